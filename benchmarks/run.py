@@ -0,0 +1,241 @@
+"""
+Benchmarks for bungee query building, result wrapping and bulk ingest.
+
+Requests go to a local stub server replaying canned responses (see
+stub_server.py), so no ElasticSearch cluster is needed. Run from the
+repository root:
+    $ python benchmarks/run.py --output bench.json
+    $ python benchmarks/run.py --compare bench.json
+
+Results are written as JSON: one entry per benchmark with its parameters
+and the best / mean time per operation. With --compare, benchmarks slower
+than the baseline by more than --tolerance are reported and the exit status
+is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bungee import SearchModel
+from stub_server import StubServer, StubState, make_hits, make_document
+
+INDEX_NAME = 'bungee_benchmarks'
+
+MAPPING = {
+    'book': {
+        'properties': {
+            'title': { 'type': 'string' },
+            'pages': { 'type': 'integer' },
+            'published': { 'type': 'date', 'format': 'YYYY-MM-dd' },
+            'tags': { 'type': 'string' },
+            'child': {
+                'properties': {
+                    'name': { 'type': 'string' },
+                    'value': { 'type': 'integer' },
+                    'born': { 'type': 'date', 'format': 'YYYY-MM-dd' }
+                }
+            },
+            'author': {
+                'properties': {
+                    'first': { 'type': 'string' },
+                    'last': { 'type': 'string' },
+                    'born': { 'type': 'date', 'format': 'YYYY-MM-dd' }
+                }
+            }
+        }
+    }
+}
+
+MIN_RUN_TIME = 0.2
+
+
+def bench(name, func, params=None, items=1, repeat=5):
+    """
+    Time func and return a result entry. The number of calls per run is
+    calibrated so each run takes at least MIN_RUN_TIME seconds.
+    :param items: number of items (documents, expressions) handled per call.
+    """
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= MIN_RUN_TIME or number >= 1000000:
+            break
+        number *= 10 if elapsed < MIN_RUN_TIME / 10 else 2
+    times = [ elapsed / number for elapsed in timer.repeat(repeat, number) ]
+    best = min(times)
+    return {
+        'name': name,
+        'params': params or {},
+        'number': number,
+        'repeat': repeat,
+        'best_s': best,
+        'mean_s': sum(times) / len(times),
+        'items_per_s': items / best if best else None,
+    }
+
+
+def bench_field_expressions(model):
+    yield bench('field.term', lambda: model.title == 'catch')
+    yield bench('field.range', lambda: model.pages > 300)
+    yield bench('field.nested_term', lambda: model.author.first == 'joseph')
+    yield bench('field.nested_like', lambda: model.author.first.like('jo*'))
+    yield bench('field.in', lambda: model.pages.in_(range(10)))
+
+
+def bench_query_building(model):
+    for filters in (1, 10, 100, 1000):
+        expressions = [ model.pages > i for i in range(filters) ]
+        def chain():
+            query = model.query()
+            for expression in expressions:
+                query = query.filter(expression)
+            return query
+        yield bench('query.chain', chain, { 'filters': filters },
+                items=filters)
+        query = chain()
+        yield bench('query.compile',
+                lambda: query._copy()._generate_es_query(),
+                { 'filters': filters })
+    query = model.query().filter(model.pages > 3).match(
+            model.title.like('heart')).order_by(model.pages.asc())
+    yield bench('query.compile_memoized', lambda: query._generate_es_query())
+
+
+def bench_wrapping(model):
+    for depth in (1, 3, 5):
+        for page_size in (10, 100, 1000):
+            hits = make_hits(0, page_size, depth)
+            params = { 'page_size': page_size, 'depth': depth }
+            yield bench('wrap.wrap_es_docs',
+                    lambda: model.wrap_es_docs(copy_hits(hits)), params,
+                    items=page_size)
+            yield bench('wrap.wrap_es_docs_decoded',
+                    lambda: model.wrap_es_docs(copy_hits(hits), decode=True),
+                    params, items=page_size)
+
+
+def copy_hits(hits):
+    """
+    wrap_es_docs modifies sources in place; give each run fresh ones.
+    """
+    return [ dict(hit, _source=dict(hit['_source'])) for hit in hits ]
+
+
+def bench_bulk_index(model):
+    for batch_size in (100, 1000):
+        docs = [ dict(make_document(i, 2), _id=str(i))
+                for i in range(batch_size) ]
+        yield bench('bulk.bulk_index', lambda: model.bulk_index(docs),
+                { 'batch_size': batch_size }, items=batch_size, repeat=3)
+
+
+def bench_pagination(model, state):
+    state.depth = 2
+    for total, page_size in ((1000, 20), (1000, 100), (1000, 1000)):
+        state.total = total
+        query = model.query().page_size(page_size)
+        yield bench('all.pagination', query.all,
+                { 'total': total, 'page_size': page_size }, items=total,
+                repeat=3)
+
+
+GROUPS = ('field', 'query', 'wrap', 'bulk', 'all')
+
+
+def run(groups=GROUPS):
+    state = StubState(INDEX_NAME, MAPPING)
+    server = StubServer(state).start()
+    try:
+        model = type('BenchBook', (SearchModel,), {
+            'index_name': INDEX_NAME,
+            'doc_type': 'book',
+            'url': server.url,
+        })
+        results = []
+        suites = {
+            'field': lambda: bench_field_expressions(model),
+            'query': lambda: bench_query_building(model),
+            'wrap': lambda: bench_wrapping(model),
+            'bulk': lambda: bench_bulk_index(model),
+            'all': lambda: bench_pagination(model, state),
+        }
+        try:
+            for group in groups:
+                for result in suites[group]():
+                    sys.stderr.write('%-28s %-40s %12.2fus\n' % (
+                        result['name'],
+                        json.dumps(result['params'], sort_keys=True),
+                        result['best_s'] * 1e6))
+                    results.append(result)
+        finally:
+            # Close keep-alive connections so the server threads exit
+            model.connection.session.close()
+        return results
+    finally:
+        server.stop()
+
+
+def result_key(result):
+    return '%s %s' % (result['name'],
+            json.dumps(result['params'], sort_keys=True))
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return a list of (key, baseline time, new time) for benchmarks slower
+    than the baseline by more than tolerance (a fraction).
+    """
+    previous = dict((result_key(result), result)
+            for result in baseline['benchmarks'])
+    regressions = []
+    for result in results:
+        old = previous.get(result_key(result))
+        if old and result['best_s'] > old['best_s'] * (1 + tolerance):
+            regressions.append((result_key(result), old['best_s'],
+                result['best_s']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', help='baseline JSON results to compare')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+            help='allowed slowdown against the baseline (default 0.2)')
+    parser.add_argument('--only', action='append', choices=GROUPS,
+            help='benchmark groups to run (default all)')
+    args = parser.parse_args(argv)
+
+    results = run(args.only or GROUPS)
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        for key, old, new in regressions:
+            sys.stderr.write('REGRESSION %s: %.2fus -> %.2fus\n' % (key,
+                old * 1e6, new * 1e6))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,148 @@
+"""
+A local HTTP server that replays canned ElasticSearch responses, so bungee
+can be benchmarked without a running cluster.
+
+The server answers the requests SearchModel makes:
+    GET  /<index>/_mapping    the configured mapping
+    GET  /<index>/_search     a page of generated documents (from / size are
+                              read from the request body)
+    GET  /<index>/_count      the configured total
+    POST /_bulk               an "ok" item per document
+    POST /<index>/_refresh    ok
+"""
+import BaseHTTPServer
+import json
+import socket
+import SocketServer
+import threading
+
+
+def make_document(doc_id, depth):
+    """
+    Return a document with nested objects depth levels deep.
+    """
+    doc = {
+        'title': 'Document %d' % doc_id,
+        'pages': doc_id % 1000,
+        'published': '1900-07-01',
+        'tags': [ 'a', 'b', 'c' ],
+    }
+    node = doc
+    for level in range(1, depth):
+        child = { 'name': 'level %d' % level, 'value': level,
+                'born': '1857-12-03' }
+        node['child'] = child
+        node = child
+    return doc
+
+
+def make_hits(start, size, depth, doc_type='book'):
+    """
+    Return a list of search hits for documents start .. start + size.
+    """
+    return [ { '_id': str(doc_id), '_type': doc_type, '_score': 1.0,
+        '_source': make_document(doc_id, depth) }
+        for doc_id in xrange(start, start + size) ]
+
+
+class StubState(object):
+    """
+    Canned data shared by the request handlers.
+    """
+
+    def __init__(self, index_name, mapping, total=1000, depth=2):
+        self.index_name = index_name
+        self.mapping = mapping
+        self.total = total
+        self.depth = depth
+        self.requests = 0
+        self.pages = {}
+
+    def search_response(self, body):
+        start = body.get('from', 0)
+        size = body.get('size', 10)
+        key = (start, size, self.depth)
+        if key not in self.pages:
+            size = max(0, min(size, self.total - start))
+            self.pages[key] = json.dumps({ 'took': 1, 'timed_out': False,
+                'hits': { 'total': self.total, 'max_score': 1.0,
+                    'hits': make_hits(start, size, self.depth) } })
+        return self.pages[key]
+
+    def bulk_response(self, body):
+        lines = body.splitlines()
+        items = []
+        for action_line in lines[::2]:
+            action = json.loads(action_line)
+            op_type, meta = action.items()[0]
+            items.append({ op_type: { '_index': meta.get('_index'),
+                '_type': meta.get('_type'), '_id': meta.get('_id'),
+                '_version': 1, 'ok': True } })
+        return json.dumps({ 'took': 1, 'items': items })
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # Headers and body are written separately; don't wait for ACKs.
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self):
+        state = self.server.state
+        state.requests += 1
+        length = int(self.headers.getheader('content-length') or 0)
+        body = self.rfile.read(length) if length else ''
+        path = self.path.split('?')[0]
+
+        if path.endswith('/_mapping'):
+            response = json.dumps({ state.index_name: state.mapping })
+        elif path.endswith('/_search'):
+            response = state.search_response(json.loads(body or '{}'))
+        elif path.endswith('/_count'):
+            response = json.dumps({ 'count': state.total })
+        elif path.endswith('/_bulk'):
+            response = state.bulk_response(body)
+        else:
+            response = json.dumps({ 'ok': True })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    do_GET = do_POST = do_PUT = do_DELETE = respond
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Stub ElasticSearch server on localhost, serving from a background thread.
+    Keep-alive connections are handled in their own daemon threads.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, state, port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                StubHandler)
+        self.state = state
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
 from bungee.model import SearchModel
+from bungee.partition import PartitionedSearchModel
 from bungee.field import not_
+from bungee.template import param
+from bungee.startup import warmup
 
-__all__ = [ 'util', 'model', 'query' ]
+__all__ = [ 'util', 'model', 'query', 'instrument', 'slowlog' ]
@@ -0,0 +1,238 @@
+"""
+This module contains builders for ES aggregations on SearchFields:
+    from bungee import aggregation as agg
+
+    q = Book.query().aggregate(
+        agg.terms(Book.author.last, size=20).aggregate(agg.stats(Book.pages)),
+        agg.date_histogram(Book.published, 'year'))
+    aggregations = q.aggregations()
+    for bucket in aggregations['author.last'].buckets:
+        print bucket.key, bucket.doc_count, bucket['pages'].avg
+
+Aggregations are named after their field path unless given a name. For
+high-cardinality fields, SearchQuery.composite_buckets pages through every
+bucket with composite aggregations (ES 6.1 or later); its query is sent in
+the ES 5 form of bool_query.
+"""
+import const
+import exception
+from field import FILTER_EXISTS, FILTER_MISSING, FILTER_NESTED, FILTER_NOT
+
+AGGS = 'aggs'
+AGGREGATIONS = 'aggregations'
+TERMS = 'terms'
+RANGE = 'range'
+DATE_RANGE = 'date_range'
+HISTOGRAM = 'histogram'
+DATE_HISTOGRAM = 'date_histogram'
+STATS = 'stats'
+CARDINALITY = 'cardinality'
+COMPOSITE = 'composite'
+
+RANGES = 'ranges'
+INTERVAL = 'interval'
+SOURCES = 'sources'
+AFTER = 'after'
+AFTER_KEY = 'after_key'
+BUCKETS = 'buckets'
+FROM = 'from'
+TO = 'to'
+
+# Aggregation types usable as composite sources
+COMPOSITE_SOURCES = (TERMS, HISTOGRAM, DATE_HISTOGRAM)
+DEFAULT_COMPOSITE_SIZE = 1000
+
+# ES 0.90 filter options that ES 5 queries reject
+LEGACY_OPTIONS = set(('_cache', '_cache_key', 'execution', 'optimize_bbox'))
+# Clauses whose "filter" became a "query" in ES 5
+JOIN_CLAUSES = set((FILTER_NESTED, 'has_child', 'has_parent'))
+BOOL_CLAUSES = (const.MUST, const.SHOULD, const.MUST_NOT, const.FILTER)
+
+
+class Aggregation(object):
+    """
+    One named aggregation and its sub-aggregations. aggregate() returns a
+    new Aggregation, so aggregations may be reused.
+    """
+
+    def __init__(self, name, agg_type, body, children=()):
+        self.name = name
+        self.agg_type = agg_type
+        self.body = body
+        self.children = tuple(children)
+
+    def aggregate(self, *aggregations):
+        """
+        Return this aggregation with sub-aggregations added, computed per
+        bucket.
+        """
+        return Aggregation(self.name, self.agg_type, self.body,
+                self.children + aggregations)
+
+    def to_dict(self):
+        agg = { self.agg_type: self.body }
+        if self.children:
+            agg[AGGS] = to_dicts(self.children)
+        return agg
+
+    def source(self):
+        """
+        Return this aggregation as a composite aggregation source.
+        """
+        if self.agg_type not in COMPOSITE_SOURCES or self.children:
+            raise exception.InvalidQueryExpression, "Composite sources must \
+be terms, histogram or date_histogram aggregations without sub-aggregations"
+        return { self.name: { self.agg_type: self.body } }
+
+    def __repr__(self):
+        return 'Aggregation[%s: %r]' % (self.name, self.to_dict())
+
+
+def to_dicts(aggregations):
+    """
+    Return the "aggs" body of a list of Aggregations.
+    """
+    return dict((aggregation.name, aggregation.to_dict())
+        for aggregation in aggregations)
+
+
+def field_body(field, **options):
+    """
+    Return an aggregation body on a SearchField, leaving out None options.
+    """
+    if field._is_parent:
+        raise exception.InvalidQueryExpression, "Cannot aggregate on object \
+field %s" % field.hierarchy
+    body = { const.FIELD: field.hierarchy }
+    for key, value in options.iteritems():
+        if value is not None:
+            body[key] = value
+    return body
+
+
+def terms(field, name=None, size=None, order=None, min_doc_count=None):
+    """
+    Bucket documents by each distinct value of a field.
+    :param size: number of buckets, by default 10.
+    :param order: e.g. { "_count": "desc" } or { "_term": "asc" }.
+    """
+    return Aggregation(name or field.hierarchy, TERMS, field_body(field,
+        size=size, order=order, min_doc_count=min_doc_count))
+
+
+def range_(field, ranges, name=None):
+    """
+    Bucket documents by value ranges, given as (from, to) tuples; either
+    bound may be None. from is inclusive, to exclusive.
+    """
+    bucket_ranges = []
+    for low, high in ranges:
+        bucket_range = {}
+        if low is not None:
+            bucket_range[FROM] = field._encode(low)
+        if high is not None:
+            bucket_range[TO] = field._encode(high)
+        bucket_ranges.append(bucket_range)
+    agg_type = DATE_RANGE if field._field_type == 'date' else RANGE
+    return Aggregation(name or field.hierarchy, agg_type,
+            field_body(field, ranges=bucket_ranges))
+
+
+def histogram(field, interval, name=None, min_doc_count=None):
+    """
+    Bucket documents by numeric value, in intervals of a fixed size.
+    """
+    return Aggregation(name or field.hierarchy, HISTOGRAM, field_body(field,
+        interval=interval, min_doc_count=min_doc_count))
+
+
+def date_histogram(field, interval, name=None, format=None,
+        min_doc_count=None):
+    """
+    Bucket documents by date, e.g. per "day", "week", "month" or "1h".
+    """
+    return Aggregation(name or field.hierarchy, DATE_HISTOGRAM,
+            field_body(field, interval=interval, format=format,
+                min_doc_count=min_doc_count))
+
+
+def stats(field, name=None):
+    """
+    Count, min, max, avg and sum of a numeric or date field.
+    """
+    return Aggregation(name or field.hierarchy, STATS, field_body(field))
+
+
+def cardinality(field, name=None, precision_threshold=None):
+    """
+    Approximate number of distinct values of a field.
+    """
+    return Aggregation(name or field.hierarchy, CARDINALITY, field_body(field,
+        precision_threshold=precision_threshold))
+
+
+def bool_query(expression):
+    """
+    Return the ES 5 and later form of a query or filter expression built for
+    ES 0.90: filtered queries and and / or / not / missing filters become
+    bool queries, filters of nested and parent/child clauses become queries,
+    and filter cache options are left out.
+    """
+    if isinstance(expression, list):
+        return [ bool_query(item) for item in expression ]
+    if not isinstance(expression, dict) or len(expression) != 1:
+        return expression
+    name, body = expression.items()[0]
+    if name == const.FILTERED:
+        converted = {}
+        if const.QUERY in body:
+            converted[const.MUST] = bool_query(body[const.QUERY])
+        if const.FILTER in body:
+            converted[const.FILTER] = bool_query(body[const.FILTER])
+        return { const.BOOL: converted }
+    if name in (const.AND, const.OR):
+        filters = bool_query(body[const.FILTERS] if isinstance(body, dict)
+                else body)
+        if name == const.AND:
+            return { const.BOOL: { const.FILTER: filters } }
+        return { const.BOOL: { const.SHOULD: filters,
+            'minimum_should_match': 1 } }
+    if name == FILTER_NOT:
+        if isinstance(body, dict) and const.FILTER in body:
+            body = body[const.FILTER]
+        return { const.BOOL: { const.MUST_NOT: bool_query(body) } }
+    if name == FILTER_MISSING:
+        return { const.BOOL: { const.MUST_NOT: { FILTER_EXISTS: {
+            const.FIELD: body[const.FIELD] } } } }
+    if name == const.QUERY:
+        # A query wrapped as a filter
+        return bool_query(body)
+    if not isinstance(body, dict):
+        return expression
+    body = dict((key, value) for key, value in body.iteritems()
+        if key not in LEGACY_OPTIONS)
+    if name == const.BOOL:
+        for clause in BOOL_CLAUSES:
+            if clause in body:
+                body[clause] = bool_query(body[clause])
+    elif name in JOIN_CLAUSES or name == 'constant_score':
+        if const.FILTER in body:
+            body[const.FILTER] = bool_query(body[const.FILTER])
+            if name in JOIN_CLAUSES:
+                body[const.QUERY] = body.pop(const.FILTER)
+        if const.QUERY in body:
+            body[const.QUERY] = bool_query(body[const.QUERY])
+    return { name: body }
+
+
+def composite(sources, name=COMPOSITE, size=DEFAULT_COMPOSITE_SIZE,
+        after=None):
+    """
+    Page through all buckets of a combination of terms / histogram
+    aggregations; after is the previous page's "after_key".
+    """
+    body = { SOURCES: [ source.source() for source in sources ],
+        const.SIZE: size }
+    if after is not None:
+        body[AFTER] = after
+    return Aggregation(name, COMPOSITE, body)
@@ -0,0 +1,187 @@
+"""
+This module contains helpers for the ES bulk API. Unlike pyelasticsearch's
+bulk_index, each action names its own index and may carry metadata such as
+routing, so one request can write to several indices.
+    actions = [ bulk.action(const.INDEX, 'events-2013.05.01', 'event', '1'),
+        ... ]
+    response = bulk.send(connection, zip(actions, docs))
+"""
+import random
+import time
+
+from pyelasticsearch import ElasticHttpError
+from pyelasticsearch.exceptions import ConnectionError, Timeout
+
+import const
+import exception
+
+BULK = '_bulk'
+UPDATE = '_update'
+META_PREFIX = '_'
+
+# Item statuses and errors worth resending: throttling, full queues
+RETRY_STATUSES = (429, 503)
+RETRY_ERRORS = ('EsRejectedExecutionException',)
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_BACKOFF = 0.1
+DEFAULT_MAX_BACKOFF = 10.0
+
+DOC = 'doc'
+SCRIPT = 'script'
+LANG = 'lang'
+UPSERT = 'upsert'
+DOC_AS_UPSERT = 'doc_as_upsert'
+
+
+def query_params(request_params):
+    """
+    Return ES query parameters from pyelasticsearch-style request arguments
+    (es_-prefixed keywords, or plain ones).
+    """
+    params = {}
+    for key, value in request_params.iteritems():
+        if key.startswith('es_'):
+            key = key[3:]
+        params[key] = value
+    return params
+
+
+def action(op_type, index, doc_type, doc_id=None, **meta):
+    """
+    Return one bulk action, e.g. { "index": { "_index": ..., "_type": ...,
+    "_id": ... } }.
+    :param op_type: "index", "create", "update" or "delete".
+    :param index: index name, or None for the index of the request URL.
+    :param meta: other action metadata (e.g. routing=..., version=...); None
+        values are left out.
+    """
+    metadata = { const.TYPE: doc_type }
+    if index is not None:
+        metadata['_index'] = index
+    if doc_id is not None:
+        metadata[const.ID] = doc_id
+    for key, value in meta.iteritems():
+        if value is not None:
+            metadata[META_PREFIX + key] = value
+    return { op_type: metadata }
+
+
+def update_body(partial=None, script=None, params=None, upsert=None,
+        lang=None):
+    """
+    Return the body of an update request or bulk update action.
+    :param partial: partial document merged into the existing document.
+    :param script: script updating the document, with params and lang.
+    :param upsert: document to create if none exists; True creates the
+        partial document instead.
+    """
+    if partial is None and script is None:
+        raise ValueError, "A partial document or a script is required"
+    update = {}
+    if partial is not None:
+        update[DOC] = partial
+    if script is not None:
+        update[SCRIPT] = script
+        if params:
+            update[const.PARAMS] = params
+        if lang:
+            update[LANG] = lang
+    if upsert is True:
+        update[DOC_AS_UPSERT] = True
+    elif upsert is not None:
+        update[UPSERT] = upsert
+    return update
+
+
+def body(connection, actions):
+    """
+    Return the newline-delimited request body for (action, source) pairs; the
+    source is None for delete actions.
+    """
+    lines = []
+    for bulk_action, source in actions:
+        lines.append(connection._encode_json(bulk_action))
+        if source is not None:
+            lines.append(connection._encode_json(source))
+    return '\n'.join(lines) + '\n'
+
+
+def send(connection, actions, **request_params):
+    """
+    Send (action, source) pairs in one bulk request and return the response.
+    """
+    if not actions:
+        raise ValueError, "No actions provided for bulk request"
+    return connection.send_request('POST', [ BULK ], body(connection, actions),
+            query_params=query_params(request_params), encode_body=False)
+
+
+def succeeded(item):
+    """
+    Return True if a bulk response item reports success.
+    """
+    result = item.values()[0]
+    return bool(result.get(const.OK)) or (result.get('status', 0) < 300
+            and 'error' not in result)
+
+
+def is_retryable(item):
+    """
+    Return True if a failed bulk response item was rejected or throttled,
+    and may succeed if resent.
+    """
+    result = item.values()[0]
+    if result.get('status') in RETRY_STATUSES:
+        return True
+    error = unicode(result.get('error', ''))
+    return any(name in error for name in RETRY_ERRORS)
+
+
+def backoff_delay(attempt, backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF):
+    """
+    Return the seconds to wait before retry number attempt (from 0):
+    exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+
+
+def send_retrying(connection, actions, max_retries=DEFAULT_MAX_RETRIES,
+        backoff=DEFAULT_BACKOFF, max_backoff=DEFAULT_MAX_BACKOFF,
+        dead_letter=None, sender=send, **request_params):
+    """
+    Send (action, source) pairs in bulk, resending only rejected or
+    throttled items (and whole requests failing with a retryable status or
+    connection error) with backoff. Yield (action, source, response item)
+    for each successful action.
+    :param dead_letter: function called with (action, source, item) for each
+        item that failed permanently or ran out of retries. Without it such
+        failures raise IndexDocumentError.
+    :param sender: function sending one bulk request, like send.
+    """
+    attempt = 0
+    while actions:
+        retry = []
+        try:
+            response = sender(connection, actions, **request_params)
+        except (ElasticHttpError, ConnectionError, Timeout), e:
+            status = getattr(e, 'status_code', None)
+            if attempt >= max_retries or not (status is None
+                    or status in RETRY_STATUSES):
+                raise
+            retry = actions
+        else:
+            for pair, item in zip(actions, response[const.ITEMS]):
+                if succeeded(item):
+                    yield pair[0], pair[1], item
+                elif is_retryable(item) and attempt < max_retries:
+                    retry.append(pair)
+                elif dead_letter is not None:
+                    dead_letter(pair[0], pair[1], item)
+                else:
+                    raise exception.IndexDocumentError("Bulk action failed \
+after %d attempts: %s" % (attempt + 1, item))
+        actions = retry
+        if actions:
+            time.sleep(backoff_delay(attempt, backoff, max_backoff))
+            attempt += 1
@@ -0,0 +1,380 @@
+"""
+This module contains helpers for converting Python values to and from the
+representations ElasticSearch expects for a given field mapping.
+
+Encoders are used when building query expressions, so operands are sent in
+their native JSON types (numbers as numbers, dates in the mapping's format).
+Decoders are used when wrapping search results, so mapped date and number
+fields come back as Python objects.
+"""
+import calendar
+import datetime
+import re
+
+import const
+from template import Param
+
+NUMBER_TYPES = {
+    'byte': int,
+    'short': int,
+    'integer': int,
+    'long': long,
+    'float': float,
+    'double': float,
+}
+
+# Named ElasticSearch date formats, as strftime patterns.
+NAMED_DATE_FORMATS = {
+    'basic_date': '%Y%m%d',
+    'basic_date_time': '%Y%m%dT%H%M%S.%f',
+    'basic_date_time_no_millis': '%Y%m%dT%H%M%S',
+    'date': '%Y-%m-%d',
+    'date_hour': '%Y-%m-%dT%H',
+    'date_hour_minute': '%Y-%m-%dT%H:%M',
+    'date_hour_minute_second': '%Y-%m-%dT%H:%M:%S',
+    'date_hour_minute_second_millis': '%Y-%m-%dT%H:%M:%S.%f',
+    'date_time': '%Y-%m-%dT%H:%M:%S.%f',
+    'date_time_no_millis': '%Y-%m-%dT%H:%M:%S',
+    'year': '%Y',
+    'year_month': '%Y-%m',
+    'year_month_day': '%Y-%m-%d',
+}
+
+# Named ES formats of numeric timestamps, kept as markers in pattern lists.
+EPOCH_MILLIS = 'epoch_millis'
+EPOCH_SECOND = 'epoch_second'
+EPOCH_FORMATS = { EPOCH_MILLIS: 1000.0, EPOCH_SECOND: 1.0 }
+
+# Patterns tried, in order, for the default "dateOptionalTime" format. Those
+# with a time may be followed by "Z" or a UTC offset.
+OPTIONAL_TIME_FORMATS = (
+    '%Y-%m-%dT%H:%M:%S.%f',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%dT%H:%M',
+    '%Y-%m-%d',
+)
+
+# strftime directives of a UTC offset: "+0100" (Joda Z) and "+01:00" (ZZ).
+# Python 2 can't parse or format them, so codec handles them itself.
+OFFSET = '%z'
+COLON_OFFSET = '%:z'
+OFFSET_RE = re.compile(r'%(%|:?z)')
+DIRECTIVE_RE = re.compile(r'%(%|f|:?z)')
+ZONE_RE = re.compile(r'(Z|[+-]\d\d(?::?\d\d)?)$')
+
+# Joda-time pattern letters and their strftime equivalents, longest first.
+JODA_TOKENS = (
+    ('yyyy', '%Y'),
+    ('YYYY', '%Y'),
+    ('yy', '%y'),
+    ('YY', '%y'),
+    ('MM', '%m'),
+    ('dd', '%d'),
+    ('HH', '%H'),
+    ('mm', '%M'),
+    ('ss', '%S'),
+    ('SSS', '%f'),
+    ('ZZ', COLON_OFFSET),
+    ('Z', OFFSET),
+)
+# A quoted literal ('' is a quote), a pattern token, or any other character
+JODA_RE = re.compile("'((?:[^']|'')*)'|%s|." % '|'.join(token
+    for token, _ in JODA_TOKENS), re.DOTALL)
+JODA_TOKEN_MAP = dict(JODA_TOKENS)
+
+
+def mapping_type(mapping):
+    """
+    Return the core type of a field mapping. multi_field mappings report the
+    type of their sub-fields (which share one core type in practice).
+    """
+    field_type = mapping.get(const.PROPERTY_TYPE)
+    if field_type == const.MAPPING_MULTI_FIELD:
+        field_type = None
+        for sub_mapping in mapping.get(const.FIELDS, {}).values():
+            field_type = sub_mapping.get(const.PROPERTY_TYPE)
+            if field_type:
+                break
+    return field_type
+
+
+def joda_strftime(fmt):
+    """
+    Return the strftime pattern of a Joda-time pattern, e.g.
+    "yyyy-MM-dd'T'HH:mm:ssZ" -> "%Y-%m-%dT%H:%M:%S%z".
+    """
+    def convert(match):
+        if match.group(1) is not None:
+            literal = match.group(1).replace("''", "'") or "'"
+            return literal.replace('%', '%%')
+        text = match.group(0)
+        if text in JODA_TOKEN_MAP:
+            return JODA_TOKEN_MAP[text]
+        return '%%' if text == '%' else text
+    return JODA_RE.sub(convert, fmt)
+
+
+def strftime_formats(mapping):
+    """
+    Return the list of strftime patterns for a date mapping's "format"
+    (formats may be joined by "||"). None means dateOptionalTime;
+    EPOCH_MILLIS and EPOCH_SECOND mean numeric timestamps.
+    """
+    date_format = mapping.get(const.MAPPING_FORMAT)
+    if not date_format:
+        return [None]
+    patterns = []
+    for fmt in date_format.split('||'):
+        if fmt in NAMED_DATE_FORMATS:
+            patterns.append(NAMED_DATE_FORMATS[fmt])
+        elif fmt in EPOCH_FORMATS:
+            patterns.append(fmt)
+        elif fmt in ('dateOptionalTime', 'date_optional_time'):
+            patterns.append(None)
+        else:
+            patterns.append(joda_strftime(fmt))
+    return patterns
+
+
+def utc_offset(value, colon=False):
+    """
+    Return the UTC offset of a datetime as "+hhmm" (or "+hh:mm"); naive
+    datetimes are taken to be UTC.
+    """
+    offset = value.utcoffset() if isinstance(value,
+            datetime.datetime) else None
+    minutes = int(offset.total_seconds()) // 60 if offset else 0
+    sign = '-' if minutes < 0 else '+'
+    hours, minutes = divmod(abs(minutes), 60)
+    return '%s%02d%s%02d' % (sign, hours, ':' if colon else '', minutes)
+
+
+def format_date(value, pattern):
+    """
+    Format a date/datetime with a strftime pattern, or as a number for
+    EPOCH_MILLIS / EPOCH_SECOND. Milliseconds (%f) are truncated to three
+    digits, as Joda expects.
+    """
+    if pattern is None:
+        return value.isoformat()
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    if pattern in EPOCH_FORMATS:
+        seconds = calendar.timegm(value.utctimetuple())
+        if pattern == EPOCH_SECOND:
+            return seconds
+        return seconds * 1000 + value.microsecond // 1000
+    def directive(match):
+        if match.group(1) == 'f':
+            return '%03d' % (value.microsecond // 1000)
+        if match.group(1) == '%':
+            return match.group(0)
+        return utc_offset(value, match.group(1) == ':z')
+    return value.strftime(DIRECTIVE_RE.sub(directive, pattern))
+
+
+def split_zone(text):
+    """
+    Return (text, offset): a date string without its trailing "Z" or UTC
+    offset, and the offset as a timedelta (None if it has none).
+    """
+    match = ZONE_RE.search(text)
+    if match is None:
+        return text, None
+    zone = match.group(1)
+    if zone == 'Z':
+        return text[:match.start()], datetime.timedelta(0)
+    minutes = int(zone[1:3]) * 60 + (int(zone[-2:]) if len(zone) > 3 else 0)
+    if zone[0] == '-':
+        minutes = -minutes
+    return text[:match.start()], datetime.timedelta(minutes=minutes)
+
+
+def strip_offset(pattern):
+    """
+    Return (pattern, zoned): a strftime pattern without its UTC offset
+    directives, and whether it had any.
+    """
+    zoned = []
+    def strip(match):
+        if match.group(1) == '%':
+            return match.group(0)
+        zoned.append(match.group(0))
+        return ''
+    return OFFSET_RE.sub(strip, pattern), bool(zoned)
+
+
+def from_epoch(value, pattern):
+    """
+    Return the naive UTC datetime of a number of EPOCH_MILLIS / EPOCH_SECOND.
+    """
+    return datetime.datetime.utcfromtimestamp(
+        float(value) / EPOCH_FORMATS[pattern])
+
+
+def parse_date(text, patterns):
+    """
+    Parse a date string with the first matching strftime pattern. A trailing
+    "Z" or UTC offset (after a dateOptionalTime time, or where the pattern
+    has one) is applied, giving a naive UTC datetime.
+
+    Returns the original text if no pattern matches, so decoded sources may
+    hold strings for dates written in other formats.
+    """
+    bare, offset = split_zone(text)
+    for pattern in patterns:
+        if pattern in EPOCH_FORMATS:
+            try:
+                return from_epoch(text, pattern)
+            except ValueError:
+                continue
+        if pattern is None:
+            candidates = [ (candidate, '%H' in candidate)
+                for candidate in OPTIONAL_TIME_FORMATS ]
+        else:
+            candidates = [ strip_offset(pattern) ]
+        for candidate, zoned in candidates:
+            try:
+                if zoned and offset is not None:
+                    return datetime.datetime.strptime(bare, candidate) - offset
+                return datetime.datetime.strptime(text, candidate)
+            except ValueError:
+                continue
+    return text
+
+
+def encode_default(value):
+    """
+    Encoding for unmapped and string fields: values are sent as strings.
+    """
+    if isinstance(value, basestring):
+        return value
+    return str(value)
+
+
+def with_params(encode):
+    """
+    Wrap an encoder so that template Params pass through it, remembering the
+    encoder to apply to the value bound later.
+    """
+    def encode_operand(value):
+        if isinstance(value, Param):
+            return value.encoded_by(encode)
+        return encode(value)
+    return encode_operand
+
+
+encode_text = with_params(encode_default)
+
+
+def encoder_for(mapping):
+    """
+    Return a function converting a query operand to the JSON value ES expects
+    for the given field mapping.
+    """
+    return with_params(value_encoder(mapping))
+
+
+def value_encoder(mapping):
+    """
+    Return the encoder for concrete (non-Param) operands of a field mapping.
+    """
+    field_type = mapping_type(mapping)
+    if field_type in NUMBER_TYPES:
+        number = NUMBER_TYPES[field_type]
+        def encode_number(value):
+            if isinstance(value, (int, long, float)):
+                return value
+            try:
+                return number(value)
+            except (TypeError, ValueError):
+                return value
+        return encode_number
+    if field_type == 'date':
+        pattern = strftime_formats(mapping)[0]
+        def encode_date(value):
+            if isinstance(value, (datetime.date, datetime.datetime)):
+                return format_date(value, pattern)
+            if isinstance(value, (int, long, float, basestring)):
+                return value
+            return str(value)
+        return encode_date
+    if field_type == 'boolean':
+        def encode_boolean(value):
+            if isinstance(value, bool):
+                return value
+            return encode_default(value)
+        return encode_boolean
+    return encode_default
+
+
+def decoder_for(mapping):
+    """
+    Return a function converting a stored _source value to a Python object for
+    the given field mapping, or None if the field needs no conversion.
+    """
+    field_type = mapping_type(mapping)
+    if field_type in NUMBER_TYPES:
+        number = NUMBER_TYPES[field_type]
+        def decode_number(value):
+            if isinstance(value, basestring):
+                try:
+                    return number(value)
+                except ValueError:
+                    return value
+            return value
+        return decode_number
+    if field_type == 'date':
+        patterns = strftime_formats(mapping)
+        epochs = [ pattern for pattern in patterns if pattern in EPOCH_FORMATS ]
+        epoch = epochs[0] if epochs else EPOCH_MILLIS
+        def decode_date(value):
+            if isinstance(value, basestring):
+                return parse_date(value, patterns)
+            if isinstance(value, (int, long, float)):
+                return from_epoch(value, epoch)
+            return value
+        return decode_date
+    return None
+
+
+def compile_decoders(mapping_properties):
+    """
+    Return a tree of decoders for the given mapping properties, e.g.
+    { 'pages': <int decoder>, 'author': { 'born': <date decoder> } }.
+    Fields that need no conversion are left out.
+    """
+    decoders = {}
+    for field_name, mapping in mapping_properties.items():
+        if const.PROPERTIES in mapping:
+            sub_decoders = compile_decoders(mapping[const.PROPERTIES])
+            if sub_decoders:
+                decoders[field_name] = sub_decoders
+            continue
+        decoder = decoder_for(mapping)
+        if decoder is not None:
+            decoders[field_name] = decoder
+    return decoders
+
+
+def decode_source(source, decoders):
+    """
+    Convert values in a document source in place, using a decoder tree from
+    compile_decoders.
+    """
+    for field_name, decoder in decoders.iteritems():
+        value = source.get(field_name)
+        if value is None:
+            continue
+        if isinstance(decoder, dict):
+            if isinstance(value, dict):
+                decode_source(value, decoder)
+            elif isinstance(value, list):
+                for item in value:
+                    if isinstance(item, dict):
+                        decode_source(item, decoder)
+        elif isinstance(value, list):
+            source[field_name] = [ decoder(item) for item in value ]
+        else:
+            source[field_name] = decoder(value)
+    return source
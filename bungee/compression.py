@@ -0,0 +1,82 @@
+"""
+This module contains HTTP compression for pyelasticsearch connections.
+Request bodies (e.g. bulk bodies) are gzip or deflate compressed, and
+compressed responses are asked for with Accept-Encoding; ES only compresses
+responses with http.compression enabled. Responses are decompressed by
+requests / urllib3 as they are read, without buffering the compressed body.
+
+Per model:
+    class Book(SearchModel):
+        index_name = 'books'
+        compression = 'gzip'
+Or per connection:
+    compression.compress(connection, 'deflate')
+"""
+import zlib
+
+import requests
+
+GZIP = 'gzip'
+DEFLATE = 'deflate'
+ENCODINGS = (GZIP, DEFLATE)
+IDENTITY = 'identity'
+CONTENT_ENCODING = 'Content-Encoding'
+ACCEPT_ENCODING = 'Accept-Encoding'
+
+# Smaller bodies aren't worth the CPU time
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+
+
+def compress_body(body, encoding=GZIP, level=DEFAULT_LEVEL):
+    """
+    Return a request body compressed with gzip or deflate (zlib format).
+    """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    wbits = zlib.MAX_WBITS | 16 if encoding == GZIP else zlib.MAX_WBITS
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    return compressor.compress(body) + compressor.flush()
+
+
+class CompressingSession(requests.Session):
+    """
+    A requests Session compressing request bodies of at least min_size
+    bytes, and accepting compressed responses if compress_responses is True.
+    """
+
+    def __init__(self, encoding=GZIP, min_size=DEFAULT_MIN_SIZE,
+            level=DEFAULT_LEVEL, compress_responses=True):
+        super(CompressingSession, self).__init__()
+        if encoding not in ENCODINGS:
+            raise ValueError, "Unsupported encoding %r, use one of %s" % (
+                    encoding, ', '.join(ENCODINGS))
+        self.encoding = encoding
+        self.min_size = min_size
+        self.level = level
+        self.headers[ACCEPT_ENCODING] = ', '.join(ENCODINGS) \
+            if compress_responses else IDENTITY
+
+    def request(self, method, url, data=None, headers=None, **kwargs):
+        if isinstance(data, basestring) and len(data) >= self.min_size:
+            data = compress_body(data, self.encoding, self.level)
+            headers = dict(headers or {})
+            headers[CONTENT_ENCODING] = self.encoding
+        return super(CompressingSession, self).request(method, url, data=data,
+                headers=headers, **kwargs)
+
+
+def compress(connection, encoding=GZIP, **kwargs):
+    """
+    Make a pyelasticsearch connection use HTTP compression, and return it.
+    Connections without an HTTP session (the memory backend) are returned
+    unchanged.
+    :param kwargs: CompressingSession arguments: min_size, level,
+        compress_responses.
+    """
+    if hasattr(connection, 'session'):
+        session = CompressingSession(encoding, **kwargs)
+        # Keep response hooks, e.g. instrument.measure's
+        session.hooks = connection.session.hooks
+        connection.session = session
+    return connection
@@ -7,25 +7,34 @@ FIELDS = 'fields'
 HITS = 'hits'
 ID = '_id'
 INDEX = 'index'
+INDEX_META = '_index'
 INDEX_NAME = 'index_name'
 ITEMS = 'items'
 KILOMETERS = 'km'
+MAPPINGS = 'mappings'
 MAPPING_DYNAMIC = 'dynamic'
+MAPPING_FORMAT = 'format'
 MAPPING_MULTI_FIELD = 'multi_field'
 MAPPING_NULL_VALUE = 'null_value'
 MILES = 'mi'
 OK = 'ok'
+PARAMS = 'params'
+PARENT = '_parent'
 PROPERTIES = 'properties'
 PROPERTY_TYPE = 'type'
+ROUTING = '_routing'
 SCORE = '_score'
 SOURCE = '_source'
+TEMPLATE = 'template'
 TOTAL = 'total'
 TTL = '_ttl'
 TYPE = '_type'
 UID = '_uid'
 UNIT = 'unit'
+UPDATE = 'update'
 URL = 'url'
 URLS = 'urls'
+VERSION = '_version'
 
 # Matching / Filtering
 AND = "and"
@@ -33,6 +42,7 @@ BOOL = 'bool'
 DOC_TYPE = 'doc_type'
 FILTER = 'filter'
 FILTERED = 'filtered'
+FILTERS = 'filters'
 MATCH_ALL = 'match_all'
 MUST = 'must'
 MUST_NOT = 'must_not'
@@ -0,0 +1,226 @@
+"""
+This module contains a static cost analyzer for compiled queries.
+
+analyze_query inspects a SearchQuery's compiled ES query, its pagination
+settings and its model's mappings, and reports patterns known to be
+expensive on the cluster:
+    - query_string / wildcard queries with leading wildcards
+    - regexp queries with open (leading ".*"-style) patterns
+    - deep pagination offsets
+    - term facets on high-cardinality fields
+"""
+import re
+
+import const
+import exception
+from field import (MATCH_QUERY_STRING, MATCH_REGEXP, MATCH_WILDCARD, VALUE,
+        ANALYZE_WILDCARD)
+
+WARNING = 'warning'
+ERROR = 'error'
+SEVERITIES = (WARNING, ERROR)
+
+DEEP_PAGINATION_OFFSET = 10000
+LARGE_FACET_SIZE = 1000
+
+# Terms starting with a wildcard, e.g. "*son" or "foo ?ar"
+LEADING_WILDCARD_RE = re.compile(r'(^|[\s(:])[*?]')
+# Patterns that start by matching any character any number of times
+OPEN_REGEXP_RE = re.compile(r'^(\.|\[\^?[^\]]*\])[*+]')
+UNIQUE_FIELDS = set((const.ID, const.UID))
+
+
+class CostWarning(object):
+    """
+    One expensive pattern found in a query.
+    """
+
+    def __init__(self, severity, rule, location, message):
+        self.severity = severity
+        self.rule = rule
+        self.location = location
+        self.message = message
+
+    def __repr__(self):
+        return '%s[%s] at %s: %s' % (self.severity.upper(), self.rule,
+                self.location, self.message)
+
+
+class CostReport(object):
+    """
+    The list of CostWarnings found in a query.
+    """
+
+    def __init__(self, warnings=None):
+        self.warnings = warnings or []
+
+    def at_least(self, severity):
+        """
+        Return the warnings of the given severity or worse.
+        """
+        level = SEVERITIES.index(severity)
+        return [ warning for warning in self.warnings
+                if SEVERITIES.index(warning.severity) >= level ]
+
+    @property
+    def errors(self):
+        return self.at_least(ERROR)
+
+    def __len__(self):
+        return len(self.warnings)
+
+    def __iter__(self):
+        return iter(self.warnings)
+
+    def __repr__(self):
+        if not self.warnings:
+            return 'CostReport: no expensive patterns found'
+        return 'CostReport:\n%s' % '\n'.join(
+                '  %r' % warning for warning in self.warnings)
+
+
+def walk(value, location=''):
+    """
+    Yield (location, key, body) for every dict entry in a compiled query.
+    """
+    if isinstance(value, dict):
+        for key, body in value.iteritems():
+            child = '%s.%s' % (location, key) if location else key
+            yield child, key, body
+            for item in walk(body, child):
+                yield item
+    elif isinstance(value, list):
+        for index, body in enumerate(value):
+            for item in walk(body, '%s[%d]' % (location, index)):
+                yield item
+
+
+def check_clause(location, key, body):
+    """
+    Return a list of CostWarnings for one query clause.
+    """
+    warnings = []
+    if key == MATCH_QUERY_STRING and isinstance(body, dict):
+        text = body.get(const.QUERY)
+        if (isinstance(text, basestring) and body.get(ANALYZE_WILDCARD, True)
+                and LEADING_WILDCARD_RE.search(text)):
+            warnings.append(CostWarning(ERROR, 'leading_wildcard', location,
+                "query_string '%s' has a leading wildcard, which scans every \
+term of the field" % text))
+    elif key in (MATCH_WILDCARD, MATCH_REGEXP) and isinstance(body, dict):
+        for field_name, clause in body.iteritems():
+            pattern = clause.get(VALUE) if isinstance(clause, dict) else clause
+            if not isinstance(pattern, basestring):
+                continue
+            if key == MATCH_WILDCARD and pattern[:1] in ('*', '?'):
+                warnings.append(CostWarning(ERROR, 'leading_wildcard',
+                    location, "wildcard '%s' on %s has a leading wildcard" % (
+                        pattern, field_name)))
+            elif key == MATCH_REGEXP and OPEN_REGEXP_RE.match(pattern):
+                warnings.append(CostWarning(ERROR, 'open_regexp', location,
+                    "regexp '%s' on %s starts with an open pattern, which \
+scans every term of the field" % (pattern, field_name)))
+            elif key == MATCH_REGEXP and pattern.count('.*') > 1:
+                warnings.append(CostWarning(WARNING, 'open_regexp', location,
+                    "regexp '%s' on %s has several open repetitions" % (
+                        pattern, field_name)))
+    return warnings
+
+
+def check_pagination(query):
+    """
+    Return a list of CostWarnings for deep result offsets.
+    """
+    page_size = query._page_size or const.DEFAULT_PAGE_SIZE
+    first = (query._offset or 0) * page_size
+    if first >= DEEP_PAGINATION_OFFSET:
+        return [ CostWarning(WARNING, 'deep_pagination', const.FROM,
+            "offset of %d documents; every shard must sort %d hits" % (
+                first, first + page_size)) ]
+    return []
+
+
+def find_mapping(model, path):
+    """
+    Return the mapping of a dotted field path in the model, or None.
+    """
+    field = model
+    for name in path.split('.'):
+        field = getattr(field, name, None)
+        if field is None:
+            return None
+    return getattr(field, '_mapping', None)
+
+
+def check_facets(query):
+    """
+    Return a list of CostWarnings for term facets on high-cardinality fields.
+    """
+    warnings = []
+    for facet_query in query.facet_queries:
+        for facet_name, facet in facet_query.iteritems():
+            terms = facet.get(const.TERMS)
+            if not isinstance(terms, dict):
+                continue
+            location = '%s.%s' % (const.FACETS, facet_name)
+            path = terms.get(const.FIELD)
+            size = terms.get(const.SIZE)
+            if size and size >= LARGE_FACET_SIZE:
+                warnings.append(CostWarning(WARNING, 'large_facet', location,
+                    "term facet returns up to %d terms" % size))
+            if path in UNIQUE_FIELDS:
+                warnings.append(CostWarning(ERROR, 'high_cardinality_facet',
+                    location, "term facet on unique field %s" % path))
+                continue
+            mapping = find_mapping(query.search_model_class, path)
+            if mapping is None:
+                continue
+            if (mapping.get(const.PROPERTY_TYPE) == 'string'
+                    and mapping.get(const.INDEX) != 'not_analyzed'):
+                warnings.append(CostWarning(WARNING, 'high_cardinality_facet',
+                    location, "term facet on analyzed string field %s loads \
+every term of every document" % path))
+    return warnings
+
+
+def check_clauses(es_query):
+    """
+    Return a list of CostWarnings for the clauses of a compiled query.
+    """
+    warnings = []
+    for location, key, body in walk(es_query):
+        warnings.extend(check_clause(location, key, body))
+    return warnings
+
+
+def analyze_query(query):
+    """
+    Return a CostReport for a SearchQuery.
+    """
+    warnings = check_clauses(query._generate_es_query())
+    warnings.extend(check_pagination(query))
+    warnings.extend(check_facets(query))
+    return CostReport(warnings)
+
+
+def enforce(query, severity):
+    """
+    Raise ExpensiveQueryError if the query has warnings of the given severity
+    or worse.
+    """
+    reject(analyze_query(query), severity)
+
+
+def enforce_body(es_query, severity):
+    """
+    Raise ExpensiveQueryError if the clauses of a compiled query, e.g. a
+    bound QueryTemplate body, have warnings of the given severity or worse.
+    """
+    reject(CostReport(check_clauses(es_query)), severity)
+
+
+def reject(report, severity):
+    rejected = report.at_least(severity)
+    if rejected:
+        raise exception.ExpensiveQueryError, "Query rejected by cost \
+analyzer:\n%s" % '\n'.join('  %r' % warning for warning in rejected)
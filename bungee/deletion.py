@@ -0,0 +1,122 @@
+"""
+This module contains throttled_delete, which deletes the documents matching
+a SearchQuery without one unbounded delete-by-query: matching ids are
+scrolled in batches and deleted with bulk requests, at most max_per_second
+documents per second:
+    stop = threading.Event()
+    progress = Book.query().filter(Book.pages < 10).delete(batch_size=500,
+        max_per_second=2000, cancel=stop.is_set,
+        progress=lambda progress: log.info('%r', progress))
+
+Deleted ids are passed to the model's delete listeners (see
+SearchModel.add_delete_listener) after each batch, to invalidate client-side
+caches.
+"""
+import time
+from contextlib import closing
+
+import bulk
+import const
+import exception
+import reindex
+
+DEFAULT_BATCH_SIZE = 500
+FIELDS = 'fields'
+NOT_FOUND = 404
+
+
+class DeleteProgress(object):
+    """
+    Progress of a throttled delete: documents deleted out of total, and
+    whether it was cancelled.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.deleted = 0
+        self.cancelled = False
+        self.start = time.time()
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        """
+        Documents deleted per second.
+        """
+        elapsed = self.elapsed
+        return self.deleted / elapsed if elapsed else 0.0
+
+    def __repr__(self):
+        return 'DeleteProgress(%d/%d documents, %.0f/s%s)' % (self.deleted,
+                self.total, self.rate, ', cancelled' if self.cancelled else '')
+
+
+def check_deleted(action, source, item):
+    """
+    Dead-letter callback of bulk deletes: documents already gone are fine,
+    other failures raise DeleteDocumentError.
+    """
+    result = item.values()[0]
+    if result.get('status') != NOT_FOUND:
+        raise exception.DeleteDocumentError("Failed to delete doc %s: %s" % (
+                action.values()[0].get(const.ID), item))
+
+
+def throttled_delete(query, doc_type=None, batch_size=DEFAULT_BATCH_SIZE,
+        max_per_second=None, progress=None, cancel=None,
+        scroll_timeout=reindex.DEFAULT_SCROLL):
+    """
+    Delete the documents matching a SearchQuery in bulk batches and return
+    the final DeleteProgress.
+    :param doc_type: document type(s) to delete; defaults to the model's.
+    :param batch_size: documents per scroll page and bulk delete.
+    :param max_per_second: maximum documents deleted per second.
+    :param progress: function called with the DeleteProgress after each
+        batch.
+    :param cancel: function returning True to stop before the next batch.
+    """
+    model = query.search_model_class
+    connection = model.connection
+    es_query = { const.QUERY: query._generate_es_query(count_query=True),
+        const.SIZE: batch_size, FIELDS: [ const.ROUTING, const.PARENT ] }
+    index, request_params = model._search_indices(model.query_indices(query))
+    model._routing_params(query._search_routing(), request_params)
+    status = None
+    try:
+        with closing(reindex.scroll(connection, es_query, index,
+                doc_type or model.doc_type, scroll_timeout,
+                **request_params)) as responses:
+            for response in responses:
+                hits = response[const.HITS][const.HITS]
+                if status is None:
+                    status = DeleteProgress(response[const.HITS][const.TOTAL])
+                if cancel is not None and cancel():
+                    status.cancelled = True
+                    break
+                # ES returns meta fields at the top level of hits
+                actions = [ (bulk.action('delete', hit['_index'],
+                    hit[const.TYPE], hit[const.ID],
+                    routing=hit.get(const.ROUTING),
+                    parent=hit.get(const.PARENT)), None) for hit in hits ]
+                deleted = {}
+                for action, _, item in bulk.send_retrying(connection, actions,
+                        dead_letter=check_deleted):
+                    meta = action['delete']
+                    deleted.setdefault(meta[const.TYPE], []).append(
+                            meta[const.ID])
+                for deleted_type, doc_ids in deleted.iteritems():
+                    status.deleted += len(doc_ids)
+                    model.deleted(deleted_type, doc_ids)
+                if progress is not None:
+                    progress(status)
+                if max_per_second:
+                    wait = (float(status.deleted) / max_per_second
+                            - status.elapsed)
+                    if wait > 0:
+                        time.sleep(wait)
+    finally:
+        model.refresh()
+    return status or DeleteProgress(0)
@@ -19,3 +19,5 @@ class DeleteDocumentError(SearchModelException):
 class UpdateIndexError(SearchModelException):
     pass
 
+class ExpensiveQueryError(SearchModelException):
+    pass
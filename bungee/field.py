@@ -5,6 +5,9 @@ evaluate to JSON, which can be used to generate JSON query expressions.
 """
 import const
 import exception
+import geo
+from codec import encoder_for, encode_text, mapping_type
+from template import Param
 from util import make_identifier
 
 MATCH = 'match'
@@ -29,6 +32,10 @@ FILTER_LTE = 'lte'
 FILTER_FROM = 'from'
 FILTER_TO = 'to'
 FILTER_FIELD = 'field'
+FILTER_NESTED = 'nested'
+MAPPING_NESTED = 'nested'
+PATH = 'path'
+SCORE_MODE = 'score_mode'
 
 RESERVED_PROPERTIES = set((
     '_is_parent',
@@ -37,7 +44,11 @@ RESERVED_PROPERTIES = set((
     '_search_model',
     '_mapping_name',
     '_parent',
-    '_field_name'))
+    '_field_name',
+    '_field_type',
+    '_encode',
+    '_path',
+    '_children'))
 
 
 def not_(query_expression):
@@ -51,10 +62,21 @@ def range_filter(query_expression):
     return { FILTER_RANGE: query_expression }
 
 
+def and_filter(filters):
+    """
+    Return one filter matching all the given filter expressions.
+    """
+    if len(filters) == 1:
+        return filters[0]
+    return { const.AND: list(filters) }
+
+
 def query_expression(func):
     """
     Ensure that the given operator is applied to a field that has no
     submappings. multi_field mappings are still valid.
+
+    Operands are converted by the operator itself, with the field's encoder.
     """
     def wrap(self, *args, **kwargs):
         if self._is_parent:
@@ -62,9 +84,6 @@ def query_expression(func):
             raise exception.InvalidQueryExpression, "Cannot create query \
 expressions on fields with nested subtypes. Submapped fields include %s" % (
                     str(mapped_subfields))
-        if len(args):
-            # TODO: seems questionable, but makes datetime stuff easier
-            args = map(str, args)
         return func(self, *args, **kwargs)
     return wrap
 
@@ -75,6 +94,8 @@ class SearchField(object):
     for query DSL operators.
     """
 
+    __slots__ = tuple(RESERVED_PROPERTIES)
+
     def __init__(self, field_name, mapping, parent=None, search_model=None):
         self._is_parent = const.PROPERTIES in mapping
         self._is_multi_field = (const.PROPERTY_TYPE in mapping
@@ -84,24 +105,35 @@ class SearchField(object):
         self._mapping = mapping
         self._field_name = make_identifier(field_name)
         self._mapping_name = field_name
+        self._field_type = mapping_type(mapping)
+        self._encode = encoder_for(mapping)
+        if parent is None:
+            self._path = field_name
+        else:
+            self._path = '%s.%s' % (parent._path, field_name)
+        self._children = {}
 
     def __getattr__(self, field):
         """
         Overriding to support multi_field and nested subdocuments mappings.
+        Sub-fields are created on first access and cached on their parent.
         """
         if field in RESERVED_PROPERTIES:
             return getattr(super(SearchField, self), field)
+        children = self._children
+        if field in children:
+            return children[field]
         if self._is_multi_field:
-            if field in self._mapping[const.FIELDS]:
-                return self.__class__(field,
-                        self._mapping[const.FIELDS][field],
-                        self, self._search_model)
+            sub_mappings = self._mapping[const.FIELDS]
         elif self._is_parent:
-            mapping_props = self._mapping[const.PROPERTIES]
-            if field in mapping_props:
-                prop = self.__class__(field, mapping_props[field],
-                    self, self._search_model)
-                return prop
+            sub_mappings = self._mapping[const.PROPERTIES]
+        else:
+            sub_mappings = {}
+        if field in sub_mappings:
+            prop = self.__class__(field, sub_mappings[field], self,
+                    self._search_model)
+            children[field] = prop
+            return prop
         return getattr(super(SearchField, self), field)
 
     @property
@@ -109,13 +141,7 @@ class SearchField(object):
         """
         Return the concatenated names of this field and all its ancestors.
         """
-        prop = self
-        fields = [prop._mapping_name]
-        while prop._parent:
-            fields.append(prop._parent._mapping_name)
-            prop = prop._parent
-        fields.reverse()
-        return '.'.join(fields)
+        return self._path
 
     def __repr__(self):
         return "SearchField[%s]" % self.hierarchy
@@ -134,7 +160,7 @@ class SearchField(object):
         """
         Adds a term query (unanalyzed).
         """
-        return { FILTER_TERM: { self.hierarchy: rhs } }
+        return { FILTER_TERM: { self.hierarchy: self._encode(rhs) } }
 
     @query_expression
     def __ne__(self, rhs):
@@ -145,32 +171,36 @@ class SearchField(object):
 
     @query_expression
     def in_(self, rhs):
-        rhs = map(str, rhs)
+        if isinstance(rhs, Param):
+            rhs = rhs.encoded_by(lambda values: map(self._encode, values))
+        else:
+            rhs = map(self._encode, rhs)
         return { FILTER_TERMS: { self.hierarchy: rhs } }
 
     @query_expression
     def __ge__(self, rhs):
-        q = { self.hierarchy: { FILTER_GTE: rhs } }
+        q = { self.hierarchy: { FILTER_GTE: self._encode(rhs) } }
         return range_filter(q)
 
     @query_expression
     def __gt__(self, rhs):
-        q = { self.hierarchy: { FILTER_GT: rhs } }
+        q = { self.hierarchy: { FILTER_GT: self._encode(rhs) } }
         return range_filter(q)
 
     @query_expression
     def __le__(self, rhs):
-        q = { self.hierarchy: { FILTER_LTE: rhs } }
+        q = { self.hierarchy: { FILTER_LTE: self._encode(rhs) } }
         return range_filter(q)
 
     @query_expression
     def __lt__(self, rhs):
-        q = { self.hierarchy: { FILTER_LT: rhs } }
+        q = { self.hierarchy: { FILTER_LT: self._encode(rhs) } }
         return range_filter(q)
 
     @query_expression
     def range(self, lhs, rhs):
-        q = { self.hierarchy: { FILTER_FROM: lhs, FILTER_TO: rhs}}
+        q = { self.hierarchy: { FILTER_FROM: self._encode(lhs),
+            FILTER_TO: self._encode(rhs) } }
         return range_filter(q)
 
     @query_expression
@@ -192,7 +222,7 @@ class SearchField(object):
             the query_string query. See ES documentation.
         """
         q = { const.FIELDS: [ self.hierarchy ],
-            const.QUERY: rhs,
+            const.QUERY: encode_text(rhs),
             ANALYZE_WILDCARD: wildcard }
         q.update(es_query_string_params)
         return { MATCH_QUERY_STRING: q }
@@ -205,13 +235,94 @@ class SearchField(object):
         :param boost: number that multiplies scoring weight of query
         :param flags: Lucene regexp field flags, joined by "|"
         """
-        q = { VALUE: pattern }
+        q = { VALUE: encode_text(pattern) }
         if boost:
             q[BOOST] = boost
         if flags:
             q[FLAGS] = flags
         return { MATCH_REGEXP:  { self.hierarchy : q } }
 
+    """Nested objects (nested fields)"""
+    def _nested_path(self):
+        if self._mapping.get(const.PROPERTY_TYPE) != MAPPING_NESTED:
+            raise exception.InvalidQueryExpression, "%s is not a nested \
+field" % self.hierarchy
+        return self.hierarchy
+
+    def nested(self, *filters):
+        """
+        Adds a nested filter: documents with at least one object of this
+        nested field matching all the filters, which are expressions on its
+        sub-fields, e.g.:
+            Book.authors.nested(Book.authors.last == 'heller',
+                Book.authors.born < '1930-01-01')
+        Sub-field expressions only match nested objects within this filter.
+        """
+        return { FILTER_NESTED: { PATH: self._nested_path(),
+            const.FILTER: and_filter(filters) } }
+
+    def nested_query(self, *queries, **options):
+        """
+        Adds a nested query: documents with at least one object of this nested
+        field matching all the queries, scored from the matching objects.
+        :param score_mode: "avg" (default), "max", "total" or "none".
+        """
+        score_mode = options.pop(SCORE_MODE, None)
+        if options:
+            raise TypeError, "Unexpected arguments: %s" % ', '.join(options)
+        q = { PATH: self._nested_path(),
+            const.QUERY: { const.BOOL: { const.MUST: list(queries) } } }
+        if score_mode:
+            q[SCORE_MODE] = score_mode
+        return { FILTER_NESTED: q }
+
+    """Geo (geo_point fields)"""
+    def _geo_point_field(self):
+        if self._field_type != geo.GEO_POINT:
+            raise exception.InvalidQueryExpression, "%s is not a geo_point \
+field" % self.hierarchy
+        return self.hierarchy
+
+    @query_expression
+    def within_distance(self, center, distance, unit=const.KILOMETERS):
+        """
+        Adds a geo_distance filter: points within distance of center. Searches
+        prefilter it with a bounding box (see geo.prefilter).
+        :param center: (lat, lon) tuple, {"lat", "lon"} dict or "lat,lon".
+        :param unit: const.KILOMETERS or const.MILES.
+        """
+        return { geo.GEO_DISTANCE: { self._geo_point_field(): geo.point(center),
+            geo.DISTANCE: geo.distance_string(distance, unit) } }
+
+    @query_expression
+    def within_box(self, top_left, bottom_right):
+        """
+        Adds a geo_bounding_box filter. A top_left longitude greater than the
+        bottom_right one selects a box crossing the dateline.
+        """
+        return { geo.GEO_BOUNDING_BOX: { self._geo_point_field(): {
+            geo.TOP_LEFT: geo.point(top_left),
+            geo.BOTTOM_RIGHT: geo.point(bottom_right) } } }
+
+    @query_expression
+    def within_polygon(self, points):
+        """
+        Adds a geo_polygon filter: points inside the polygon of the given
+        vertices.
+        """
+        return { geo.GEO_POLYGON: { self._geo_point_field(): {
+            geo.POINTS: map(geo.point, points) } } }
+
+    @query_expression
+    def by_distance(self, center, order=const.ASC, unit=const.KILOMETERS):
+        """
+        Sort by distance from center; nearest first by default. Use
+        geo.distance to compute the distance of returned documents.
+        """
+        return [{ geo.SORT_GEO_DISTANCE: { self._geo_point_field():
+            geo.point(center), const.ORDER: order,
+            const.UNIT: geo.check_unit(unit) } }]
+
     """Order By"""
     @query_expression
     def desc(self):
@@ -0,0 +1,226 @@
+"""
+This module contains helpers for geo_point fields: point and distance
+encoding, great-circle distances, and the bounding boxes used to prefilter
+geo_distance filters.
+
+Exact distance filters compute a distance per candidate document. Searches
+put a geo_bounding_box filter around each distance filter ahead of it in
+the compiled filter chain (see prefilter), so only documents inside the box
+are measured:
+    q = Store.query().filter(Store.location.within_distance(
+        (40.71, -74.0), 5, const.MILES))
+    q = q.order_by(Store.location.by_distance((40.71, -74.0)))
+"""
+import math
+
+import const
+import exception
+from template import Param
+
+GEO_POINT = 'geo_point'
+GEO_DISTANCE = 'geo_distance'
+GEO_BOUNDING_BOX = 'geo_bounding_box'
+GEO_POLYGON = 'geo_polygon'
+SORT_GEO_DISTANCE = '_geo_distance'
+DISTANCE = 'distance'
+DISTANCE_TYPE = 'distance_type'
+OPTIMIZE_BBOX = 'optimize_bbox'
+TOP_LEFT = 'top_left'
+BOTTOM_RIGHT = 'bottom_right'
+POINTS = 'points'
+LAT = 'lat'
+LON = 'lon'
+
+# Options of geo filters and sorts that aren't field names
+OPTIONS = set((DISTANCE, DISTANCE_TYPE, OPTIMIZE_BBOX, const.UNIT,
+    const.ORDER, 'mode', '_cache', '_cache_key', '_name'))
+
+# Mean earth radius, as used by ES
+EARTH_RADIUS_KM = 6371.0087714
+KILOMETERS_PER_UNIT = {
+    const.KILOMETERS: 1.0,
+    const.MILES: 1.609344,
+}
+
+
+def point(value):
+    """
+    Return a {"lat", "lon"} geo point from a (lat, lon) tuple, a dict with
+    "lat" and "lon", or a "lat,lon" string.
+    """
+    try:
+        if isinstance(value, dict):
+            lat, lon = value[LAT], value[LON]
+        elif isinstance(value, basestring):
+            lat, lon = value.split(',')
+        else:
+            lat, lon = value
+        lat, lon = float(lat), float(lon)
+    except (KeyError, TypeError, ValueError):
+        raise exception.InvalidQueryExpression, "Invalid geo point %r, use \
+a (lat, lon) tuple or a {'lat', 'lon'} dict" % (value,)
+    if not -90 <= lat <= 90 or not -180 <= lon <= 180:
+        raise exception.InvalidQueryExpression, "Geo point %r is out of \
+range" % (value,)
+    return { LAT: lat, LON: lon }
+
+
+def source_points(value):
+    """
+    Return the (lat, lon) tuples of a geo_point source value in any format
+    ES accepts except geohashes: {"lat", "lon"}, [lon, lat], "lat,lon", or
+    a list of those.
+    """
+    if value is None:
+        return []
+    if isinstance(value, dict):
+        return [ (float(value[LAT]), float(value[LON])) ]
+    if isinstance(value, basestring):
+        lat, lon = value.split(',')
+        return [ (float(lat), float(lon)) ]
+    if len(value) == 2 and all(isinstance(item, (int, long, float))
+            for item in value):
+        return [ (float(value[1]), float(value[0])) ]
+    points = []
+    for item in value:
+        points.extend(source_points(item))
+    return points
+
+
+def check_unit(unit):
+    if unit not in KILOMETERS_PER_UNIT:
+        raise exception.InvalidQueryExpression, "Unsupported distance unit \
+%r, use one of %s" % (unit, ', '.join(sorted(KILOMETERS_PER_UNIT)))
+    return unit
+
+
+def distance_string(distance, unit=const.KILOMETERS):
+    """
+    Return an ES distance, e.g. "5km".
+    """
+    return '%s%s' % (distance, check_unit(unit))
+
+
+def parse_distance(distance):
+    """
+    Return the number of kilometers of an ES distance string or number (in
+    kilometers).
+    """
+    if isinstance(distance, (int, long, float)):
+        return float(distance)
+    for unit, kilometers in KILOMETERS_PER_UNIT.iteritems():
+        if distance.endswith(unit):
+            return float(distance[:-len(unit)]) * kilometers
+    return float(distance)
+
+
+def distance(first, second, unit=const.KILOMETERS):
+    """
+    Return the great-circle (haversine) distance between two (lat, lon)
+    points, in unit.
+    """
+    lat1, lon1 = map(math.radians, first)
+    lat2, lon2 = map(math.radians, second)
+    a = (math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2)
+        * math.sin((lon2 - lon1) / 2) ** 2)
+    kilometers = 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+    return kilometers / KILOMETERS_PER_UNIT[check_unit(unit)]
+
+
+def bounding_box(center, kilometers):
+    """
+    Return the (top_left, bottom_right) points of the smallest box holding
+    every point within kilometers of center. Boxes crossing the dateline
+    have a top_left longitude greater than the bottom_right one.
+    """
+    lat, lon = center[LAT], center[LON]
+    angle = math.degrees(kilometers / EARTH_RADIUS_KM)
+    top, bottom = lat + angle, lat - angle
+    if top >= 90 or bottom <= -90:
+        # A pole is in range: every longitude is
+        left, right = -180.0, 180.0
+    else:
+        spread = math.degrees(math.asin(min(1.0,
+            math.sin(math.radians(angle)) / math.cos(math.radians(lat)))))
+        left, right = lon - spread, lon + spread
+        if right - left >= 360:
+            left, right = -180.0, 180.0
+        else:
+            left = left + 360 if left < -180 else left
+            right = right - 360 if right > 180 else right
+    return ({ LAT: min(top, 90.0), LON: left },
+            { LAT: max(bottom, -90.0), LON: right })
+
+
+def in_box(lat_lon, top_left, bottom_right):
+    lat, lon = lat_lon
+    if not bottom_right[LAT] <= lat <= top_left[LAT]:
+        return False
+    if top_left[LON] <= bottom_right[LON]:
+        return top_left[LON] <= lon <= bottom_right[LON]
+    return lon >= top_left[LON] or lon <= bottom_right[LON]
+
+
+def in_polygon(lat_lon, vertices):
+    """
+    Return True if a (lat, lon) point is inside a polygon of (lat, lon)
+    vertices (ray casting, treating coordinates as planar like ES does).
+    """
+    lat, lon = lat_lon
+    inside = False
+    for (lat1, lon1), (lat2, lon2) in zip(vertices,
+            vertices[-1:] + vertices[:-1]):
+        if (lon1 > lon) != (lon2 > lon) and lat < (lat2 - lat1) * (
+                lon - lon1) / (lon2 - lon1) + lat1:
+            inside = not inside
+    return inside
+
+
+def field_body(body):
+    """
+    Return (field path, value) of a geo filter or sort body.
+    """
+    fields = [ (key, value) for key, value in body.iteritems()
+        if key not in OPTIONS ]
+    if len(fields) != 1:
+        return None, None
+    return fields[0]
+
+
+def bounding_prefilter(expression):
+    """
+    Return (bounding box filter, distance filter without ES's own bounding
+    box check) for a geo_distance filter, or None if it has Params.
+    """
+    body = expression[GEO_DISTANCE]
+    path, center = field_body(body)
+    if path is None or isinstance(center, Param) or isinstance(
+            body.get(DISTANCE), Param) or not isinstance(center, dict):
+        return None
+    top_left, bottom_right = bounding_box(center,
+            parse_distance(body[DISTANCE]))
+    exact = dict(body)
+    exact[OPTIMIZE_BBOX] = 'none'
+    return ({ GEO_BOUNDING_BOX: { path: { TOP_LEFT: top_left,
+        BOTTOM_RIGHT: bottom_right } } }, { GEO_DISTANCE: exact })
+
+
+def prefilter(filters, conjunction=const.AND):
+    """
+    Return a filter list joined by conjunction with a bounding box filter
+    ahead of each top-level geo_distance filter: next to it under "and",
+    joined to it by an "and" filter under "or".
+    """
+    prefiltered = []
+    for expression in filters:
+        pair = None
+        if (isinstance(expression, dict) and len(expression) == 1
+                and GEO_DISTANCE in expression):
+            pair = bounding_prefilter(expression)
+        if pair is None:
+            prefiltered.append(expression)
+        elif conjunction == const.AND:
+            prefiltered.extend(pair)
+        else:
+            prefiltered.append({ const.AND: list(pair) })
+    return prefiltered
@@ -0,0 +1,319 @@
+"""
+This module contains hooks for instrumenting the requests SearchModel makes
+through its connection.
+
+Each request produces a RequestEvent, which is passed to every registered
+sink once the request (and any result wrapping) is done:
+    from bungee import instrument
+    histograms = instrument.HistogramSink()
+    instrument.add_sink(histograms)
+    ...
+    print histograms.summary()
+
+With no sinks registered, instrumentation costs one function call per
+request. Byte sizes are measured on the wire, by a response hook on the HTTP
+session of connections (see measure); they are None for the memory backend.
+"""
+import logging
+import threading
+import time
+from collections import deque
+
+import const
+
+SINKS = []
+CONTENT_LENGTH = 'Content-Length'
+
+# The event whose connection call is in progress on each thread
+_current = threading.local()
+
+
+def add_sink(sink):
+    """
+    Register a sink: any object with a handle(event) method.
+    """
+    if sink not in SINKS:
+        SINKS.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    """
+    Unregister a sink.
+    """
+    if sink in SINKS:
+        SINKS.remove(sink)
+
+
+def record_exchange(response, *args, **kwargs):
+    """
+    requests response hook: add the bytes of one HTTP exchange to the event
+    whose request is in progress on this thread.
+    """
+    event = getattr(_current, 'event', None)
+    if event is not None:
+        event.record_exchange(response)
+    return response
+
+
+def measure(connection):
+    """
+    Install record_exchange on a pyelasticsearch connection's HTTP session,
+    and return the connection. Connections without an HTTP session (the
+    memory backend) are returned unchanged.
+    """
+    session = getattr(connection, 'session', None)
+    if session is not None:
+        hooks = session.hooks.setdefault('response', [])
+        if record_exchange not in hooks:
+            hooks.append(record_exchange)
+    return connection
+
+
+class RequestEvent(object):
+    """
+    Timings and payload metrics for one request to ElasticSearch.
+
+    Attributes:
+        operation: API name, e.g. "search", "bulk_index"
+        model: the SearchModel class that made the request
+        index: index name(s) the request was sent to
+        wall_time: seconds from start of request to end of result wrapping
+        request_time: seconds spent in the connection call
+        wrap_time: seconds spent building JsonDocuments / ResultSets
+        took: ES "took" (milliseconds), if the response has one
+        request_bytes: bytes of request bodies sent over HTTP, as sent
+            (i.e. compressed), or None without an HTTP exchange
+        response_bytes: bytes of response bodies received over HTTP: their
+            Content-Length (compressed size, if compressed), or the decoded
+            length of chunked responses; None without an HTTP exchange
+        hits: number of documents returned or sent
+        total: total matching documents, for searches and counts
+        error: the exception raised by the request, if any
+        extra: dict of operation-specific details
+    """
+
+    def __init__(self, operation, model, index=None, body=None, **extra):
+        self.operation = operation
+        self.model = model
+        self.index = index
+        self.body = body
+        self.response = None
+        self.start = time.time()
+        self.wall_time = None
+        self.request_time = None
+        self.wrap_time = 0.0
+        self.took = None
+        self.request_bytes = None
+        self.response_bytes = None
+        self.hits = None
+        self.total = None
+        self.error = None
+        self.extra = extra
+        self._wrap_start = None
+
+    def record_exchange(self, response):
+        """
+        Add the body sizes of one HTTP request / response to the event.
+        """
+        body = response.request.body
+        self.request_bytes = (self.request_bytes or 0) + len(body or '')
+        length = response.headers.get(CONTENT_LENGTH)
+        self.response_bytes = (self.response_bytes or 0) + (int(length)
+                if length is not None else len(response.content))
+
+    def send(self, call, *args, **kwargs):
+        """
+        Make the connection call, recording its timing, response and the
+        bytes of its HTTP exchanges.
+        """
+        start = time.time()
+        outer = getattr(_current, 'event', None)
+        _current.event = self
+        try:
+            response = call(*args, **kwargs)
+        except Exception, e:
+            self.error = e
+            raise
+        finally:
+            _current.event = outer
+            self.request_time = time.time() - start
+        self.response = response
+        if isinstance(response, dict):
+            self.took = response.get('took')
+            hits = response.get(const.HITS)
+            if isinstance(hits, dict):
+                self.total = hits.get(const.TOTAL)
+                self.hits = len(hits.get(const.HITS, ()))
+            elif const.COUNT in response:
+                self.total = response[const.COUNT]
+        return response
+
+    def start_wrap(self):
+        self._wrap_start = time.time()
+
+    def end_wrap(self):
+        self.wrap_time += time.time() - self._wrap_start
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_value is not None and self.error is None:
+            self.error = exc_value
+        self.wall_time = time.time() - self.start
+        for sink in list(SINKS):
+            sink.handle(self)
+        return False
+
+    def __repr__(self):
+        return '<RequestEvent %s %s: %.1fms>' % (self.operation,
+                getattr(self.model, '__name__', self.model),
+                (self.wall_time or 0) * 1000)
+
+
+class NullEvent(object):
+    """
+    Stand-in for RequestEvent when no sinks are registered.
+    """
+    hits = total = None
+
+    def send(self, call, *args, **kwargs):
+        return call(*args, **kwargs)
+
+    def start_wrap(self):
+        pass
+
+    def end_wrap(self):
+        pass
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_EVENT = NullEvent()
+
+
+def request(operation, model, index=None, body=None, **extra):
+    """
+    Return a context manager for one request; the event is emitted to the
+    registered sinks on exit.
+    """
+    if not SINKS:
+        return NULL_EVENT
+    return RequestEvent(operation, model, index, body, **extra)
+
+
+class Sink(object):
+    """
+    Base class for event sinks.
+    """
+
+    def handle(self, event):
+        raise NotImplementedError
+
+
+class LoggingSink(Sink):
+    """
+    Log one line per request.
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        self.logger = logger or logging.getLogger('bungee')
+        self.level = level
+
+    def handle(self, event):
+        self.logger.log(self.level, '%s %s [%s]: wall=%.1fms request=%.1fms \
+wrap=%.1fms took=%s hits=%s total=%s req_bytes=%s resp_bytes=%s%s',
+            event.operation, event.model.__name__, event.index,
+            event.wall_time * 1000, (event.request_time or 0) * 1000,
+            event.wrap_time * 1000, event.took, event.hits, event.total,
+            event.request_bytes, event.response_bytes,
+            ' error=%r' % event.error if event.error else '')
+
+
+class CounterSink(Sink):
+    """
+    Send StatsD-style metrics to a client with timing(name, ms) and
+    incr(name, count) methods, e.g. a statsd.StatsClient.
+    """
+
+    def __init__(self, client, prefix='bungee', measure_bytes=False):
+        self.client = client
+        self.prefix = prefix
+        self.measure_bytes = measure_bytes
+
+    def handle(self, event):
+        name = '%s.%s.%s' % (self.prefix, event.model.__name__,
+                event.operation)
+        self.client.incr(name + '.requests', 1)
+        if event.error is not None:
+            self.client.incr(name + '.errors', 1)
+        self.client.timing(name + '.wall', event.wall_time * 1000)
+        self.client.timing(name + '.wrap', event.wrap_time * 1000)
+        if event.took is not None:
+            self.client.timing(name + '.took', event.took)
+        if event.hits:
+            self.client.incr(name + '.hits', event.hits)
+        if self.measure_bytes and event.request_bytes is not None:
+            self.client.incr(name + '.request_bytes', event.request_bytes)
+            self.client.incr(name + '.response_bytes', event.response_bytes)
+
+
+class HistogramSink(Sink):
+    """
+    Keep per-operation samples in memory, for summary().
+    :param max_samples: number of most recent samples kept per operation.
+    """
+
+    METRICS = ('wall_time', 'request_time', 'wrap_time', 'took')
+
+    def __init__(self, max_samples=10000, measure_bytes=False):
+        self.max_samples = max_samples
+        self.measure_bytes = measure_bytes
+        self.samples = {}
+
+    def handle(self, event):
+        metrics = self.samples.setdefault(event.operation, {})
+        values = dict((metric, getattr(event, metric))
+                for metric in self.METRICS)
+        if self.measure_bytes:
+            values['request_bytes'] = event.request_bytes
+            values['response_bytes'] = event.response_bytes
+        for metric, value in values.iteritems():
+            if value is None:
+                continue
+            if metric not in metrics:
+                metrics[metric] = deque(maxlen=self.max_samples)
+            metrics[metric].append(value)
+
+    def clear(self):
+        self.samples = {}
+
+    def summary(self):
+        """
+        Return {operation: {metric: {count, mean, p50, p95, p99, max}}}.
+        """
+        summary = {}
+        for operation, metrics in self.samples.iteritems():
+            summary[operation] = {}
+            for metric, samples in metrics.iteritems():
+                ordered = sorted(samples)
+                count = len(ordered)
+                percentile = lambda p: ordered[min(count - 1,
+                    int(p * count))]
+                summary[operation][metric] = {
+                    'count': count,
+                    'mean': sum(ordered) / float(count),
+                    'p50': percentile(0.50),
+                    'p95': percentile(0.95),
+                    'p99': percentile(0.99),
+                    'max': ordered[-1],
+                }
+        return summary
@@ -12,6 +12,7 @@ class ResultSet(object):
         self.documents = []
         self.total = None
         self.facets = {}
+        self.aggregations = {}
 
 
 class JsonDocument(object):
@@ -0,0 +1,2098 @@
+"""
+This module contains an in-process stand-in for the pyelasticsearch
+ElasticSearch client, which stores documents and mappings in memory and
+evaluates the query DSL bungee generates.
+
+Models use it when their URL starts with "memory://":
+    class Book(SearchModel):
+        index_name = 'books'
+        url = 'memory://'
+
+Models sharing a URL share one MemoryElasticSearch instance (and its data),
+through the regular connection pool. This gives hermetic tests and a
+low-latency local mode for small reference datasets.
+
+The backend models ES 1.7, the last release accepting both the ES 0.90 DSL
+bungee generates (filtered queries, and / or / not / missing filters, term
+facets) and the aggregations, search templates and terminate_after counts
+it uses. Another version is selected by URL, e.g. "memory://?version=6.1";
+requests using DSL that version doesn't have fail with a 400 error, as
+they would on ES (see VERSIONED_FEATURES):
+    Book.url = 'memory://?version=6.1'  # composite aggregations, bool
+                                        # filter clauses, no facets
+
+Supported DSL:
+    queries: match_all, bool (must / should / must_not / filter), filtered,
+        query_string, wildcard, regexp, term, terms, range, ids
+    filters: term, terms, range, exists, missing, not, and, or, bool, query,
+        match_all, ids, type, geo_distance, geo_bounding_box, geo_polygon,
+        nested, has_child, has_parent
+    search: from, size, sort (including _geo_distance), term facets (with
+        facet_filter), aggregations, scroll (with its keep alive time, at
+        most MAX_OPEN_SCROLLS at once, and clear scroll), routing
+    count: terminate_after, routing
+    explain: one detail per top-level query / filter clause (not Lucene's
+        explanation; use a real cluster to check scoring)
+
+Each field has an inverted index (term -> document ids) and a lazily
+sorted term list for range filters. Strings are analyzed like the standard
+analyzer (lowercased alphanumeric tokens) unless mapped "not_analyzed".
+Changes are searchable immediately; refresh is a no-op. Nested objects are
+also indexed in their root document, as with "include_in_parent".
+Documents written with a routing value (or a parent id) are only found by
+get, multi get, update and delete with that value, and by searches and
+counts routed to it (or not routed at all), as on an index with many
+shards. Documents written without routing are found by every request.
+"""
+import bisect
+import copy
+import datetime
+import fnmatch
+import itertools
+import json
+import re
+import threading
+import time
+import uuid
+
+import aggregation
+import const
+import geo
+from codec import NUMBER_TYPES, mapping_type, parse_date, strftime_formats
+
+from pyelasticsearch import ElasticHttpError, ElasticHttpNotFoundError
+from pyelasticsearch.exceptions import IndexAlreadyExistsError
+
+MEMORY_URL = 'memory://'
+
+# Metadata fields: never part of the mapped source, always indexed.
+META_FIELDS = set(('_id', '_type', '_uid', '_index', '_routing', '_parent',
+    '_ttl', '_timestamp', '_source', '_all', '_version'))
+ALL_FIELD = '_all'
+PARENT_FIELD = '_parent'
+NESTED_TYPE = '_nested'
+
+DEFAULT_SEARCH_SIZE = 10
+DEFAULT_FACET_SIZE = 10
+SCROLL = 'scroll'
+SCROLL_ID = '_scroll_id'
+# ES search.max_open_scroll_context default
+MAX_OPEN_SCROLLS = 500
+KEEP_ALIVE_RE = re.compile(r'^(\d+)(ms|s|m|h|d)$')
+KEEP_ALIVE_SECONDS = { 'ms': 0.001, 's': 1, 'm': 60, 'h': 3600, 'd': 86400 }
+
+# ES version modelled unless the URL selects another ("?version=6.1")
+DEFAULT_VERSION = (1, 7)
+VERSION_RE = re.compile(r'[?&]version=(\d+)\.(\d+)')
+
+# Request features by (the ES version adding them, the version removing
+# them or None, the exception ES reports where they aren't supported)
+VERSIONED_FEATURES = {
+    'facets': ((0, 90), (2, 0), 'SearchParseException'),
+    'aggregations': ((1, 0), None, 'SearchParseException'),
+    'search templates': ((1, 1), None, 'ElasticsearchIllegalArgumentException'),
+    'terminate_after': ((1, 4), None, 'ElasticsearchIllegalArgumentException'),
+    'bool filter clauses': ((2, 0), None, 'QueryParsingException'),
+    'composite aggregations': ((6, 1), None, 'SearchParseException'),
+    'ES 0.90 queries and filters': ((0, 90), (5, 0), 'ParsingException'),
+}
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# ES dynamic date detection ("dateOptionalTime")
+DATE_DETECTION_RE = re.compile(r'^\d{4}-\d{2}-\d{2}(T[\d:.]+)?$')
+STRING_MAPPING = { const.PROPERTY_TYPE: 'string', const.INDEX: 'not_analyzed' }
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def url_version(urls):
+    """
+    Return the ES version (major, minor) a memory URL (or list of URLs)
+    selects, or DEFAULT_VERSION.
+    """
+    if isinstance(urls, basestring):
+        urls = [ urls ]
+    for url in urls or ():
+        match = VERSION_RE.search(url)
+        if match is not None:
+            return int(match.group(1)), int(match.group(2))
+    return DEFAULT_VERSION
+
+
+def is_memory_url(urls):
+    """
+    Return True if the given URL (or list of URLs) selects the memory backend.
+    """
+    if isinstance(urls, basestring):
+        urls = [ urls ]
+    return bool(urls) and all(url.startswith(MEMORY_URL) for url in urls)
+
+
+def names(value):
+    """
+    Return a list of index / type names from None, a string (possibly comma
+    separated) or a list. None and "_all" mean all names.
+    """
+    if value is None:
+        return None
+    if isinstance(value, basestring):
+        value = value.split(',')
+    value = [ name for name in value if name and name != '_all' ]
+    return value or None
+
+
+def es_params(kwargs, query_params=None):
+    """
+    Return pyelasticsearch-style request parameters: query_params plus
+    keyword arguments (es_-prefixed or not).
+    """
+    params = dict(query_params or {})
+    for key, value in kwargs.iteritems():
+        if key.startswith('es_'):
+            key = key[3:]
+        params[key] = value
+    return params
+
+
+def bad_request(message):
+    return ElasticHttpError(400, message)
+
+
+# Query DSL clauses removed in ES 5
+LEGACY_CLAUSES = set((const.FILTERED, const.AND, const.OR, 'not', 'missing'))
+
+
+def legacy_clauses(expression):
+    """
+    Return the names of ES 0.90-only clauses (and filter cache options) used
+    in a query expression.
+    """
+    found = []
+    if isinstance(expression, dict):
+        for key, body in expression.iteritems():
+            if key in LEGACY_CLAUSES or key in ('_cache', '_cache_key'):
+                found.append(key)
+            found.extend(legacy_clauses(body))
+    elif isinstance(expression, list):
+        for item in expression:
+            found.extend(legacy_clauses(item))
+    return found
+
+
+def has_bool_filter(expression):
+    """
+    Return True if a query expression has a bool query or filter with a
+    "filter" clause.
+    """
+    if isinstance(expression, dict):
+        return any((key == const.BOOL and isinstance(body, dict)
+            and const.FILTER in body) or has_bool_filter(body)
+            for key, body in expression.iteritems())
+    if isinstance(expression, list):
+        return any(has_bool_filter(item) for item in expression)
+    return False
+
+
+def aggregation_types(aggs):
+    """
+    Return the set of aggregation types of an "aggs" body and its
+    sub-aggregations.
+    """
+    types = set()
+    for body in aggs.itervalues():
+        for key, spec in body.iteritems():
+            if key in (aggregation.AGGS, aggregation.AGGREGATIONS):
+                types.update(aggregation_types(spec))
+            else:
+                types.add(key)
+    return types
+
+
+def routing_values(params):
+    """
+    Return the set of routing values of search parameters, or None.
+    """
+    routing = params.get('routing')
+    if routing is None:
+        return None
+    if not isinstance(routing, (list, tuple, set)):
+        routing = unicode(routing).split(',')
+    return set(unicode(value) for value in routing)
+
+
+def keep_alive_seconds(value):
+    """
+    Return the seconds of a scroll keep alive time such as "5m".
+    """
+    match = KEEP_ALIVE_RE.match(unicode(value).strip())
+    if match is None:
+        raise bad_request('ElasticsearchParseException[Failed to parse \
+setting [scroll] with value [%s]]' % value)
+    return int(match.group(1)) * KEEP_ALIVE_SECONDS[match.group(2)]
+
+
+def optional_unicode(value):
+    return unicode(value) if value is not None else None
+
+
+def routed(document, params):
+    """
+    Return the document if a request with the given parameters reaches its
+    shard, else None. Documents written with a routing value (or a parent
+    id) are only found with that value, as on an index with many shards.
+    """
+    if document is None:
+        return None
+    expected = document.shard_routing()
+    if expected is None:
+        return document
+    routing = params.get('routing')
+    if routing is None:
+        routing = params.get('parent')
+    if routing is not None and unicode(routing) == expected:
+        return document
+    return None
+
+
+def analyze(text):
+    """
+    Standard-analyzer-like tokenization: lowercased alphanumeric runs.
+    """
+    return TOKEN_RE.findall(text.lower())
+
+
+def to_millis(value):
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000 + \
+            delta.microseconds // 1000
+
+
+def infer_mapping(value):
+    """
+    Return a dynamic mapping for a source value, like ES does for unmapped
+    fields, or None for null / empty values.
+    """
+    if isinstance(value, list):
+        for item in value:
+            mapping = infer_mapping(item)
+            if mapping is not None:
+                return mapping
+        return None
+    if isinstance(value, dict):
+        return { const.PROPERTIES: {} }
+    if isinstance(value, bool):
+        return { const.PROPERTY_TYPE: 'boolean' }
+    if isinstance(value, (int, long)):
+        return { const.PROPERTY_TYPE: 'long' }
+    if isinstance(value, float):
+        return { const.PROPERTY_TYPE: 'double' }
+    if isinstance(value, basestring):
+        if DATE_DETECTION_RE.match(value):
+            return { const.PROPERTY_TYPE: 'date',
+                const.MAPPING_FORMAT: 'dateOptionalTime' }
+        return { const.PROPERTY_TYPE: 'string' }
+    return None
+
+
+def merge_properties(properties, new_properties):
+    """
+    Merge mapping properties into existing ones, in place.
+    """
+    for name, mapping in new_properties.iteritems():
+        existing = properties.get(name)
+        if (existing is not None and const.PROPERTIES in existing
+                and const.PROPERTIES in mapping):
+            merge_properties(existing[const.PROPERTIES],
+                    mapping[const.PROPERTIES])
+        else:
+            properties[name] = copy.deepcopy(mapping)
+
+
+def add_dynamic_mappings(properties, source):
+    """
+    Add mappings for unmapped fields of a source, in place. Returns True if
+    the mapping changed.
+    """
+    changed = False
+    for name, value in source.iteritems():
+        if name in META_FIELDS:
+            continue
+        mapping = properties.get(name)
+        if mapping is None:
+            mapping = infer_mapping(value)
+            if mapping is None:
+                continue
+            properties[name] = mapping
+            changed = True
+        if const.PROPERTIES in mapping:
+            items = value if isinstance(value, list) else [ value ]
+            for item in items:
+                if isinstance(item, dict):
+                    changed = add_dynamic_mappings(mapping[const.PROPERTIES],
+                            item) or changed
+    return changed
+
+
+def leaf_mappings(properties, prefix=''):
+    """
+    Return {source path: [(indexed path, mapping)]} for the leaf fields of
+    mapping properties. multi_field sub-fields are indexed as "path.name",
+    except the default one (named like the field), indexed as "path".
+    """
+    leaves = {}
+    for name, mapping in properties.iteritems():
+        path = prefix + name
+        if const.PROPERTIES in mapping:
+            leaves.update(leaf_mappings(mapping[const.PROPERTIES], path + '.'))
+        elif mapping.get(const.PROPERTY_TYPE) == const.MAPPING_MULTI_FIELD:
+            leaves[path] = [ (path if sub_name == name
+                else '%s.%s' % (path, sub_name), sub_mapping)
+                for sub_name, sub_mapping
+                in mapping.get(const.FIELDS, {}).iteritems() ]
+        else:
+            leaves[path] = [ (path, mapping) ]
+    return leaves
+
+
+def merge_source(source, partial):
+    """
+    Merge a partial document into a document source, recursively for
+    objects, as the update API does. Returns source.
+    """
+    for key, value in partial.iteritems():
+        if isinstance(value, dict) and isinstance(source.get(key), dict):
+            merge_source(source[key], value)
+        else:
+            source[key] = value
+    return source
+
+
+def source_values(source, prefix='', values=None):
+    """
+    Return {dotted path: [values]} for the leaf values of a document source,
+    flattening objects and arrays.
+    """
+    if values is None:
+        values = {}
+    for name, value in source.iteritems():
+        if not prefix and name in META_FIELDS:
+            continue
+        path = prefix + name
+        items = value if isinstance(value, list) else [ value ]
+        for item in items:
+            if isinstance(item, dict):
+                source_values(item, path + '.', values)
+            elif item is not None:
+                values.setdefault(path, []).append(item)
+    return values
+
+
+def path_values(source, path):
+    """
+    Return the raw values at a dotted path of a document source, through
+    objects and arrays of objects.
+    """
+    values = [ source ]
+    for name in path.split('.'):
+        found = []
+        for value in values:
+            for item in (value if isinstance(value, list) else [ value ]):
+                if isinstance(item, dict) and item.get(name) is not None:
+                    found.append(item[name])
+        values = found
+    return values
+
+
+def is_analyzed(mapping):
+    return (mapping_type(mapping) in (None, 'string')
+            and mapping.get(const.INDEX) not in ('not_analyzed', 'no'))
+
+
+def to_term(mapping, value):
+    """
+    Convert a value to the indexed term for a (leaf) field mapping: numbers,
+    dates (as epoch milliseconds), booleans or unicode strings. Raises
+    ValueError for values that don't fit the mapping.
+    """
+    field_type = mapping_type(mapping)
+    if field_type in NUMBER_TYPES:
+        if isinstance(value, bool):
+            return int(value)
+        if NUMBER_TYPES[field_type] is float:
+            return float(value)
+        try:
+            return int(value)
+        except ValueError:
+            return int(float(value))
+    if field_type == 'date':
+        if isinstance(value, (int, long, float)):
+            return int(value)
+        if isinstance(value, datetime.datetime):
+            return to_millis(value)
+        if isinstance(value, datetime.date):
+            return to_millis(datetime.datetime.combine(value, datetime.time()))
+        parsed = parse_date(value, strftime_formats(mapping))
+        if not isinstance(parsed, datetime.datetime):
+            raise ValueError, "failed to parse date field [%s]" % value
+        return to_millis(parsed)
+    if field_type == 'boolean':
+        if isinstance(value, basestring):
+            return value.lower() not in ('false', 'f', '0', 'off', 'no', '')
+        return bool(value)
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return unicode(value)
+
+
+def index_terms(mapping, value):
+    """
+    Return the list of terms indexed for one source value.
+    """
+    term = to_term(mapping, value)
+    if isinstance(term, unicode) and is_analyzed(mapping):
+        return analyze(term)
+    return [ term ]
+
+
+def document_terms(leaves, source, doc_type=None, doc_id=None):
+    """
+    Return ({indexed path: [terms]}, {indexed path: [sortable values]}) for a
+    document source, given the leaf_mappings of its type. Unmapped fields are
+    mapped dynamically. Metadata fields and _all are included.
+    """
+    terms = {}
+    values = {}
+    all_terms = []
+    for path, field_values in source_values(source).iteritems():
+        pairs = leaves.get(path)
+        if pairs is None:
+            pairs = [ (path, infer_mapping(field_values) or {}) ]
+        for indexed_path, mapping in pairs:
+            if mapping.get(const.INDEX) == 'no':
+                continue
+            field_terms = terms.setdefault(indexed_path, [])
+            sort_values = values.setdefault(indexed_path, [])
+            for value in field_values:
+                try:
+                    field_terms.extend(index_terms(mapping, value))
+                    sort_values.append(to_term(mapping, value))
+                except (TypeError, ValueError), e:
+                    raise bad_request('MapperParsingException[failed to \
+parse [%s]]; nested: %s' % (path, e))
+            if is_analyzed(mapping):
+                all_terms.extend(field_terms)
+    terms[ALL_FIELD] = all_terms
+    if doc_id is not None:
+        uid = u'%s#%s' % (doc_type, doc_id)
+        for path, value in ((const.ID, doc_id), (const.TYPE, doc_type),
+                (const.UID, uid)):
+            terms[path] = values[path] = [ value ]
+    return terms, values
+
+
+class FieldIndex(object):
+    """
+    Inverted index of one field: term -> set of document keys, with a sorted
+    term list (rebuilt lazily after new terms are added) for ranges.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.docs = set()
+        self._sorted = None
+
+    def add(self, term, key):
+        postings = self.postings.get(term)
+        if postings is None:
+            postings = self.postings[term] = set()
+            self._sorted = None
+        postings.add(key)
+        self.docs.add(key)
+
+    def remove(self, term, key):
+        postings = self.postings.get(term)
+        if postings is not None:
+            postings.discard(key)
+            if not postings:
+                del self.postings[term]
+                self._sorted = None
+
+    def sorted_terms(self):
+        if self._sorted is None:
+            self._sorted = sorted(self.postings)
+        return self._sorted
+
+    def lookup(self, term):
+        return self.postings.get(term, set())
+
+    def range(self, low=None, high=None, include_low=True, include_high=True):
+        terms = self.sorted_terms()
+        start = 0
+        end = len(terms)
+        if low is not None:
+            start = (bisect.bisect_left if include_low
+                    else bisect.bisect_right)(terms, low)
+        if high is not None:
+            end = (bisect.bisect_right if include_high
+                    else bisect.bisect_left)(terms, high)
+        keys = set()
+        for term in terms[start:end]:
+            keys.update(self.postings[term])
+        return keys
+
+    def matching(self, predicate):
+        """
+        Return the keys of documents with a term matching predicate(term).
+        """
+        keys = set()
+        for term, postings in self.postings.iteritems():
+            if predicate(term):
+                keys.update(postings)
+        return keys
+
+
+class StoredDocument(object):
+
+    __slots__ = ('key', 'source', 'version', 'seq', 'parent', 'routing',
+            'terms', 'values')
+
+    def __init__(self, key, source, version, seq, parent=None, routing=None):
+        self.key = key
+        self.source = source
+        self.version = version
+        self.seq = seq
+        self.parent = parent
+        self.routing = routing
+        # indexed path -> list of terms / sortable values
+        self.terms = {}
+        self.values = {}
+
+    def shard_routing(self):
+        """
+        Return the value the document is routed by: its routing value, its
+        parent id for children, or None.
+        """
+        return self.routing if self.routing is not None else self.parent
+
+
+class MemoryIndex(object):
+    """
+    Documents, mappings and field indexes of one index. Document keys are
+    (doc_type, id) tuples.
+    """
+
+    def __init__(self, name, settings=None):
+        self.name = name
+        self.settings = copy.deepcopy(settings or {})
+        self.mappings = {}
+        self.documents = {}
+        self.fields = {}
+        self._leaves = {}
+        self._seq = itertools.count()
+        for doc_type, mapping in self.settings.pop('mappings', {}).items():
+            self.put_mapping(doc_type, mapping)
+
+    def properties(self, doc_type):
+        mapping = self.mappings.setdefault(doc_type, { const.PROPERTIES: {} })
+        return mapping.setdefault(const.PROPERTIES, {})
+
+    def put_mapping(self, doc_type, mapping):
+        if doc_type in mapping and len(mapping) == 1:
+            mapping = mapping[doc_type]
+        merge_properties(self.properties(doc_type),
+                mapping.get(const.PROPERTIES, {}))
+        if PARENT_FIELD in mapping:
+            self.mappings[doc_type][PARENT_FIELD] = dict(mapping[PARENT_FIELD])
+        self._leaves.pop(doc_type, None)
+        # Reindex existing documents of the type with the new mapping
+        for key, document in self.documents.items():
+            if key[0] == doc_type:
+                self.add(key, document.source, document.version)
+
+    def parent_type(self, doc_type):
+        """
+        Return the parent document type of a child type, or None.
+        """
+        return self.mappings.get(doc_type, {}).get(PARENT_FIELD, {}).get(
+                const.PROPERTY_TYPE)
+
+    def leaves(self, doc_type):
+        if doc_type not in self._leaves:
+            self._leaves[doc_type] = leaf_mappings(self.properties(doc_type))
+        return self._leaves[doc_type]
+
+    def field(self, path):
+        if path not in self.fields:
+            self.fields[path] = FieldIndex()
+        return self.fields[path]
+
+    def field_mapping(self, path, doc_types=None):
+        """
+        Return the leaf mapping of an indexed field path in the given types.
+        """
+        if path in META_FIELDS:
+            return STRING_MAPPING
+        for doc_type in doc_types or self.mappings.keys():
+            if doc_type not in self.mappings:
+                continue
+            leaves = self.leaves(doc_type)
+            if path in leaves:
+                for indexed_path, mapping in leaves[path]:
+                    if indexed_path == path:
+                        return mapping
+            # multi_field sub-field, e.g. "title.untouched"
+            parent, _, _ = path.rpartition('.')
+            for indexed_path, mapping in leaves.get(parent, ()):
+                if indexed_path == path:
+                    return mapping
+        return None
+
+    def get(self, doc_type, doc_id):
+        return self.documents.get((doc_type, doc_id))
+
+    def add(self, key, source, version=None, parent=None, routing=None):
+        """
+        Index a document source under key = (doc_type, id), replacing any
+        previous version (and keeping its parent id and routing value unless
+        given). Returns the stored document.
+        """
+        doc_type, doc_id = key
+        previous = self.documents.get(key)
+        if previous is not None:
+            self.remove(key)
+            if version is None:
+                version = previous.version + 1
+            if parent is None:
+                parent = previous.parent
+            if routing is None:
+                routing = previous.routing
+        if add_dynamic_mappings(self.properties(doc_type), source):
+            self._leaves.pop(doc_type, None)
+
+        document = StoredDocument(key, source, version or 1, next(self._seq),
+                parent, routing)
+        terms, document.values = document_terms(self.leaves(doc_type),
+                source, doc_type, doc_id)
+        if parent is not None:
+            terms[PARENT_FIELD] = document.values[PARENT_FIELD] = [ parent ]
+        document.terms = terms
+        for path, field_terms in terms.iteritems():
+            field = self.field(path)
+            for term in field_terms:
+                field.add(term, key)
+        self.documents[key] = document
+        return document
+
+    def remove(self, key):
+        document = self.documents.pop(key, None)
+        if document is None:
+            return None
+        for path, field_terms in document.terms.iteritems():
+            field = self.fields[path]
+            for term in field_terms:
+                field.remove(term, key)
+            field.docs.discard(key)
+        return document
+
+    def keys(self, doc_types=None):
+        if doc_types is None:
+            return set(self.documents)
+        types = set(doc_types)
+        return set(key for key in self.documents if key[0] in types)
+
+
+class Searcher(object):
+    """
+    Evaluates one search body against one index and set of document types.
+    Filters evaluate to sets of document keys; queries to {key: score}.
+    """
+
+    def __init__(self, index, doc_types=None):
+        self.index = index
+        self.doc_types = doc_types
+        self.universe = index.keys(doc_types)
+
+    def field(self, path):
+        return self.index.fields.get(path) or FieldIndex()
+
+    def term(self, path, value):
+        """
+        Convert a query operand to the field's term type (not analyzed).
+        """
+        mapping = self.index.field_mapping(path, self.doc_types)
+        try:
+            return to_term(mapping or {}, value)
+        except (TypeError, ValueError), e:
+            raise bad_request('SearchParseException[failed to parse \
+[%s] for field [%s]]: %s' % (value, path, e))
+
+    def keys(self, filter_):
+        """
+        Return the set of document keys matching a filter.
+        """
+        if not isinstance(filter_, dict) or len(filter_) != 1:
+            raise bad_request('SearchParseException[failed to parse \
+filter %r]' % (filter_,))
+        name, body = filter_.items()[0]
+        method = getattr(self, 'filter_' + name, None)
+        if method is None:
+            scorer = getattr(self, 'query_' + name, None)
+            if scorer is None:
+                raise bad_request('QueryParsingException[No filter \
+registered for [%s]]' % name)
+            return set(scorer(body))
+        return method(body) & self.universe
+
+    def scores(self, query):
+        """
+        Return {document key: score} for the documents matching a query.
+        """
+        if not isinstance(query, dict) or len(query) != 1:
+            raise bad_request('SearchParseException[failed to parse \
+query %r]' % (query,))
+        name, body = query.items()[0]
+        method = getattr(self, 'query_' + name, None)
+        if method is None:
+            if not hasattr(self, 'filter_' + name):
+                raise bad_request('QueryParsingException[No query \
+registered for [%s]]' % name)
+            return dict.fromkeys(self.keys(query), 1.0)
+        return method(body)
+
+    @staticmethod
+    def clauses(body):
+        if body is None:
+            return []
+        if isinstance(body, dict):
+            return [ body ]
+        return body
+
+    @staticmethod
+    def field_body(body):
+        """
+        Return (field path, clause) from a single-field clause, ignoring
+        options such as "_cache".
+        """
+        fields = [ (key, value) for key, value in body.iteritems()
+            if not key.startswith('_') or key in META_FIELDS ]
+        if len(fields) != 1:
+            raise bad_request('QueryParsingException[expected one field in \
+%r]' % (body,))
+        return fields[0]
+
+    """Filters"""
+    def filter_match_all(self, body):
+        return set(self.universe)
+
+    def filter_term(self, body):
+        path, value = self.field_body(body)
+        if isinstance(value, dict):
+            value = value.get(const.TERM, value.get('value'))
+        return set(self.field(path).lookup(self.term(path, value)))
+
+    def filter_terms(self, body):
+        body = dict((key, value) for key, value in body.iteritems()
+                if key not in ('execution', 'minimum_match',
+                    'minimum_should_match'))
+        path, values = self.field_body(body)
+        field = self.field(path)
+        keys = set()
+        for value in values:
+            keys.update(field.lookup(self.term(path, value)))
+        return keys
+
+    def filter_range(self, body):
+        path, bounds = self.field_body(body)
+        low = high = None
+        include_low = include_high = True
+        for key, value in bounds.iteritems():
+            if value is None or key in ('include_lower', 'include_upper',
+                    'boost', 'time_zone'):
+                continue
+            if key in ('gt', 'gte', 'from'):
+                low = self.term(path, value)
+                include_low = key != 'gt' and bounds.get('include_lower', True)
+            elif key in ('lt', 'lte', 'to'):
+                high = self.term(path, value)
+                include_high = key != 'lt' and bounds.get('include_upper',
+                        True)
+            else:
+                raise bad_request('QueryParsingException[[range] filter does \
+not support [%s]]' % key)
+        return self.field(path).range(low, high, include_low, include_high)
+
+    def filter_exists(self, body):
+        return set(self.field(body[const.FIELD]).docs)
+
+    def filter_missing(self, body):
+        return self.universe - self.field(body[const.FIELD]).docs
+
+    def filter_not(self, body):
+        if const.FILTER in body and len(body) <= 2:
+            body = body[const.FILTER]
+        return self.universe - self.keys(body)
+
+    def filter_and(self, body):
+        if isinstance(body, dict):
+            body = body[const.FILTERS]
+        keys = set(self.universe)
+        for filter_ in body:
+            keys &= self.keys(filter_)
+            if not keys:
+                break
+        return keys
+
+    def filter_or(self, body):
+        if isinstance(body, dict):
+            body = body[const.FILTERS]
+        keys = set()
+        for filter_ in body:
+            keys |= self.keys(filter_)
+        return keys
+
+    def filter_bool(self, body):
+        keys = set(self.universe)
+        for filter_ in (self.clauses(body.get(const.MUST))
+                + self.clauses(body.get(const.FILTER))):
+            keys &= self.keys(filter_)
+        should = self.clauses(body.get(const.SHOULD))
+        if should:
+            matched = set()
+            for filter_ in should:
+                matched |= self.keys(filter_)
+            keys &= matched
+        for filter_ in self.clauses(body.get(const.MUST_NOT)):
+            keys -= self.keys(filter_)
+        return keys
+
+    def filter_query(self, body):
+        return set(self.scores(body))
+
+    def filter_ids(self, body):
+        doc_types = names(body.get('type'))
+        ids = self.field(const.ID)
+        keys = set()
+        for doc_id in body.get('values', ()):
+            keys |= ids.lookup(unicode(doc_id))
+        return set(key for key in keys & self.universe
+            if doc_types is None or key[0] in doc_types)
+
+    def filter_type(self, body):
+        return set(key for key in self.universe if key[0] == body['value'])
+
+    def geo_keys(self, path, predicate):
+        """
+        Return the keys of documents with a geo point at path for which
+        predicate((lat, lon)) is True.
+        """
+        documents = self.index.documents
+        keys = set()
+        for key in self.universe:
+            for value in path_values(documents[key].source, path):
+                if any(predicate(point) for point in geo.source_points(value)):
+                    keys.add(key)
+                    break
+        return keys
+
+    def filter_geo_distance(self, body):
+        path, center = geo.field_body(body)
+        center = geo.source_points(center)[0]
+        kilometers = geo.parse_distance(body[geo.DISTANCE])
+        return self.geo_keys(path,
+            lambda point: geo.distance(center, point) <= kilometers)
+
+    def filter_geo_bounding_box(self, body):
+        path, box = geo.field_body(body)
+        top_left = geo.point(geo.source_points(box[geo.TOP_LEFT])[0])
+        bottom_right = geo.point(geo.source_points(box[geo.BOTTOM_RIGHT])[0])
+        return self.geo_keys(path,
+            lambda point: geo.in_box(point, top_left, bottom_right))
+
+    def filter_geo_polygon(self, body):
+        path, polygon = geo.field_body(body)
+        vertices = [ geo.source_points(vertex)[0]
+            for vertex in polygon[geo.POINTS] ]
+        return self.geo_keys(path,
+            lambda point: geo.in_polygon(point, vertices))
+
+    def related_keys(self, doc_type, body):
+        """
+        Return the keys of documents of doc_type matching the query or filter
+        of a has_child / has_parent body.
+        """
+        searcher = Searcher(self.index, [ doc_type ])
+        if const.QUERY in body:
+            return set(searcher.scores(body[const.QUERY]))
+        return searcher.keys(body[const.FILTER])
+
+    def filter_has_child(self, body):
+        child_type = body[const.PROPERTY_TYPE]
+        documents = self.index.documents
+        parent_ids = set(documents[key].parent
+            for key in self.related_keys(child_type, body))
+        parent_type = self.index.parent_type(child_type)
+        return set(key for key in self.universe
+            if key[0] == parent_type and key[1] in parent_ids)
+
+    def filter_has_parent(self, body):
+        parent_type = body.get('parent_type', body.get(const.PROPERTY_TYPE))
+        parent_ids = set(key[1]
+            for key in self.related_keys(parent_type, body))
+        documents = self.index.documents
+        return set(key for key in self.universe
+            if self.index.parent_type(key[0]) == parent_type
+            and documents[key].parent in parent_ids)
+
+    """Queries"""
+    def query_match_all(self, body):
+        return dict.fromkeys(self.universe, 1.0)
+
+    def query_bool(self, body):
+        must = self.clauses(body.get(const.MUST))
+        should = self.clauses(body.get(const.SHOULD))
+        must_not = self.clauses(body.get(const.MUST_NOT))
+        scores = None
+        for query in must:
+            clause = self.scores(query)
+            if scores is None:
+                scores = clause
+            else:
+                scores = dict((key, score + clause[key])
+                    for key, score in scores.iteritems() if key in clause)
+        if should:
+            minimum = body.get('minimum_should_match',
+                    body.get('minimum_number_should_match', 0 if must else 1))
+            matches = {}
+            should_scores = {}
+            for query in should:
+                for key, score in self.scores(query).iteritems():
+                    matches[key] = matches.get(key, 0) + 1
+                    should_scores[key] = should_scores.get(key, 0) + score
+            if scores is None:
+                scores = dict((key, should_scores[key]) for key, count
+                    in matches.iteritems() if count >= max(1, minimum))
+            else:
+                scores = dict((key, score + should_scores.get(key, 0))
+                    for key, score in scores.iteritems()
+                    if matches.get(key, 0) >= minimum)
+        if scores is None:
+            scores = dict.fromkeys(self.universe, 1.0)
+        for filter_ in self.clauses(body.get(const.FILTER)):
+            keys = self.keys(filter_)
+            scores = dict((key, score) for key, score in scores.iteritems()
+                if key in keys)
+        for query in must_not:
+            for key in self.scores(query):
+                scores.pop(key, None)
+        return scores
+
+    def query_filtered(self, body):
+        if const.QUERY in body:
+            scores = self.scores(body[const.QUERY])
+        else:
+            scores = dict.fromkeys(self.universe, 1.0)
+        if const.FILTER in body:
+            keys = self.keys(body[const.FILTER])
+            scores = dict((key, score) for key, score in scores.iteritems()
+                if key in keys)
+        return scores
+
+    def query_constant_score(self, body):
+        if const.FILTER in body:
+            keys = self.keys(body[const.FILTER])
+        else:
+            keys = self.scores(body[const.QUERY])
+        return dict.fromkeys(keys, body.get('boost', 1.0))
+
+    def query_nested(self, body):
+        """
+        Evaluate the query or filter of a nested body against each object at
+        its path, indexed on its own with its document's mapping; documents
+        are scored from their matching objects by score_mode.
+        """
+        path = body['path']
+        objects = MemoryIndex(NESTED_TYPE)
+        documents = self.index.documents
+        for key in self.universe:
+            if key[0] not in objects.mappings:
+                objects.put_mapping(key[0], { const.PROPERTIES:
+                    self.index.properties(key[0]) })
+            items = []
+            for value in path_values(documents[key].source, path):
+                items.extend(value if isinstance(value, list) else [ value ])
+            for number, item in enumerate(items):
+                for name in reversed(path.split('.')):
+                    item = { name: item }
+                objects.add((key[0], (key, number)), item)
+        searcher = Searcher(objects)
+        if const.QUERY in body:
+            object_scores = searcher.scores(body[const.QUERY])
+        else:
+            object_scores = dict.fromkeys(searcher.keys(body[const.FILTER]),
+                    1.0)
+        matches = {}
+        for object_key, score in object_scores.iteritems():
+            matches.setdefault(object_key[1][0], []).append(score)
+        score_mode = body.get('score_mode', 'avg')
+        scores = {}
+        for key, object_scores in matches.iteritems():
+            if score_mode == 'max':
+                scores[key] = max(object_scores)
+            elif score_mode in ('total', 'sum'):
+                scores[key] = sum(object_scores)
+            elif score_mode == 'none':
+                scores[key] = 1.0
+            else:
+                scores[key] = sum(object_scores) / len(object_scores)
+        return scores
+
+    def query_ids(self, body):
+        return dict.fromkeys(self.filter_ids(body), 1.0)
+
+    def text_fields(self, body):
+        fields = body.get(const.FIELDS)
+        if not fields:
+            fields = [ body.get('default_field', ALL_FIELD) ]
+        return [ field.split('^')[0] for field in fields ]
+
+    def query_query_string(self, body):
+        """
+        A subset of query_string: whitespace separated terms (optionally with
+        a "field:" prefix and * and ? wildcards), combined with
+        default_operator.
+        """
+        text = body[const.QUERY]
+        wildcards = body.get('analyze_wildcard', False)
+        require_all = body.get('default_operator', 'OR').upper() == 'AND'
+        fields = [ self.field(path) for path in self.text_fields(body) ]
+        scores = {}
+        matched_words = 0
+        for word in text.split():
+            if word.upper() in ('AND', 'OR'):
+                continue
+            matched_words += 1
+            word_fields = fields
+            if ':' in word:
+                path, _, word = word.partition(':')
+                word_fields = [ self.field(path) ]
+            keys = set()
+            if wildcards and ('*' in word or '?' in word):
+                pattern = re.compile(fnmatch.translate(word.lower()))
+                for field in word_fields:
+                    keys |= field.matching(lambda term:
+                        isinstance(term, basestring) and pattern.match(term))
+            else:
+                for token in analyze(word):
+                    for field in word_fields:
+                        keys |= field.lookup(token)
+            for key in keys & self.universe:
+                scores[key] = scores.get(key, 0) + 1.0
+        if require_all:
+            scores = dict((key, score) for key, score in scores.iteritems()
+                if score >= matched_words)
+        return scores
+
+    def pattern_query(self, body, translate):
+        path, clause = self.field_body(body)
+        if isinstance(clause, dict):
+            pattern = clause.get('value', clause.get(const.TERM))
+            boost = clause.get('boost', 1.0)
+        else:
+            pattern, boost = clause, 1.0
+        regex = re.compile(translate(pattern) + r'\Z')
+        keys = self.field(path).matching(lambda term:
+            isinstance(term, basestring) and regex.match(term))
+        return dict.fromkeys(keys & self.universe, boost)
+
+    def query_wildcard(self, body):
+        return self.pattern_query(body, fnmatch.translate)
+
+    def query_regexp(self, body):
+        return self.pattern_query(body, lambda pattern: pattern)
+
+    def search(self, body):
+        """
+        Return {document key: score} for a search body: its query, restricted
+        by its top-level filter if any.
+        """
+        scores = self.scores(body.get(const.QUERY, { const.MATCH_ALL: {} }))
+        if const.FILTER in body:
+            keys = self.keys(body[const.FILTER])
+            scores = dict((key, score) for key, score in scores.iteritems()
+                if key in keys)
+        return scores
+
+
+def top_level_clauses(query):
+    """
+    Return the queries and filters of a filtered and / or bool query, or
+    the query itself.
+    """
+    name, body = query.items()[0]
+    if name == const.FILTERED:
+        clauses = top_level_clauses(body[const.QUERY]) \
+            if const.QUERY in body else []
+        filter_ = body.get(const.FILTER)
+        if filter_:
+            filter_name, filters = filter_.items()[0]
+            if filter_name in (const.AND, const.OR):
+                if isinstance(filters, dict):
+                    filters = filters[const.FILTERS]
+                clauses.extend(filters)
+            else:
+                clauses.append(filter_)
+        return clauses
+    if name == const.BOOL:
+        return [ clause for occur in (const.MUST, const.SHOULD, const.MUST_NOT)
+            for clause in Searcher.clauses(body.get(occur)) ]
+    return [ query ]
+
+
+def clause_description(clause):
+    """
+    Return a Lucene-like description of a clause, e.g.
+    'term author.last:"heller"'.
+    """
+    name, body = clause.items()[0]
+    if isinstance(body, dict) and const.FIELDS in body:
+        # Text queries, e.g. query_string: "title:catch"
+        return '%s %s' % (name, ' '.join('%s:%s' % (field.split('^')[0],
+            body.get(const.QUERY)) for field in body[const.FIELDS]))
+    if isinstance(body, dict):
+        return '%s %s' % (name, ' '.join('%s:%s' % (key, json.dumps(value,
+            sort_keys=True)) for key, value in sorted(body.iteritems())))
+    return '%s %s' % (name, json.dumps(body))
+
+
+def sort_specs(sort):
+    """
+    Normalize a sort body to a list of (field, descending, options) tuples.
+    """
+    if sort is None:
+        return [ (const.SCORE, True, {}) ]
+    if not isinstance(sort, list):
+        sort = [ sort ]
+    specs = []
+    for spec in sort:
+        if isinstance(spec, basestring):
+            specs.append((spec, spec == const.SCORE, {}))
+            continue
+        for path, order in spec.iteritems():
+            options = {}
+            if isinstance(order, dict):
+                options = order
+                order = order.get(const.ORDER, const.ASC)
+            specs.append((path, order == const.DESC, options))
+    return specs
+
+
+def geo_distances(document, options):
+    """
+    Return the distances of a document's points from the center of a
+    _geo_distance sort.
+    """
+    path, center = geo.field_body(options)
+    center = geo.source_points(center)[0]
+    unit = options.get(const.UNIT, const.KILOMETERS)
+    return [ geo.distance(center, point, unit)
+        for value in path_values(document.source, path)
+        for point in geo.source_points(value) ]
+
+
+def sort_hits(hits, sort):
+    """
+    Sort a list of (index, document, score) in place. Documents missing a
+    sort value are placed last.
+    """
+    hits.sort(key=lambda hit: hit[1].seq)
+    for path, descending, options in reversed(sort_specs(sort)):
+        if path == const.SCORE:
+            hits.sort(key=lambda hit: hit[2], reverse=descending)
+            continue
+        present = []
+        missing = []
+        for hit in hits:
+            if path == geo.SORT_GEO_DISTANCE:
+                values = geo_distances(hit[1], options)
+            else:
+                values = hit[1].values.get(path)
+            if values:
+                present.append(((max if descending else min)(values), hit))
+            else:
+                missing.append(hit)
+        present.sort(key=lambda item: item[0], reverse=descending)
+        hits[:] = [ hit for _, hit in present ] + missing
+
+
+def facet_response(searcher_hits, facet):
+    """
+    Return the response of a terms facet, given a list of
+    (searcher, document keys) it applies to.
+    """
+    terms = facet[const.TERMS]
+    paths = terms.get(const.FIELDS) or [ terms[const.FIELD] ]
+    counts = {}
+    missing = total = 0
+    for searcher, keys in searcher_hits:
+        for key in keys:
+            document = searcher.index.documents[key]
+            doc_terms = set()
+            for path in paths:
+                doc_terms.update(document.terms.get(path, ()))
+            if not doc_terms:
+                missing += 1
+            for term in doc_terms:
+                counts[term] = counts.get(term, 0) + 1
+                total += 1
+    order = terms.get(const.ORDER, 'count')
+    if order in ('term', 'reverse_term'):
+        ranked = sorted(counts.iteritems(), reverse=order == 'reverse_term')
+    else:
+        ranked = sorted(counts.iteritems(), key=lambda item: (-item[1],
+            item[0]), reverse=order == 'reverse_count')
+    ranked = ranked[:terms.get(const.SIZE) or DEFAULT_FACET_SIZE]
+    return {
+        '_type': const.TERMS,
+        'missing': missing,
+        'total': total,
+        'other': total - sum(count for _, count in ranked),
+        const.TERMS: [ { const.TERM: term, const.COUNT: count }
+            for term, count in ranked ],
+    }
+
+
+MILLIS = { 's': 1000, 'm': 60 * 1000, 'h': 3600 * 1000, 'd': 86400 * 1000,
+    'w': 7 * 86400 * 1000 }
+NAMED_INTERVALS = { 'second': '1s', 'minute': '1m', 'hour': '1h', 'day': '1d',
+    'week': '1w' }
+INTERVAL_RE = re.compile(r'^(\d+)([smhdw])$')
+
+
+def floor_millis(millis, interval):
+    """
+    Return the start (epoch milliseconds) of the date_histogram interval
+    containing millis: "month", "quarter", "year" or e.g. "day", "6h".
+    Weeks start on Monday.
+    """
+    if interval in ('month', 'quarter', 'year'):
+        date = EPOCH + datetime.timedelta(milliseconds=millis)
+        month = 1
+        if interval == 'month':
+            month = date.month
+        elif interval == 'quarter':
+            month = date.month - (date.month - 1) % 3
+        return to_millis(datetime.datetime(date.year, month, 1))
+    match = INTERVAL_RE.match(NAMED_INTERVALS.get(interval, interval))
+    if match is None:
+        raise bad_request('SearchParseException[failed to parse interval \
+[%s]]' % interval)
+    size = int(match.group(1)) * MILLIS[match.group(2)]
+    # The epoch is a Thursday
+    offset = 3 * MILLIS['d'] if match.group(2) == 'w' else 0
+    return (millis + offset) // size * size - offset
+
+
+def iso_millis(millis):
+    return (EPOCH + datetime.timedelta(milliseconds=millis)).isoformat()
+
+
+class Aggregator(object):
+    """
+    Evaluates aggregations over a list of (searcher, document) hits of a
+    search query.
+    """
+
+    def aggregate(self, hits, aggs):
+        """
+        Return the "aggregations" response for an "aggs" body.
+        """
+        results = {}
+        for name, body in aggs.iteritems():
+            children = body.get(aggregation.AGGS) or body.get(
+                    aggregation.AGGREGATIONS) or {}
+            agg_types = [ key for key in body if key not in (aggregation.AGGS,
+                aggregation.AGGREGATIONS) ]
+            method = getattr(self, 'agg_' + agg_types[0], None) \
+                if len(agg_types) == 1 else None
+            if method is None:
+                raise bad_request('SearchParseException[aggregation [%s]: \
+unsupported type %s]' % (name, agg_types))
+            results[name] = method(hits, body[agg_types[0]], children)
+        return results
+
+    def bucket(self, key, hits, children, **extra):
+        bucket = { 'key': key, 'doc_count': len(hits) }
+        bucket.update(extra)
+        bucket.update(self.aggregate(hits, children))
+        return bucket
+
+    @staticmethod
+    def group(hits, keys_of):
+        """
+        Return {key: [hits]} for the keys keys_of(hit) returns per hit.
+        """
+        groups = {}
+        for hit in hits:
+            for key in set(keys_of(hit)):
+                groups.setdefault(key, []).append(hit)
+        return groups
+
+    def histogram_buckets(self, hits, spec, children, floor, **extra):
+        path = spec[const.FIELD]
+        groups = self.group(hits, lambda hit: [ floor(value)
+            for value in hit[1].values.get(path, ()) ])
+        min_doc_count = spec.get('min_doc_count', 1)
+        return { aggregation.BUCKETS: [ self.bucket(key, groups[key], children,
+            **dict((name, function(key)) for name, function
+                in extra.iteritems()))
+            for key in sorted(groups) if len(groups[key]) >= min_doc_count ] }
+
+    def agg_terms(self, hits, spec, children):
+        path = spec[const.FIELD]
+        groups = self.group(hits, lambda hit: hit[1].terms.get(path, ()))
+        order = spec.get(const.ORDER, { '_count': 'desc' })
+        (order_by, direction), = order.items()
+        if order_by in ('_term', '_key'):
+            ranked = sorted(groups, reverse=direction == const.DESC)
+        else:
+            ranked = sorted(groups, key=lambda term: (-len(groups[term])
+                if direction == const.DESC else len(groups[term]), term))
+        ranked = [ term for term in ranked
+            if len(groups[term]) >= spec.get('min_doc_count', 1) ]
+        size = spec.get(const.SIZE, 10) or len(ranked)
+        return {
+            'doc_count_error_upper_bound': 0,
+            'sum_other_doc_count': sum(len(groups[term])
+                for term in ranked[size:]),
+            aggregation.BUCKETS: [ self.bucket(term, groups[term], children)
+                for term in ranked[:size] ],
+        }
+
+    def agg_range(self, hits, spec, children):
+        path = spec[const.FIELD]
+        buckets = []
+        for bounds in spec[aggregation.RANGES]:
+            low = high = None
+            if hits and aggregation.FROM in bounds:
+                low = hits[0][0].term(path, bounds[aggregation.FROM])
+            if hits and aggregation.TO in bounds:
+                high = hits[0][0].term(path, bounds[aggregation.TO])
+            matching = [ hit for hit in hits if any(
+                (low is None or value >= low) and (high is None or value < high)
+                for value in hit[1].values.get(path, ())) ]
+            extra = {}
+            if low is not None:
+                extra[aggregation.FROM] = low
+            if high is not None:
+                extra[aggregation.TO] = high
+            key = '%s-%s' % ('*' if low is None else low,
+                    '*' if high is None else high)
+            buckets.append(self.bucket(key, matching, children, **extra))
+        return { aggregation.BUCKETS: buckets }
+
+    agg_date_range = agg_range
+
+    def agg_histogram(self, hits, spec, children):
+        interval = spec[aggregation.INTERVAL]
+        return self.histogram_buckets(hits, spec, children,
+                lambda value: value // interval * interval)
+
+    def agg_date_histogram(self, hits, spec, children):
+        interval = spec[aggregation.INTERVAL]
+        return self.histogram_buckets(hits, spec, children,
+                lambda value: floor_millis(value, interval),
+                key_as_string=iso_millis)
+
+    def agg_stats(self, hits, spec, children):
+        path = spec[const.FIELD]
+        values = [ value for hit in hits
+            for value in hit[1].values.get(path, ()) ]
+        if not values:
+            return { const.COUNT: 0, 'min': None, 'max': None, 'avg': None,
+                'sum': None }
+        return { const.COUNT: len(values), 'min': min(values),
+            'max': max(values), 'avg': float(sum(values)) / len(values),
+            'sum': sum(values) }
+
+    def agg_cardinality(self, hits, spec, children):
+        path = spec[const.FIELD]
+        return { 'value': len(set(term for hit in hits
+            for term in hit[1].terms.get(path, ()))) }
+
+    def agg_composite(self, hits, spec, children):
+        sources = []
+        for source in spec[aggregation.SOURCES]:
+            (name, body), = source.items()
+            (source_type, source_spec), = body.items()
+            path = source_spec[const.FIELD]
+            if source_type == const.TERMS:
+                keys_of = lambda hit, path=path: hit[1].terms.get(path, ())
+            elif source_type in (aggregation.HISTOGRAM,
+                    aggregation.DATE_HISTOGRAM):
+                interval = source_spec[aggregation.INTERVAL]
+                if source_type == aggregation.HISTOGRAM:
+                    floor = lambda value, interval=interval: \
+                        value // interval * interval
+                else:
+                    floor = lambda value, interval=interval: \
+                        floor_millis(value, interval)
+                keys_of = lambda hit, path=path, floor=floor: [ floor(value)
+                    for value in hit[1].values.get(path, ()) ]
+            else:
+                raise bad_request('SearchParseException[composite source \
+[%s]: unsupported type %s]' % (name, source_type))
+            sources.append((name, keys_of))
+        names = [ name for name, _ in sources ]
+        groups = self.group(hits, lambda hit: itertools.product(*[
+            sorted(set(keys_of(hit))) for _, keys_of in sources ]))
+        keys = sorted(groups)
+        after = spec.get(aggregation.AFTER)
+        if after is not None:
+            after = tuple(after[name] for name in names)
+            keys = [ key for key in keys if key > after ]
+        keys = keys[:spec.get(const.SIZE, 10)]
+        response = { aggregation.BUCKETS: [ self.bucket(dict(zip(names, key)),
+            groups[key], children) for key in keys ] }
+        if keys:
+            response[aggregation.AFTER_KEY] = dict(zip(names, keys[-1]))
+        return response
+
+
+class MemoryElasticSearch(object):
+    """
+    In-memory implementation of the pyelasticsearch ElasticSearch client
+    methods used by SearchModel, accepting the DSL of the ES version its URL
+    selects. Responses have the shape of ES 0.90 responses (which later
+    versions extend); errors are raised as pyelasticsearch exceptions.
+    """
+
+    def __init__(self, urls=MEMORY_URL):
+        self.urls = urls
+        self.version = url_version(urls)
+        self.indices = {}
+        self.scrolls = {}
+        self.lock = threading.RLock()
+
+    def _index(self, name, create=False):
+        if name not in self.indices:
+            if not create:
+                raise ElasticHttpNotFoundError(404,
+                        'IndexMissingException[[%s] missing]' % name)
+            self.indices[name] = MemoryIndex(name)
+        return self.indices[name]
+
+    def _indices(self, index, ignore_missing=False):
+        """
+        Return the MemoryIndexes for index names, which may contain "*"
+        wildcards. Missing indices raise ElasticHttpNotFoundError, unless
+        ignore_missing is True.
+        """
+        index_names = names(index)
+        if index_names is None:
+            return self.indices.values()
+        indices = []
+        for name in index_names:
+            if '*' in name:
+                indices.extend(self.indices[match] for match
+                    in sorted(fnmatch.filter(self.indices, name)))
+            elif name in self.indices or not ignore_missing:
+                indices.append(self._index(name))
+        return indices
+
+    def _encode_json(self, value):
+        return json.dumps(value, default=lambda value: value.isoformat())
+
+    def _concat(self, items):
+        if items is None:
+            return ''
+        if isinstance(items, basestring):
+            items = [ items ]
+        return ','.join(item for item in items if item != '_all')
+
+    @staticmethod
+    def _shards():
+        return { 'total': 1, 'successful': 1, 'failed': 0 }
+
+    def _require(self, feature, name=None):
+        """
+        Raise a 400 ElasticHttpError if the modelled ES version doesn't have
+        a feature of VERSIONED_FEATURES.
+        """
+        since, until, error = VERSIONED_FEATURES[feature]
+        if self.version < since or (until is not None
+                and self.version >= until):
+            raise bad_request('%s[%s is not supported by ES %d.%d]' % (error,
+                name or feature, self.version[0], self.version[1]))
+
+    def _check_query(self, query):
+        """
+        Reject the query DSL of other ES versions in a query or filter.
+        """
+        legacy = legacy_clauses(query)
+        if legacy:
+            self._require('ES 0.90 queries and filters', '[%s]' % legacy[0])
+        if has_bool_filter(query):
+            self._require('bool filter clauses')
+
+    def _check_search(self, body, params):
+        """
+        Reject the search body features of other ES versions.
+        """
+        for key in (const.QUERY, const.FILTER):
+            if key in body:
+                self._check_query(body[key])
+        if const.FACETS in body:
+            self._require('facets')
+        aggs = body.get(aggregation.AGGS) or body.get(
+                aggregation.AGGREGATIONS)
+        if aggs:
+            self._require('aggregations')
+            if aggregation.COMPOSITE in aggregation_types(aggs):
+                self._require('composite aggregations')
+        if 'terminate_after' in body or 'terminate_after' in params:
+            self._require('terminate_after')
+        if body.get('profile'):
+            raise bad_request('SearchParseException[profile is not \
+supported by the memory backend]')
+
+    @staticmethod
+    def _routed_scores(searcher, scores, params):
+        """
+        Return the scores of the documents a search with the given
+        parameters reaches: those written with one of its routing values,
+        or without routing.
+        """
+        routing = routing_values(params)
+        if routing is None:
+            return scores
+        documents = searcher.index.documents
+        return dict((key, score) for key, score in scores.iteritems()
+            if documents[key].shard_routing() in routing
+            or documents[key].shard_routing() is None)
+
+    """Documents"""
+    def index(self, index, doc_type, doc, id=None, force_insert=False,
+            query_params=None, **kwargs):
+        with self.lock:
+            memory_index = self._index(index, create=True)
+            doc_id = unicode(id) if id is not None else uuid.uuid4().hex
+            key = (doc_type, doc_id)
+            if force_insert and key in memory_index.documents:
+                raise ElasticHttpError(409, 'DocumentAlreadyExistsException\
+[[%s][0] [%s][%s]: document already exists]' % (index, doc_type, doc_id))
+            params = es_params(kwargs, query_params)
+            version = params.get('version')
+            document = memory_index.add(key, copy.deepcopy(doc),
+                    int(version) if version is not None else None,
+                    optional_unicode(params.get('parent')),
+                    optional_unicode(params.get('routing')))
+            return { const.OK: True, '_index': index, const.TYPE: doc_type,
+                const.ID: doc_id, '_version': document.version }
+
+    def bulk_index(self, index, doc_type, docs, id_field='id',
+            parent_field='_parent', query_params=None, **kwargs):
+        if not docs:
+            raise ValueError('No documents provided for bulk indexing!')
+        start = time.time()
+        items = []
+        with self.lock:
+            for doc in docs:
+                doc_id = doc.get(id_field)
+                response = self.index(index, doc_type, doc, id=doc_id)
+                items.append({ const.INDEX: response })
+        return { 'took': int((time.time() - start) * 1000),
+            const.ITEMS: items }
+
+    def get(self, index, doc_type, id, query_params=None, **kwargs):
+        with self.lock:
+            document = routed(self._index(index).get(doc_type, unicode(id)),
+                    es_params(kwargs, query_params))
+            if document is None:
+                raise ElasticHttpNotFoundError(404, { '_index': index,
+                    const.TYPE: doc_type, const.ID: id, 'exists': False })
+            return { '_index': index, const.TYPE: doc_type, const.ID: id,
+                '_version': document.version, 'exists': True,
+                const.SOURCE: copy.deepcopy(document.source) }
+
+    def multi_get(self, ids, index=None, doc_type=None, fields=None,
+            query_params=None, **kwargs):
+        docs = []
+        with self.lock:
+            for doc_id in ids:
+                params = es_params(kwargs, query_params)
+                doc_index, doc_doc_type = index, doc_type
+                if isinstance(doc_id, dict):
+                    doc_index = doc_id.get('_index', index)
+                    doc_doc_type = doc_id.get(const.TYPE, doc_type)
+                    for meta in ('routing', 'parent'):
+                        if '_' + meta in doc_id:
+                            params[meta] = doc_id['_' + meta]
+                    doc_id = doc_id[const.ID]
+                try:
+                    docs.append(self.get(doc_index, doc_doc_type, doc_id,
+                        query_params=params))
+                except ElasticHttpNotFoundError, e:
+                    docs.append(e.error)
+        return { const.DOCS: docs }
+
+    def update(self, index, doc_type, id, script=None, params=None, lang=None,
+            query_params=None, doc=None, upsert=None, doc_as_upsert=False,
+            **kwargs):
+        """
+        Merge a partial document into a document, or create it from upsert.
+        Scripts are not supported.
+        """
+        if script is not None:
+            raise bad_request('ElasticSearchIllegalArgumentException\
+[scripts are not supported by the memory backend]')
+        params = es_params(kwargs, query_params)
+        with self.lock:
+            memory_index = self._index(index, create=True)
+            doc_id = unicode(id)
+            key = (doc_type, doc_id)
+            document = routed(memory_index.documents.get(key), params)
+            version = params.get('version')
+            if document is None:
+                if doc_as_upsert:
+                    upsert = doc
+                if upsert is None:
+                    raise ElasticHttpNotFoundError(404, \
+'DocumentMissingException[[%s][0] [%s][%s]: document missing]' % (index,
+                        doc_type, doc_id))
+                source = copy.deepcopy(upsert)
+            elif version is not None and int(version) != document.version:
+                raise ElasticHttpError(409, 'VersionConflictEngineException[\
+[%s][0] [%s][%s]: version conflict, current [%s], provided [%s]]' % (index,
+                    doc_type, doc_id, document.version, version))
+            else:
+                source = merge_source(copy.deepcopy(document.source),
+                        doc or {})
+            document = memory_index.add(key, source, None,
+                    optional_unicode(params.get('parent')),
+                    optional_unicode(params.get('routing')))
+            return { const.OK: True, '_index': index, const.TYPE: doc_type,
+                const.ID: doc_id, const.VERSION: document.version }
+
+    def delete(self, index, doc_type, id, query_params=None, **kwargs):
+        if id is None or id == '':
+            raise ValueError('No ID specified. To delete all documents in '
+                    'an index, use delete_all().')
+        with self.lock:
+            memory_index = self._index(index)
+            key = (doc_type, unicode(id))
+            document = routed(memory_index.documents.get(key),
+                    es_params(kwargs, query_params))
+            if document is None:
+                raise ElasticHttpNotFoundError(404, { const.OK: True,
+                    'found': False, '_index': index, const.TYPE: doc_type,
+                    const.ID: id })
+            memory_index.remove(key)
+            return { const.OK: True, 'found': True, '_index': index,
+                const.TYPE: doc_type, const.ID: id,
+                '_version': document.version + 1 }
+
+    def delete_all(self, index, doc_type, query_params=None, **kwargs):
+        """
+        Delete a document type: its documents and its mapping.
+        """
+        with self.lock:
+            memory_index = self._index(index)
+            for key in memory_index.keys([ doc_type ]):
+                memory_index.remove(key)
+            memory_index.mappings.pop(doc_type, None)
+            memory_index._leaves.pop(doc_type, None)
+            return { const.OK: True }
+
+    def delete_by_query(self, index, doc_type, query, query_params=None,
+            **kwargs):
+        params = es_params(kwargs, query_params)
+        query = self._count_query(query)
+        self._check_query(query)
+        ignore_missing = params.get('ignore_indices') == 'missing'
+        with self.lock:
+            indices = {}
+            for memory_index in self._indices(index, ignore_missing):
+                searcher = Searcher(memory_index, names(doc_type))
+                for key in self._routed_scores(searcher,
+                        searcher.scores(query), params):
+                    memory_index.remove(key)
+                indices[memory_index.name] = { '_shards': self._shards() }
+            return { const.OK: True, '_indices': indices }
+
+    """Searching"""
+    def _count_query(self, query):
+        """
+        Count and delete-by-query bodies are the query itself; accept ones
+        wrapped in {"query": ...} as well.
+        """
+        if isinstance(query, basestring):
+            return { 'query_string': { const.QUERY: query } }
+        if query.keys() == [ const.QUERY ]:
+            return query[const.QUERY]
+        return query
+
+    def _searchers(self, index, doc_type, params):
+        doc_types = names(doc_type)
+        ignore_missing = params.get('ignore_indices') == 'missing'
+        return [ Searcher(memory_index, doc_types)
+            for memory_index in self._indices(index, ignore_missing) ]
+
+    def search(self, query, index=None, doc_type=None, query_params=None,
+            **kwargs):
+        start = time.time()
+        if isinstance(query, basestring):
+            query = { const.QUERY: self._count_query(query) }
+        params = es_params(kwargs, query_params)
+        self._check_search(query, params)
+        with self.lock:
+            hits = []
+            searcher_keys = []
+            for searcher in self._searchers(index, doc_type, params):
+                scores = self._routed_scores(searcher, searcher.search(query),
+                        params)
+                searcher_keys.append((searcher, scores))
+                documents = searcher.index.documents
+                hits.extend((searcher.index, documents[key], score)
+                    for key, score in scores.iteritems())
+            sort_hits(hits, query.get(const.SORT))
+            offset = int(query.get(const.FROM, params.get(const.FROM, 0)))
+            size = int(query.get(const.SIZE,
+                params.get(const.SIZE, DEFAULT_SEARCH_SIZE)))
+            response = self._hits_response(hits, offset, size)
+            if params.get(SCROLL):
+                response[SCROLL_ID] = self._open_scroll(hits, offset + size,
+                        size, params[SCROLL])
+            facets = query.get(const.FACETS)
+            if facets:
+                response[const.FACETS] = self._facets(facets, searcher_keys)
+            aggs = query.get(aggregation.AGGS) or query.get(
+                    aggregation.AGGREGATIONS)
+            if aggs:
+                aggregator = Aggregator()
+                response[aggregation.AGGREGATIONS] = aggregator.aggregate(
+                    [ (searcher, searcher.index.documents[key])
+                        for searcher, scores in searcher_keys
+                        for key in scores ], aggs)
+        response['took'] = int((time.time() - start) * 1000)
+        return response
+
+    def _hits_response(self, hits, offset, size):
+        """
+        Return a search response for a page of sorted (index, document,
+        score) hits.
+        """
+        return {
+            'took': 0,
+            'timed_out': False,
+            '_shards': self._shards(),
+            const.HITS: {
+                const.TOTAL: len(hits),
+                'max_score': max([ hit[2] for hit in hits ] or [ None ]),
+                const.HITS: [ self._hit(memory_index, document, score)
+                    for memory_index, document, score
+                    in hits[offset:offset + size] ],
+            },
+        }
+
+    @staticmethod
+    def _hit(memory_index, document, score):
+        """
+        Return one search hit, with the document's "_routing" and "_parent"
+        meta fields if it has them.
+        """
+        hit = {
+            '_index': memory_index.name,
+            const.TYPE: document.key[0],
+            const.ID: document.key[1],
+            '_version': document.version,
+            const.SCORE: score,
+            const.SOURCE: copy.deepcopy(document.source),
+        }
+        if document.routing is not None:
+            hit[const.ROUTING] = document.routing
+        if document.parent is not None:
+            hit[const.PARENT] = document.parent
+        return hit
+
+    def _expire_scrolls(self):
+        now = time.time()
+        for scroll_id, (_, _, _, expires) in self.scrolls.items():
+            if expires <= now:
+                del self.scrolls[scroll_id]
+
+    def _open_scroll(self, hits, offset, size, keep_alive):
+        """
+        Keep the hits of a scrolled search for keep_alive (e.g. "5m"); return
+        the scroll id. At most MAX_OPEN_SCROLLS may be open at once.
+        """
+        expires = time.time() + keep_alive_seconds(keep_alive)
+        with self.lock:
+            self._expire_scrolls()
+            if len(self.scrolls) >= MAX_OPEN_SCROLLS:
+                raise ElasticHttpError(500, 'ElasticsearchException[Trying \
+to create too many scroll contexts. Must be less than or equal to: [%d]]' %
+                    MAX_OPEN_SCROLLS)
+            scroll_id = uuid.uuid4().hex
+            self.scrolls[scroll_id] = (hits, offset, size, expires)
+            return scroll_id
+
+    def _scroll(self, scroll_id, params):
+        """
+        Return the next page of a scrolled search. Scrolls see the results
+        as of their first request; each request keeps the scroll open for
+        its "scroll" time, after which (or after the last page) it expires.
+        """
+        with self.lock:
+            self._expire_scrolls()
+            if scroll_id not in self.scrolls:
+                raise ElasticHttpNotFoundError(404,
+                        'SearchContextMissingException[No search context \
+found for id [%s]]' % scroll_id)
+            hits, offset, size, expires = self.scrolls[scroll_id]
+            response = self._hits_response(hits, offset, size)
+            if offset >= len(hits):
+                del self.scrolls[scroll_id]
+            else:
+                if params.get(SCROLL):
+                    expires = time.time() + keep_alive_seconds(params[SCROLL])
+                self.scrolls[scroll_id] = (hits, offset + size, size, expires)
+            response[SCROLL_ID] = scroll_id
+            return response
+
+    def clear_scroll(self, scroll_ids):
+        """
+        Free scroll contexts by id ("_all" frees every one).
+        """
+        with self.lock:
+            if '_all' in scroll_ids:
+                scroll_ids = self.scrolls.keys()
+            freed = [ scroll_id for scroll_id in scroll_ids
+                if self.scrolls.pop(scroll_id, None) is not None ]
+            return { 'succeeded': True, 'num_freed': len(freed) }
+
+    def _facets(self, facets, searcher_keys):
+        results = {}
+        for name, facet in facets.iteritems():
+            if const.TERMS not in facet:
+                raise bad_request('SearchParseException[facet [%s]: only \
+terms facets are supported]' % name)
+            facet_hits = []
+            for searcher, scores in searcher_keys:
+                keys = searcher.universe if facet.get('global') else scores
+                if const.FACET_FILTER in facet:
+                    keys = searcher.keys(facet[const.FACET_FILTER]) & set(keys)
+                facet_hits.append((searcher, keys))
+            results[name] = facet_response(facet_hits, facet)
+        return results
+
+    def explain(self, index, doc_type, id, query):
+        """
+        Explain a document's score: one detail per top-level query or filter
+        clause, valued with the clause's score for the document.
+        """
+        self._check_query(query)
+        with self.lock:
+            memory_index = self._index(index)
+            key = (doc_type, unicode(id))
+            if memory_index.get(*key) is None:
+                raise ElasticHttpNotFoundError(404, { '_index': index,
+                    const.TYPE: doc_type, const.ID: id, 'exists': False })
+            searcher = Searcher(memory_index, [ doc_type ])
+            score = searcher.scores(query).get(key)
+            details = [ { 'value': searcher.scores(clause).get(key, 0.0),
+                'description': clause_description(clause), 'details': [] }
+                for clause in top_level_clauses(query) ]
+            return { '_index': index, const.TYPE: doc_type, const.ID: id,
+                'matched': score is not None, 'explanation': {
+                    'value': score or 0.0, 'description': 'sum of:',
+                    'details': details } }
+
+    def count(self, query, index=None, doc_type=None, query_params=None,
+            **kwargs):
+        params = es_params(kwargs, query_params)
+        terminate_after = params.get('terminate_after')
+        if terminate_after is not None:
+            self._require('terminate_after')
+        query = self._count_query(query)
+        self._check_query(query)
+        with self.lock:
+            # Each index is one shard: terminate_after applies per index
+            counts = [ len(self._routed_scores(searcher,
+                searcher.scores(query), params))
+                for searcher in self._searchers(index, doc_type, params) ]
+        response = { '_shards': self._shards() }
+        if terminate_after is not None:
+            terminate_after = int(terminate_after)
+            response['terminated_early'] = any(count >= terminate_after
+                for count in counts)
+            counts = [ min(count, terminate_after) for count in counts ]
+        response[const.COUNT] = sum(counts)
+        return response
+
+    """Indices and mappings"""
+    def create_index(self, index, settings=None, query_params=None):
+        with self.lock:
+            if index in self.indices:
+                raise IndexAlreadyExistsError(400,
+                        'IndexAlreadyExistsException[[%s] Already exists]' %
+                        index)
+            self.indices[index] = MemoryIndex(index, settings)
+            return { const.OK: True, 'acknowledged': True }
+
+    def delete_index(self, index, query_params=None):
+        with self.lock:
+            for memory_index in self._indices(index):
+                del self.indices[memory_index.name]
+            return { const.OK: True, 'acknowledged': True }
+
+    def get_mapping(self, index=None, doc_type=None, query_params=None):
+        with self.lock:
+            doc_types = names(doc_type)
+            response = {}
+            for memory_index in self._indices(index):
+                response[memory_index.name] = dict(
+                    (name, copy.deepcopy(mapping))
+                    for name, mapping in memory_index.mappings.iteritems()
+                    if doc_types is None or name in doc_types)
+            if doc_types is not None and len(response) == 1:
+                return response.values()[0]
+            return response
+
+    def put_mapping(self, index, doc_type, mapping, query_params=None,
+            **kwargs):
+        with self.lock:
+            for memory_index in self._indices(index):
+                memory_index.put_mapping(doc_type, mapping)
+            return { const.OK: True, 'acknowledged': True }
+
+    def get_settings(self, index, query_params=None):
+        with self.lock:
+            return dict((memory_index.name,
+                { 'settings': copy.deepcopy(memory_index.settings) })
+                for memory_index in self._indices(index))
+
+    def update_settings(self, index, settings, query_params=None):
+        with self.lock:
+            for memory_index in self._indices(index):
+                memory_index.settings.update(settings)
+            return { const.OK: True, 'acknowledged': True }
+
+    def refresh(self, index=None, query_params=None):
+        self._indices(index)
+        return { const.OK: True, '_shards': self._shards() }
+
+    def flush(self, index=None, query_params=None):
+        return self.refresh(index)
+
+    """Raw requests"""
+    def send_request(self, method, path_components, body='', query_params=None,
+            encode_body=True):
+        """
+        Serve the raw requests bungee makes: _search/template,
+        _search/scroll (GET, and DELETE to clear), _search, _count, _update,
+        _explain and _bulk.
+        """
+        path = [ component for component in path_components
+            if component not in (None, '') ]
+        if path[:2] == [ '_search', SCROLL ] and method == 'DELETE':
+            scroll_ids = path[2].split(',') if len(path) > 2 else []
+            if isinstance(body, basestring) and body.strip().startswith('{'):
+                body = json.loads(body)
+            if isinstance(body, dict):
+                body = body.get('scroll_id', [])
+            if isinstance(body, basestring):
+                body = body.split(',')
+            scroll_ids.extend(scroll_id.strip() for scroll_id in body or ()
+                if scroll_id.strip())
+            return self.clear_scroll(scroll_ids)
+        if path == [ '_search', SCROLL ]:
+            return self._scroll(body.strip(), query_params or {})
+        if path and path[-1] == const.TEMPLATE and '_search' in path:
+            return self._search_template(path[:path.index('_search')], body,
+                    query_params)
+        if path and path[-1] in ('_search', '_count'):
+            index = path[0] if len(path) > 1 else None
+            doc_type = path[1] if len(path) > 2 else None
+            if isinstance(body, basestring):
+                body = json.loads(body) if body.strip() else {}
+            if path[-1] == '_count':
+                return self.count(body or { const.MATCH_ALL: {} }, index,
+                        doc_type, query_params)
+            return self.search(body, index, doc_type, query_params)
+        if len(path) == 4 and path[-1] == '_explain':
+            if isinstance(body, basestring):
+                body = json.loads(body)
+            return self.explain(path[0], path[1], path[2], body[const.QUERY])
+        if len(path) == 4 and path[-1] == '_update':
+            if isinstance(body, basestring):
+                body = json.loads(body)
+            return self.update(*path[:3], query_params=query_params, **dict(
+                (str(key), value) for key, value in body.iteritems()))
+        if path and path[-1] == '_bulk':
+            return self.bulk(body, path[0] if len(path) > 1 else None,
+                    path[1] if len(path) > 2 else None)
+        raise bad_request('No handler found for uri [/%s] and method [%s]' % (
+            '/'.join(path), method))
+
+    def _search_template(self, path, body, query_params=None):
+        """
+        Render a mustache search template, as sent by SearchModel
+        search_template: every {{{name}}} is replaced by its param value.
+        """
+        self._require('search templates')
+        params = body.get(const.PARAMS, {})
+        template = body[const.TEMPLATE]
+        if not isinstance(template, basestring):
+            template = json.dumps(template)
+        rendered = re.sub(r'\{\{\{?(\w+)\}?\}\}',
+                lambda match: unicode(params.get(match.group(1), '')),
+                template)
+        return self.search(json.loads(rendered),
+                path[0] if path else None, path[1] if len(path) > 1 else None,
+                query_params)
+
+    def bulk(self, body, index=None, doc_type=None):
+        """
+        Apply a raw newline-delimited _bulk body (index, create, update and
+        delete actions).
+        """
+        start = time.time()
+        if not isinstance(body, basestring):
+            body = ''.join(body)
+        lines = iter(line for line in body.splitlines() if line.strip())
+        items = []
+        with self.lock:
+            for line in lines:
+                action = json.loads(line)
+                op_type, meta = action.items()[0]
+                item_index = meta.get('_index', index)
+                item_type = meta.get(const.TYPE, doc_type)
+                item_id = meta.get(const.ID)
+                try:
+                    routing = dict(es_routing=meta.get(const.ROUTING),
+                        es_parent=meta.get(PARENT_FIELD))
+                    if op_type == 'delete':
+                        response = self.delete(item_index, item_type, item_id,
+                                **routing)
+                    elif op_type == const.UPDATE:
+                        update = dict((str(key), value) for key, value
+                            in json.loads(next(lines)).iteritems())
+                        update.update(routing)
+                        response = self.update(item_index, item_type, item_id,
+                                es_version=meta.get('_version'), **update)
+                    elif op_type in (const.INDEX, const.CREATE):
+                        source = json.loads(next(lines))
+                        response = self.index(item_index, item_type, source,
+                                id=item_id, force_insert=op_type == const.CREATE,
+                                **routing)
+                    else:
+                        raise bad_request('ActionRequestValidationException\
+[action [%s] is not supported]' % op_type)
+                except ElasticHttpError, e:
+                    response = { '_index': item_index, const.TYPE: item_type,
+                        const.ID: item_id, 'status': e.status_code,
+                        'error': e.error }
+                items.append({ op_type: response })
+        return { 'took': int((time.time() - start) * 1000),
+            const.ITEMS: items }
@@ -4,19 +4,75 @@ and ElasticSearch, via the pyelasticsearch library.
 
 A given SearchModel supports exactly ONE index.
 """
+import aggregation
+import bulk
+import compression
 import const
 import exception
+import instrument
+import reindex
+import snapshot
 import warnings
+import weakref
 
+from codec import compile_decoders, decode_source
 from field import SearchField
 from query import SearchQuery
 from json_document import JsonDocument, ResultSet
+from memory import MemoryElasticSearch, is_memory_url
+from percolator import Percolator
 from util import make_identifier
 
 from pyelasticsearch import ElasticSearch, ElasticHttpNotFoundError
 
 CONNECTION_POOL = {}
 INDEX_MAPPINGS = {}
+# Every concrete SearchModel class defined in this process
+MODELS = weakref.WeakSet()
+
+
+def get_connection(urls, compression_encoding=None):
+    """
+    Return the pooled connection for a URL or list of URLs.
+    :param compression_encoding: "gzip" or "deflate" to compress requests and
+        accept compressed responses.
+    """
+    global CONNECTION_POOL
+    key = str(urls)
+    if compression_encoding and not is_memory_url(urls):
+        key = '%s;%s' % (key, compression_encoding)
+    if key not in CONNECTION_POOL:
+        if is_memory_url(urls):
+            CONNECTION_POOL[key] = MemoryElasticSearch(urls)
+        else:
+            connection = ElasticSearch(urls)
+            if compression_encoding:
+                compression.compress(connection, compression_encoding)
+            CONNECTION_POOL[key] = instrument.measure(connection)
+    return CONNECTION_POOL[key]
+
+
+def registered_models():
+    """
+    Return all concrete SearchModel classes defined so far, sorted by name.
+    """
+    return sorted(MODELS, key=lambda model: (model.__module__, model.__name__))
+
+
+def merge_mappings(mappings):
+    """
+    Return one mapping per document type from a get_mapping response of one
+    or more indices, taking the first mapping of each type by index name.
+    Responses of ES 1.0 or later nest the types under "mappings".
+    """
+    mapping = {}
+    for index_name in sorted(mappings):
+        index_mappings = mappings[index_name]
+        if isinstance(index_mappings.get(const.MAPPINGS), dict):
+            index_mappings = index_mappings[const.MAPPINGS]
+        for doc_type, type_mapping in index_mappings.items():
+            mapping.setdefault(doc_type, type_mapping)
+    return mapping
 
 
 class SearchModelMeta(type):
@@ -27,7 +83,7 @@ class SearchModelMeta(type):
 
     def __init__(cls, name, bases, dict_):
         super(SearchModelMeta, cls).__init__(name, bases, dict_)
-        if name == 'SearchModel':
+        if name == 'SearchModel' or dict_.get('abstract'):
             return
         if const.INDEX_NAME not in dict_:
             raise (exception.ConfigError,
@@ -40,39 +96,61 @@ class SearchModelMeta(type):
             cls._urls = dict_.get(const.URLS)
         else:
             cls._urls = "http://localhost:9200"
+        cls._percolator = None
+        cls._delete_listeners = []
+        cls._warmup_queries = []
         cls.initialize_search_fields()
+        MODELS.add(cls)
 
     @property
     def connection(cls):
         """
-        Return an pyelasticsearch.ElasticSearch instance for the class URL.
-        Connections are pooled globally by URL in this process.
+        Return an pyelasticsearch.ElasticSearch instance for the class URL, or
+        a MemoryElasticSearch for "memory://" URLs.
+        Connections are pooled globally by URL (and compression) in this
+        process.
         """
-        global CONNECTION_POOL
-        key = str(cls._urls)
-        if key not in CONNECTION_POOL:
-            CONNECTION_POOL[key] = ElasticSearch(cls._urls)
-        return CONNECTION_POOL[key]
+        return get_connection(cls._urls, cls.compression)
 
     def generate_field_mappings(cls):
         """
         Return the processed search Fields for an index given its mappings.
-        Fields are cached globally by index name in this process.
+        Fields are cached globally by index name in this process. If the
+        index name matches several indices, the first mapping found for each
+        document type is used.
         """
         global INDEX_MAPPINGS
         key = cls.index_name
         if key not in INDEX_MAPPINGS:
-            mappings = cls.connection.get_mapping(index=cls.index_name)
-            INDEX_MAPPINGS[key] = cls.parse_mapping(mappings.values()[0])
+            with instrument.request('get_mapping', cls, key) as event:
+                mappings = event.send(cls.connection.get_mapping,
+                        index=cls.index_name)
+            INDEX_MAPPINGS[key] = cls.parse_mapping(merge_mappings(mappings))
         return INDEX_MAPPINGS[key]
 
+    def bind_field_mappings(cls, mappings):
+        """
+        Replace the class's search fields with those of a get_mapping
+        response covering its index, e.g. one fetched for several models.
+        """
+        cls.unbind_search_fields()
+        INDEX_MAPPINGS[cls.index_name] = cls.parse_mapping(
+                merge_mappings(mappings))
+        cls.initialize_search_fields()
+
+    def unbind_search_fields(cls):
+        """
+        Remove the search fields bound to the class. Fields of other
+        document types in its index were never bound.
+        """
+        for name, value in cls.__dict__.items():
+            if isinstance(value, SearchField):
+                delattr(cls, name)
+
     def delete_field_mappings(cls):
         global INDEX_MAPPINGS
-        field_mapping = cls.generate_field_mappings()
-        for fields in field_mapping.values():
-            for field_name, search_field in fields.iteritems():
-                delattr(cls, search_field._field_name)
-        del INDEX_MAPPINGS[cls.index_name]
+        cls.unbind_search_fields()
+        INDEX_MAPPINGS.pop(cls.index_name, None)
 
     def parse_mapping(cls, mapping):
         """
@@ -98,6 +176,8 @@ class SearchModelMeta(type):
         if force_reload:
             cls.delete_field_mappings()
         mappings = cls.generate_field_mappings()
+        if cls._percolator is not None:
+            cls._percolator.invalidate()
 
         if isinstance(cls.doc_type, (str, unicode)):
             doc_types = [ cls.doc_type ] 
@@ -105,6 +185,7 @@ class SearchModelMeta(type):
             doc_types = list(cls.doc_type)
         else:
             doc_types = mappings.keys()
+        cls._decoders = {}
         for doc_type in doc_types:
             mapping = mappings[doc_type]
             for field in mapping.values():
@@ -112,6 +193,9 @@ class SearchModelMeta(type):
                     warnings.warn('Field "%s" is already defined for document \
 type %s' % (field._field_name, doc_type))
                 setattr(cls, field._field_name, field)
+            cls._decoders[doc_type] = compile_decoders(dict(
+                (field._mapping_name, field._mapping)
+                for field in mapping.values()))
 
         # Special cases - add fields for doc type and id
         setattr(cls, const.ID, SearchField(const.ID, {}))
@@ -126,43 +210,202 @@ class SearchModel(object):
 
     __metaclass__ = SearchModelMeta
 
+    # If True, convert mapped date and number fields in results to Python
+    # objects. May be overridden per call with the "decode" argument.
+    decode_results = False
+
+    # If set to "error" or "warning", queries whose cost report has warnings
+    # of that severity or worse are rejected before they are sent.
+    strict_cost = None
+
+    # "gzip" or "deflate" to compress request bodies and accept compressed
+    # responses (see compression.py).
+    compression = None
+
+    # Dotted path of the document field holding the ES routing value, e.g.
+    # a tenant id. Documents are written with their routing value, and
+    # queries with term filters on the field search the matching shards only.
+    routing_field = None
+
+    # Dotted path of the document field holding the parent document id, for
+    # child types mapped with "_parent" (see SearchQuery.has_child).
+    parent_field = None
+
+    @staticmethod
+    def _routing_params(routing, request_params):
+        """
+        Add a routing value (or list of values) to request_params.
+        """
+        if routing is not None:
+            if isinstance(routing, (list, tuple, set)):
+                routing = ','.join(sorted(unicode(value) for value in routing))
+            request_params['es_routing'] = routing
+        return request_params
+
+    @classmethod
+    def _document_routing(cls, routing, request_params, parent=None):
+        """
+        Add the routing value and parent id of one document to
+        request_params. Document requests hash their routing value as one
+        key, so unlike searches they take a single value; children are
+        routed by their parent id unless given a routing value.
+        """
+        if isinstance(routing, (list, tuple, set)):
+            if len(routing) != 1:
+                raise ValueError, "A document has one routing value, got %r" % (
+                        routing,)
+            routing = list(routing)[0]
+        if parent is not None:
+            request_params['es_parent'] = unicode(parent)
+        return cls._routing_params(routing, request_params)
+
+    @staticmethod
+    def _document_values(doc_ids, values, description):
+        """
+        Return one value per document id from values: one value for all
+        documents, a list of values matching doc_ids, or a { doc id: value }
+        dict.
+        """
+        if isinstance(values, dict):
+            return [ values.get(doc_id) for doc_id in doc_ids ]
+        if isinstance(values, (list, tuple)):
+            if len(values) != len(doc_ids):
+                raise ValueError, "Got %d %s for %d documents" % (len(values),
+                        description, len(doc_ids))
+            return values
+        if isinstance(values, set):
+            raise ValueError, "The %s of several documents must be a list \
+matching their ids or a dict" % description
+        return [ values ] * len(doc_ids)
+
+    @classmethod
+    def _multi_get_docs(cls, doc_ids, routing=None, parent=None, index=None):
+        """
+        Return the multi get "docs" entries of doc_ids, each with its own
+        routing value, parent id and index (see _document_values).
+        """
+        doc_ids = list(doc_ids)
+        if routing is None and parent is None and index is None:
+            return doc_ids
+        docs = []
+        for doc_id, routing_value, parent_id, doc_index in zip(doc_ids,
+                cls._document_values(doc_ids, routing, 'routing values'),
+                cls._document_values(doc_ids, parent, 'parent ids'),
+                cls._document_values(doc_ids, index, 'indices')):
+            doc = { const.ID: doc_id }
+            if routing_value is not None:
+                doc[const.ROUTING] = unicode(routing_value)
+            if parent_id is not None:
+                doc[const.PARENT] = unicode(parent_id)
+            if doc_index is not None:
+                doc[const.INDEX_META] = doc_index
+            docs.append(doc)
+        return docs
+
+    @staticmethod
+    def _field_value(doc, path, description):
+        value = doc
+        for name in path.split('.'):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is None:
+            raise exception.InvalidDocument, "Document has no %s in %s: %r" % (
+                    description, path, doc)
+        return unicode(value)
+
+    @classmethod
+    def routing_for(cls, doc):
+        """
+        Return the routing value of a document, from its routing_field, or
+        None.
+        """
+        if cls.routing_field is None:
+            return None
+        return cls._field_value(doc, cls.routing_field, 'routing value')
+
+    @classmethod
+    def parent_for(cls, doc):
+        """
+        Return the parent id of a document, from its parent_field, or None.
+        """
+        if cls.parent_field is None:
+            return None
+        return cls._field_value(doc, cls.parent_field, 'parent id')
+
+    @classmethod
+    def _decode_sources(cls, sources, decode=None):
+        """
+        Convert date and number fields of the given sources in place, using
+        the decoders compiled from the class mappings. Dates with a UTC offset
+        become naive UTC datetimes; values matching none of a field's formats
+        are left unchanged.
+        """
+        if decode is None:
+            decode = cls.decode_results
+        if not decode:
+            return sources
+        decoders = cls._decoders
+        for source in sources:
+            doc_decoders = decoders.get(source.get(const.TYPE))
+            if doc_decoders:
+                decode_source(source, doc_decoders)
+        return sources
+
     @classmethod
-    def wrap_es_docs(cls, docs):
+    def wrap_es_docs(cls, docs, decode=None):
         """
         Convert result JSON "sources" ResultSet object.
+        :param decode: if True, convert mapped date and number fields to Python
+            objects. Defaults to the class "decode_results" setting.
         """
         result_set = ResultSet()
+        sources = []
         for doc in docs:
             source = doc[const.SOURCE]
             source[const.ID] = doc[const.ID]
             source[const.TYPE] = doc[const.TYPE]
-            result_set.documents.append(JsonDocument(source))
+            sources.append(source)
+        cls._decode_sources(sources, decode)
+        result_set.documents = [ JsonDocument(source) for source in sources ]
         return result_set
 
     @classmethod
-    def get(cls, doc_id, doc_type=None, return_raw=False, **request_params):
+    def get(cls, doc_id, doc_type=None, return_raw=False, decode=None,
+            routing=None, parent=None, index=None, **request_params):
         """
         Get one document by id.
         :param doc_id: the document id string to retrieve.
         :param return_raw: if True, return pyelasticsearch response.
+        :param decode: if True, convert mapped date and number fields.
+        :param routing: routing value the document was indexed with.
+        :param parent: parent id of a child document.
+        :param index: index holding the document; defaults to index_name.
         :param request_params: pyelasticsearch request arguments.
         """
+        cls._document_routing(routing, request_params, parent)
         if doc_type is None:
             if cls.doc_type:
                 doc_type = cls.doc_type
             else:
                 raise ValueError, "No document type specified"
-        try:
-            doc = cls.connection.get(cls.index_name, doc_type,
-                    doc_id, **request_params)
-        except ElasticHttpNotFoundError:
-            return None
-        source = doc[const.SOURCE]
-        source[const.ID] = doc[const.ID]
-        source[const.TYPE] = doc[const.TYPE]
-        if return_raw:
-            return source
-        return JsonDocument(source)
+        index = index or cls.index_name
+        with instrument.request('get', cls, index) as event:
+            try:
+                doc = event.send(cls.connection.get, index, doc_type,
+                        doc_id, **request_params)
+            except ElasticHttpNotFoundError:
+                event.hits = 0
+                return None
+            event.hits = 1
+            source = doc[const.SOURCE]
+            source[const.ID] = doc[const.ID]
+            source[const.TYPE] = doc[const.TYPE]
+            if return_raw:
+                return source
+            event.start_wrap()
+            cls._decode_sources([source], decode)
+            document = JsonDocument(source)
+            event.end_wrap()
+            return document
 
     @classmethod
     def _has_field(cls, field_name):
@@ -170,26 +413,43 @@ class SearchModel(object):
         return hasattr(cls, field_name)
 
     @classmethod
-    def multi_get(cls, doc_ids, doc_type=None, return_raw=False,
-            **request_params):
+    def multi_get(cls, doc_ids, doc_type=None, return_raw=False, decode=None,
+            routing=None, parent=None, index=None, **request_params):
         """
         Get documents by their ids.
         :param doc_ids: list of document id strings to retrieve.
         :param return_raw: if True, return pyelasticsearch response.
+        :param decode: if True, convert mapped date and number fields.
+        :param routing: routing value the documents were indexed with: one
+            value for all of them, a list of values matching doc_ids, or a
+            { doc id: value } dict.
+        :param parent: parent ids of child documents, in the same forms.
+        :param index: indices holding the documents, in the same forms;
+            defaults to index_name.
         :param request_params: pyelasticsearch request arguments.
         """
+        if isinstance(index, basestring):
+            default_index, index = index, None
+        else:
+            default_index = cls.index_name
+        docs = cls._multi_get_docs(doc_ids, routing, parent, index)
         if doc_type is None:
             if cls.doc_type:
                 doc_type = cls.doc_type
             else:
                 raise ValueError, "No document type specified"
-        doc = cls.connection.multi_get(doc_ids, index=cls.index_name,
-                doc_type=doc_type, **request_params)
-        if return_raw:
-            return doc
-        result_set = cls.wrap_es_docs(doc[const.DOCS])
-        result_set.total = len(result_set.documents)
-        return result_set
+        with instrument.request('multi_get', cls, default_index,
+                doc_ids) as event:
+            doc = event.send(cls.connection.multi_get, docs,
+                    index=default_index, doc_type=doc_type, **request_params)
+            if return_raw:
+                return doc
+            event.start_wrap()
+            result_set = cls.wrap_es_docs(doc[const.DOCS], decode)
+            event.end_wrap()
+            result_set.total = len(result_set.documents)
+            event.hits = result_set.total
+            return result_set
 
     @classmethod
     def index(cls, doc, doc_id=None, doc_type=None, **request_params):
@@ -204,7 +464,7 @@ class SearchModel(object):
         if isinstance(doc, JsonDocument):
             doc = doc._document
         elif not isinstance(doc, dict):
-            raise exceptions.InvalidDocument("Must index a dictionary or \
+            raise exception.InvalidDocument("Must index a dictionary or \
 JsonObject instance")
         if doc_id is None and const.ID in doc:
             doc_id = doc[const.ID]
@@ -220,15 +480,24 @@ JsonObject instance")
             else:
                 raise ValueError, "No document type specified"
 
-        response = cls.connection.index(cls.index_name, doc_type, doc,
-                id=doc_id, **request_params)
+        index_name = cls.write_index(doc)
+        cls._routing_params(cls.routing_for(doc), request_params)
+        parent = cls.parent_for(doc)
+        if parent is not None:
+            request_params['es_parent'] = parent
+        with instrument.request('index', cls, index_name, doc) as event:
+            event.hits = 1
+            response = event.send(cls.connection.index, index_name,
+                    doc_type, doc, id=doc_id, **request_params)
         if response[const.OK]:
             if update_fields:
                 cls.initialize_search_fields(force_reload=True)
-            cls.connection.refresh()
+            cls.refresh()
+            if cls._percolator is not None:
+                cls._percolator.notify([ (response[const.ID], doc) ], doc_type)
             return response[const.ID]
         else:
-            raise exceptions.IndexDocumentError("Failed to index doc.\
+            raise exception.IndexDocumentError("Failed to index doc.\
 ES response: " + str(response))
 
     @classmethod
@@ -245,7 +514,7 @@ ES response: " + str(response))
             docs = [ doc._document if isinstance(doc, JsonDocument) else doc
                     for doc in docs ]
         else:
-            raise exceptions.InvalidDocument("Must index a list/set of dicts \
+            raise exception.InvalidDocument("Must index a list/set of dicts \
 or JsonObject instances")
         if doc_type is None:
             if isinstance(cls.doc_type, (str, unicode)):
@@ -259,20 +528,256 @@ or JsonObject instances")
             if not cls._has_field(field_name):
                 update_fields = True
 
-        response = cls.connection.bulk_index(cls.index_name, doc_type, docs,
-                id_field, **request_params)
+        actions = [ (bulk.action(const.INDEX, cls.write_index(doc), doc_type,
+            doc.get(id_field), routing=cls.routing_for(doc),
+            parent=cls.parent_for(doc)), doc) for doc in docs ]
+        with instrument.request('bulk_index', cls, cls.index_name,
+                docs) as event:
+            event.hits = len(docs)
+            response = event.send(bulk.send, cls.connection, actions,
+                    **request_params)
         items = response[const.ITEMS]
-        if not all(item[const.INDEX][const.OK] for item in items):
-            raise exceptions.IndexDocumentError("Failed to bulk index docs.\
+        if not all(bulk.succeeded(item) for item in items):
+            raise exception.IndexDocumentError("Failed to bulk index docs.\
 ES response: " + str(response))
 
         ids = [ item[const.INDEX][const.ID] for item in items ]
         if update_fields:
             cls.initialize_search_fields(force_reload=True)
 
-        cls.connection.refresh()
+        cls.refresh()
+        if cls._percolator is not None:
+            cls._percolator.notify(zip(ids, docs), doc_type)
+        return ids
+
+    @classmethod
+    def reindex_to(cls, target_index, transform=None, **kwargs):
+        """
+        Copy all documents into target_index (created with the current
+        mappings if missing) and return a reindex.Progress.
+        :param transform: function of a document source returning the document
+            to write, or None to skip it.
+        :param kwargs: reindex.reindex arguments: doc_type, chunk_size,
+            workers, checkpoint, progress, scroll_timeout.
+        """
+        return reindex.reindex(cls, target_index, transform, **kwargs)
+
+    @classmethod
+    def dump(cls, path, doc_type=None, **kwargs):
+        """
+        Write all documents to a newline-delimited JSON file of bulk actions,
+        gzip compressed if path ends in ".gz". Return the document count.
+        :param doc_type: document type(s) to dump; defaults to all.
+        :param kwargs: snapshot.dump arguments: chunk_size, scroll_timeout.
+        """
+        return snapshot.dump(cls, path, doc_type, **kwargs)
+
+    @classmethod
+    def load(cls, path, index=None, **kwargs):
+        """
+        Bulk index a file written by dump. Return the document count.
+        :param index: index to load into; defaults to the class index.
+        :param kwargs: snapshot.load arguments: chunk_bytes.
+        """
+        count = snapshot.load(cls, path, index, **kwargs)
+        if index is None:
+            cls.initialize_search_fields(force_reload=True)
+        return count
+
+    @classmethod
+    def bulk_ingest(cls, docs, doc_type=None, id_field=const.ID,
+            chunk_size=500, max_retries=bulk.DEFAULT_MAX_RETRIES,
+            backoff=bulk.DEFAULT_BACKOFF, max_backoff=bulk.DEFAULT_MAX_BACKOFF,
+            dead_letter=None, **request_params):
+        """
+        Index documents in chunked bulk requests, resending only rejected or
+        throttled items with exponential backoff and jitter. A generator:
+        yields the ids of indexed documents as requests complete.
+        :param docs: iterable of document dictionaries / JsonObjects.
+        :param chunk_size: documents per bulk request.
+        :param max_retries: times an item is resent before it is given up on.
+        :param backoff: base delay in seconds, doubled on each retry.
+        :param max_backoff: maximum delay in seconds.
+        :param dead_letter: function called with (action, doc, response item)
+            for documents that could not be indexed; without it they raise
+            IndexDocumentError.
+        :param request_params: pyelasticsearch request arguments.
+        """
+        if doc_type is None:
+            if isinstance(cls.doc_type, (str, unicode)):
+                doc_type = cls.doc_type
+            else:
+                raise ValueError, "No document type specified"
+
+        def sender(connection, actions, **request_params):
+            with instrument.request('bulk_index', cls, cls.index_name,
+                    [ doc for _, doc in actions ]) as event:
+                event.hits = len(actions)
+                return event.send(bulk.send, connection, actions,
+                        **request_params)
+
+        def chunks():
+            chunk = []
+            for doc in docs:
+                if isinstance(doc, JsonDocument):
+                    doc = doc._document
+                chunk.append((bulk.action(const.INDEX, cls.write_index(doc),
+                    doc_type, doc.get(id_field), routing=cls.routing_for(doc),
+                    parent=cls.parent_for(doc)), doc))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        update_fields = False
+        for actions in chunks():
+            update_fields = update_fields or not all(cls._has_field(name)
+                for _, doc in actions for name in doc)
+            indexed = []
+            for _, doc, item in bulk.send_retrying(cls.connection, actions,
+                    max_retries, backoff, max_backoff, dead_letter,
+                    sender=sender, **request_params):
+                doc_id = item[const.INDEX][const.ID]
+                indexed.append((doc_id, doc))
+                yield doc_id
+            if cls._percolator is not None and indexed:
+                cls.refresh()
+                cls._percolator.notify(indexed, doc_type)
+        if update_fields:
+            cls.initialize_search_fields(force_reload=True)
+        cls.refresh()
+
+    @classmethod
+    def write_index(cls, doc):
+        """
+        Return the name of the index a document is written to.
+        """
+        return cls.index_name
+
+    @classmethod
+    def query_indices(cls, query):
+        """
+        Return the index name(s) a SearchQuery needs to search.
+        """
+        return cls.index_name
+
+    @classmethod
+    def refresh(cls):
+        """
+        Refresh the class index, making recent changes searchable.
+        """
+        with instrument.request('refresh', cls, cls.index_name) as event:
+            return event.send(cls.connection.refresh, cls.index_name)
+
+    @classmethod
+    def update(cls, doc_id, partial=None, script=None, params=None,
+            upsert=None, doc_type=None, version=None, retry_on_conflict=None,
+            routing=None, index=None, parent=None, **request_params):
+        """
+        Update one document in place with a partial document or a script,
+        and return its new version.
+        :param partial: partial document merged into the existing document.
+        :param script: script updating the document, with params.
+        :param upsert: document to create if none exists; True creates the
+            partial document instead.
+        :param version: fail with a version conflict (409) unless the document
+            has this version.
+        :param retry_on_conflict: times ES retries the update on conflicting
+            concurrent changes.
+        :param routing: routing value the document was indexed with.
+        :param index: index holding the document; defaults to index_name.
+        :param parent: parent id of a child document.
+        :param request_params: pyelasticsearch request arguments.
+        """
+        if doc_type is None:
+            if isinstance(cls.doc_type, (str, unicode)):
+                doc_type = cls.doc_type
+            else:
+                raise ValueError, "No document type specified"
+        index = index or cls.index_name
+        body = bulk.update_body(partial, script, params, upsert)
+        cls._document_routing(routing, request_params, parent)
+        request_params.update(es_version=version,
+                es_retry_on_conflict=retry_on_conflict)
+        query_params = dict((key, value) for key, value
+            in bulk.query_params(request_params).iteritems()
+            if value is not None)
+        with instrument.request('update', cls, index, body) as event:
+            response = event.send(cls.connection.send_request, 'POST',
+                    [ index, doc_type, doc_id, bulk.UPDATE ], body,
+                    query_params=query_params)
+        if cls._has_new_fields(body):
+            cls.initialize_search_fields(force_reload=True)
+        cls.refresh()
+        return response[const.VERSION]
+
+    @classmethod
+    def bulk_update(cls, updates, doc_type=None, chunk_size=500,
+            **request_params):
+        """
+        Apply updates in chunked bulk requests; updates may be a generator.
+        Return the updated document ids.
+        :param updates: dicts with an "_id" and update arguments: partial,
+            script, params, upsert, version, retry_on_conflict, routing,
+            parent, index (defaults to index_name).
+        :param chunk_size: updates per bulk request.
+        :param request_params: pyelasticsearch request arguments.
+        """
+        if doc_type is None:
+            if isinstance(cls.doc_type, (str, unicode)):
+                doc_type = cls.doc_type
+            else:
+                raise ValueError, "No document type specified"
+        def chunks():
+            chunk = []
+            for update in updates:
+                update = dict(update)
+                action = bulk.action(const.UPDATE,
+                    update.pop('index', None) or cls.index_name, doc_type,
+                    update.pop(const.ID), version=update.pop('version', None),
+                    retry_on_conflict=update.pop('retry_on_conflict', None),
+                    routing=update.pop('routing', None),
+                    parent=update.pop('parent', None))
+                chunk.append((action, bulk.update_body(**update)))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        ids = []
+        update_fields = False
+        for actions in chunks():
+            with instrument.request('bulk_update', cls, cls.index_name,
+                    actions) as event:
+                event.hits = len(actions)
+                response = event.send(bulk.send, cls.connection, actions,
+                        **request_params)
+            items = response[const.ITEMS]
+            if not all(bulk.succeeded(item) for item in items):
+                raise exception.UpdateIndexError("Failed to bulk update docs.\
+ ES response: " + str(response))
+            ids.extend(item[const.UPDATE][const.ID] for item in items)
+            update_fields = update_fields or any(cls._has_new_fields(body)
+                for _, body in actions)
+        if update_fields:
+            cls.initialize_search_fields(force_reload=True)
+        if ids:
+            cls.refresh()
         return ids
 
+    @classmethod
+    def _has_new_fields(cls, update_body):
+        """
+        Return True if an update body adds fields the model doesn't have.
+        """
+        for key in (bulk.DOC, bulk.UPSERT):
+            if isinstance(update_body.get(key), dict) and not all(
+                    cls._has_field(name) for name in update_body[key]):
+                return True
+        return False
+
     @classmethod
     def save(cls, doc_type, doc, doc_id=None, **request_params):
         """
@@ -281,17 +786,25 @@ ES response: " + str(response))
         return cls.index(doc_type, doc, id=doc_id, **request_params)
 
     @classmethod
-    def delete(cls, doc_type, doc_id, **request_params):
+    def delete(cls, doc_type, doc_id, routing=None, index=None, parent=None,
+            **request_params):
         """
         Delete one document by its document type and id.
+        :param routing: routing value the document was indexed with.
+        :param index: index holding the document; defaults to index_name.
+        :param parent: parent id of a child document.
         """
+        cls._document_routing(routing, request_params, parent)
+        index = index or cls.index_name
 
-        response = cls.connection.delete(cls.index_name, doc_type, doc_id,
-                **request_params)
+        with instrument.request('delete', cls, index) as event:
+            response = event.send(cls.connection.delete, index,
+                    doc_type, doc_id, **request_params)
         if response[const.OK]:
+            cls.deleted(doc_type, [ doc_id ])
             return True
         else:
-            raise exceptions.DeleteDocumentError("Failed to delete doc %s: %s" %
+            raise exception.DeleteDocumentError("Failed to delete doc %s: %s" %
                     (doc_id, str(response)))
 
     @classmethod
@@ -299,12 +812,13 @@ ES response: " + str(response))
         """
         Delete all documents of a given type.
         """
-        response = cls.connection.delete_all(cls.index_name, doc_type,
-                **request_params)
+        with instrument.request('delete_all', cls, cls.index_name) as event:
+            response = event.send(cls.connection.delete_all, cls.index_name,
+                    doc_type, **request_params)
         if response[const.OK]:
             return True
         else:
-            raise exceptions.DeleteDocumentError("Failed to delete doc type %s:\
+            raise exception.DeleteDocumentError("Failed to delete doc type %s:\
 %s" % (doc_type, str(response)))
 
     """Querying"""
@@ -316,53 +830,212 @@ ES response: " + str(response))
         return SearchQuery(cls)
 
     @classmethod
-    def search(cls, query, return_raw=False):
+    def add_warmup_query(cls, query):
+        """
+        Register a SearchQuery for bungee.warmup() to run, e.g. one whose
+        sorts or facets load field data, so the first user request is fast.
+        """
+        cls._warmup_queries.append(query)
+
+    @classmethod
+    def search(cls, query, return_raw=False, decode=None, index=None,
+            routing=None, **event_details):
         """
         Run one search and return a tuple of (total result count, result data).
         :param query: dict of raw ElasticSearch API query parameters
         :param return_raw: if True, return pyelasticsearch response.
+        :param decode: if True, convert mapped date and number fields.
+        :param index: index name or list of names to search; defaults to the
+            class index. Missing indices in a list are ignored.
+        :param routing: routing value(s) selecting the shards to search.
+        :param event_details: extra details for instrumentation events.
+        """
+        index, request_params = cls._search_indices(index)
+        cls._routing_params(routing, request_params)
+        with instrument.request('search', cls, index, query,
+                **event_details) as event:
+            results = event.send(cls.connection.search, query,
+                    index=index, doc_type=cls.doc_type, **request_params)
+            if return_raw:
+                return results
+            event.start_wrap()
+            result_set = cls._wrap_search_results(results, decode)
+            event.end_wrap()
+            return result_set
+
+    @classmethod
+    def search_template(cls, template, return_raw=False, decode=None,
+            index=None, routing=None):
+        """
+        Run one search with the ES search template API.
+        :param template: dict with "template" and "params" keys, e.g. from
+            QueryTemplate.server_body.
+        :param return_raw: if True, return pyelasticsearch response.
+        :param decode: if True, convert mapped date and number fields.
+        :param index: index name or list of names to search; defaults to the
+            class index. Missing indices in a list are ignored.
+        :param routing: routing value(s) selecting the shards to search.
+        """
+        connection = cls.connection
+        index, request_params = cls._search_indices(index)
+        cls._routing_params(routing, request_params)
+        with instrument.request('search_template', cls, index,
+                template) as event:
+            results = event.send(connection.send_request, 'GET', [
+                connection._concat(index),
+                connection._concat(cls.doc_type), '_search', const.TEMPLATE ],
+                template, query_params=bulk.query_params(request_params))
+            if return_raw:
+                return results
+            event.start_wrap()
+            result_set = cls._wrap_search_results(results, decode)
+            event.end_wrap()
+            return result_set
+
+    @classmethod
+    def _wrap_search_results(cls, results, decode=None):
+        """
+        Convert a search API response to a ResultSet.
         """
-        results = cls.connection.search(query, index=cls.index_name,
-                doc_type=cls.doc_type)
-        if return_raw:
-            return results
         total = results[const.HITS][const.TOTAL]
         hits = results[const.HITS][const.HITS]
         facets = results.get(const.FACETS)
-        result_set = cls.wrap_es_docs(hits)
+        aggregations = results.get(aggregation.AGGREGATIONS)
+        result_set = cls.wrap_es_docs(hits, decode)
         result_set.total = total
         if facets:
             result_set.facets = JsonDocument(facets)
+        if aggregations:
+            result_set.aggregations = JsonDocument(aggregations)
         return result_set
 
     @classmethod
-    def count(cls, query, **request_params):
+    def _search_indices(cls, index):
+        """
+        Return (index, request params) for a search or count on the given
+        index name(s).
+        """
+        if index is None:
+            return cls.index_name, {}
+        if isinstance(index, (list, tuple)):
+            return list(index), { 'es_ignore_indices': 'missing' }
+        return index, {}
+
+    @classmethod
+    def count(cls, query, index=None, routing=None, terminate_after=None,
+            **request_params):
         """
         Run one count request with given query, class index and doc type(s).
         :param query: dict of raw ElasticSearch API query parameters
+        :param index: index name or list of names to count in; defaults to
+            the class index. Missing indices in a list are ignored.
+        :param routing: routing value(s) selecting the shards to count in.
+        :param terminate_after: stop counting on each shard after this many
+            matches (ES 1.4+); the count is then a lower bound.
         :param request_params: pyelasticsearch request arguments.
         """
-        count = cls.connection.count(query, index=cls.index_name,
-                doc_type=cls.doc_type, **request_params)
+        index, index_params = cls._search_indices(index)
+        request_params.update(index_params)
+        cls._routing_params(routing, request_params)
+        if terminate_after is not None:
+            request_params['es_terminate_after'] = terminate_after
+        with instrument.request('count', cls, index, query) as event:
+            count = event.send(cls.connection.count, query,
+                    index=index, doc_type=cls.doc_type, **request_params)
         return count[const.COUNT]
 
     @classmethod
-    def delete_by_query(cls, doc_type, query, **request_params):
+    def delete_by_query(cls, doc_type, query, index=None, routing=None,
+            **request_params):
         """
         Delete documents that match the given query.
         :param doc_type: string document type to query against.
         :param query: dictionary of raw ElasticSearch API query parameters
+        :param index: index name or list of names to delete from; defaults
+            to the class index. Missing indices in a list are ignored.
+        :param routing: routing value(s) selecting the shards to delete from.
         :param request_params: pyelasticsearch request arguments.
         """
-        response = cls.connection.delete_by_query(cls.index_name, doc_type,
-                query, **request_params)
+        index, index_params = cls._search_indices(index)
+        request_params.update(index_params)
+        cls._routing_params(routing, request_params)
+        with instrument.request('delete_by_query', cls, index,
+                query) as event:
+            response = event.send(cls.connection.delete_by_query,
+                    index, doc_type, query, **request_params)
         if response[const.OK]:
             return True
         else:
-            raise exceptions.DeleteDocumentError("Failed to delete by query %s:\
+            raise exception.DeleteDocumentError("Failed to delete by query %s:\
 \n%s" % (query, str(response)))
 
 
+    @classmethod
+    def add_delete_listener(cls, listener):
+        """
+        Call listener(doc_type, doc_ids) when documents are deleted by id
+        through this class (delete, or a throttled SearchQuery.delete), e.g.
+        to invalidate client-side caches. Deletes by query can't report ids.
+        """
+        cls._delete_listeners.append(listener)
+
+    @classmethod
+    def remove_delete_listener(cls, listener):
+        cls._delete_listeners.remove(listener)
+
+    @classmethod
+    def deleted(cls, doc_type, doc_ids):
+        """
+        Notify delete listeners of deleted document ids.
+        """
+        for listener in list(cls._delete_listeners):
+            listener(doc_type, doc_ids)
+
+    """Percolation"""
+    @classmethod
+    def percolator(cls):
+        """
+        Return the class Percolator, holding its registered queries.
+        """
+        if cls._percolator is None:
+            cls._percolator = Percolator(cls)
+        return cls._percolator
+
+    @classmethod
+    def register_query(cls, query_id, query):
+        """
+        Register a SearchQuery for percolation. Documents indexed through
+        this class are matched against it (see add_percolate_listener).
+        :param query_id: hashable id returned by percolate for matches.
+        :param query: SearchQuery (or raw query body) to match documents with.
+        """
+        cls.percolator().register(query_id, query)
+
+    @classmethod
+    def unregister_query(cls, query_id):
+        cls.percolator().unregister(query_id)
+
+    @classmethod
+    def add_percolate_listener(cls, listener):
+        """
+        Call listener(doc_id, doc, query_ids) for each document indexed or
+        bulk indexed through this class that matches registered queries.
+        """
+        cls.percolator().add_listener(listener)
+
+    @classmethod
+    def percolate(cls, doc, doc_type=None):
+        """
+        Return the ids of registered queries matching a document, evaluated
+        locally without a request to ElasticSearch.
+        :param doc: dictionary / JsonDocument to match.
+        :param doc_type: string document type whose mapping applies.
+        """
+        if isinstance(doc, JsonDocument):
+            doc = doc._document
+        return cls.percolator().percolate(doc, doc_type)
+
+
     """Misc."""
     @classmethod
     def put_mapping(cls, doc_type, mapping, ignore_conflicts=False):
@@ -373,12 +1046,14 @@ ES response: " + str(response))
         :param mapping: dictionary with ElasticSearch field mappings.
         :param ignore_conflicts: if True, new mappings will replace old ones.
         """
-        response = cls.connection.put_mapping(cls.index_name, doc_type,
-                mapping, ignore_conflicts=ignore_conflicts)
+        with instrument.request('put_mapping', cls, cls.index_name,
+                mapping) as event:
+            response = event.send(cls.connection.put_mapping, cls.index_name,
+                    doc_type, mapping, ignore_conflicts=ignore_conflicts)
         if response[const.OK]:
             cls.initialize_search_fields(force_reload=True)
             return True
         else:
-            raise exceptions.UpdateIndexError("Failed to put mapping: " +
+            raise exception.UpdateIndexError("Failed to put mapping: " +
                     str(response))
 
@@ -0,0 +1,307 @@
+"""
+This module contains an optimizer pass over compiled filter expressions.
+
+Given the list of filters that SearchQuery places under an "and" or "or"
+filter, optimize_filters returns an equivalent list with:
+    - duplicate filters dropped
+    - term/terms filters on one field merged ("or")
+    - range filters on one field intersected ("and"), when their bounds are
+      numbers or absolute dates the field's decoder parses
+    - cheap filters ordered ahead of expensive ones
+    - caching disabled for range filters relative to "now"
+along with a list of notes describing each change.
+"""
+import json
+
+import const
+import geo
+from field import (FILTER_TERM, FILTER_TERMS, FILTER_RANGE, FILTER_EXISTS,
+        FILTER_MISSING, FILTER_NOT, FILTER_GT, FILTER_GTE, FILTER_LT,
+        FILTER_LTE, FILTER_FROM, FILTER_TO)
+from template import Param
+
+CACHE = '_cache'
+
+# Relative cost of evaluating each filter type; lower runs first.
+FILTER_COSTS = {
+    FILTER_TERM: 0,
+    FILTER_TERMS: 1,
+    FILTER_EXISTS: 1,
+    FILTER_MISSING: 1,
+    FILTER_RANGE: 2,
+    geo.GEO_BOUNDING_BOX: 2,
+    FILTER_NOT: 3,
+    const.AND: 3,
+    const.OR: 3,
+    const.BOOL: 3,
+    # Distance and polygon filters test every candidate point
+    geo.GEO_DISTANCE: 5,
+    geo.GEO_POLYGON: 5,
+}
+DEFAULT_FILTER_COST = 4
+
+LOWER_BOUNDS = (FILTER_GT, FILTER_GTE)
+UPPER_BOUNDS = (FILTER_LT, FILTER_LTE)
+
+
+def filter_key(expression):
+    """
+    Return a hashable, order-independent key for a filter expression.
+    """
+    return json.dumps(expression, sort_keys=True, default=repr)
+
+
+def filter_type(expression):
+    """
+    Return (type, field name, value) for single-field term, terms and range
+    filters, or (type, None, None) for anything else.
+    """
+    if len(expression) != 1:
+        return None, None, None
+    ftype, body = expression.items()[0]
+    if ftype in (FILTER_TERM, FILTER_TERMS, FILTER_RANGE):
+        if isinstance(body, dict) and len(body) == 1:
+            field, value = body.items()[0]
+            return ftype, field, value
+    return ftype, None, None
+
+
+def is_concrete(value):
+    """
+    Return True if value can be compared at optimization time.
+    """
+    return value is not None and not isinstance(value, (Param, dict, list))
+
+
+def is_date_math(value):
+    """
+    Return True if a range bound is ES date math, e.g. "now-7d" or
+    "2014-01-01||+1M", which only ES can resolve.
+    """
+    return isinstance(value, basestring) and (value.startswith('now')
+            or '||' in value)
+
+
+def field_decoder(decoders, field):
+    """
+    Return the decoder of a field path from a list of decoder trees (see
+    codec.compile_decoders), or None.
+    """
+    for tree in decoders or ():
+        decoder = tree
+        for name in field.split('.'):
+            decoder = decoder.get(name) if isinstance(decoder, dict) else None
+        if decoder is not None and not isinstance(decoder, dict):
+            return decoder
+    return None
+
+
+def comparable(bound, decode):
+    """
+    Return the value a range bound is compared by: numbers as they are,
+    strings as parsed by the field's decoder (absolute dates). Returns None
+    for date math and strings the decoder doesn't parse.
+    """
+    if isinstance(bound, (int, long, float)) and not isinstance(bound, bool):
+        return bound
+    if (isinstance(bound, basestring) and decode is not None
+            and not is_date_math(bound)):
+        value = decode(bound)
+        if not isinstance(value, basestring):
+            return value
+    return None
+
+
+def range_bounds(value, decode=None):
+    """
+    Return the list of (operator, bound, comparable value) of a range filter
+    body, with from/to converted to gte/lte. Returns None for ranges the
+    optimizer does not understand.
+    """
+    bounds = []
+    for op, bound in value.items():
+        if op == FILTER_FROM:
+            op = FILTER_GTE
+        elif op == FILTER_TO:
+            op = FILTER_LTE
+        elif op not in LOWER_BOUNDS and op not in UPPER_BOUNDS:
+            return None
+        if bound is None:
+            continue
+        key = comparable(bound, decode)
+        if key is None:
+            return None
+        bounds.append((op, bound, key))
+    return bounds
+
+
+def tighter(current, candidate, lower):
+    """
+    Return the tighter of two (operator, bound, comparable value) triples.
+    """
+    if current is None:
+        return candidate
+    if type(current[2]) != type(candidate[2]):
+        if not all(isinstance(key, (int, long, float))
+                for _, _, key in (current, candidate)):
+            raise TypeError, "Cannot compare range bounds"
+    if current[2] == candidate[2]:
+        # Exclusive bounds are tighter than inclusive ones
+        exclusive = FILTER_GT if lower else FILTER_LT
+        return current if current[0] == exclusive else candidate
+    if lower:
+        return current if current[2] > candidate[2] else candidate
+    return current if current[2] < candidate[2] else candidate
+
+
+def intersect_ranges(field, values, notes, decoders=None):
+    """
+    Return one range filter body equivalent to all the given range bodies, or
+    None if they cannot be combined.
+    :param decoders: decoder trees parsing the field's string bounds.
+    """
+    decode = field_decoder(decoders, field)
+    lower = upper = None
+    for value in values:
+        bounds = range_bounds(value, decode)
+        if bounds is None:
+            return None
+        try:
+            for bound in bounds:
+                if bound[0] in LOWER_BOUNDS:
+                    lower = tighter(lower, bound, True)
+                else:
+                    upper = tighter(upper, bound, False)
+        except TypeError:
+            return None
+    merged = {}
+    for bound in (lower, upper):
+        if bound is not None:
+            merged[bound[0]] = bound[1]
+    notes.append("intersected %d range filters on '%s' into %s" % (
+            len(values), field, merged))
+    return merged
+
+
+def merge_terms(field, expressions, notes):
+    """
+    Return one filter equivalent to the given term/terms filters on a field
+    joined by "or": the union of their values. Returns None if they cannot
+    be combined.
+    """
+    value_lists = []
+    for expression in expressions:
+        ftype, _, value = filter_type(expression)
+        values = [ value ] if ftype == FILTER_TERM else value
+        if not isinstance(values, list) or not all(
+                is_concrete(item) for item in values):
+            return None
+        value_lists.append(values)
+
+    merged = []
+    seen = set()
+    for values in value_lists:
+        for item in values:
+            if item not in seen:
+                seen.add(item)
+                merged.append(item)
+
+    if len(merged) == 1:
+        result = { FILTER_TERM: { field: merged[0] } }
+    else:
+        result = { FILTER_TERMS: { field: merged } }
+    notes.append("merged %d term filters on '%s' into %s" % (
+            len(expressions), field, result))
+    return result
+
+
+def uses_now(value):
+    """
+    Return True if a range body has a bound relative to the current time.
+    """
+    return any(isinstance(bound, basestring) and bound.startswith('now')
+            for bound in value.values())
+
+
+def optimize_filters(filters, conjunction=const.AND, decoders=None):
+    """
+    Return (filters, notes): an optimized equivalent of the filter list
+    joined by conjunction ("and" or "or"), and a list of strings describing
+    each change made.
+    :param decoders: decoder trees of the searched document types, used to
+        parse absolute date bounds of range filters.
+    """
+    notes = []
+
+    # Drop duplicates
+    unique = []
+    seen = set()
+    for expression in filters:
+        key = filter_key(expression)
+        if key in seen:
+            notes.append("dropped duplicate filter %s" % key)
+            continue
+        seen.add(key)
+        unique.append(expression)
+
+    # Group single-field term filters under "or" and range filters under
+    # "and". Terms under "and" are left alone: on fields holding several
+    # values, "t is a or b" and "t is b or c" both match [a, c].
+    term_groups = {}
+    range_groups = {}
+    for index, expression in enumerate(unique):
+        ftype, field, _ = filter_type(expression)
+        if field is None:
+            continue
+        if ftype == FILTER_RANGE:
+            if conjunction == const.AND:
+                range_groups.setdefault(field, []).append(index)
+        elif conjunction == const.OR:
+            term_groups.setdefault(field, []).append(index)
+
+    replaced = {}
+    for field, indexes in term_groups.items():
+        if len(indexes) < 2:
+            continue
+        merged = merge_terms(field, [ unique[index] for index in indexes ],
+                notes)
+        if merged is not None:
+            replaced[indexes[0]] = merged
+            for index in indexes[1:]:
+                replaced[index] = None
+    for field, indexes in range_groups.items():
+        if len(indexes) < 2:
+            continue
+        merged = intersect_ranges(field,
+                [ filter_type(unique[index])[2] for index in indexes ], notes,
+                decoders)
+        if merged is not None:
+            replaced[indexes[0]] = { FILTER_RANGE: { field: merged } }
+            for index in indexes[1:]:
+                replaced[index] = None
+
+    optimized = []
+    for index, expression in enumerate(unique):
+        expression = replaced.get(index, expression)
+        if expression is not None:
+            optimized.append(expression)
+
+    # Disable caching of ranges relative to "now"; they never repeat.
+    for index, expression in enumerate(optimized):
+        ftype, field, value = filter_type(expression)
+        if (ftype == FILTER_RANGE and isinstance(value, dict)
+                and uses_now(value)):
+            optimized[index] = { FILTER_RANGE: { field: value,
+                CACHE: False } }
+            notes.append("disabled caching of range filter on '%s'" % field)
+
+    # Cheap filters first (sorted is stable)
+    costs = [ FILTER_COSTS.get(expression.keys()[0], DEFAULT_FILTER_COST)
+            if len(expression) else DEFAULT_FILTER_COST
+            for expression in optimized ]
+    ordered = [ expression for _, _, expression in sorted(
+            zip(costs, range(len(optimized)), optimized)) ]
+    if ordered != optimized:
+        notes.append("reordered filters by cost")
+
+    return ordered, notes
@@ -0,0 +1,418 @@
+"""
+This module contains PartitionedSearchModel, for data split into one index
+per time period (e.g. daily indices):
+    class Event(PartitionedSearchModel):
+        index_name = 'events-*'
+        index_pattern = 'events-%Y.%m.%d'
+        partition_field = 'timestamp'
+        partition_interval = 'day'
+
+index_name names every partition (a wildcard or an alias); it is used for
+mappings, refreshes and unpruned searches. Documents are written to the
+index of their partition field value. Queries with range or term filters on
+the partition field only search the partitions overlapping the filtered
+window; date math bounds ("now-1d/d", "2013-05-01||+1M") are resolved
+against the UTC clock when the query is sent. Gets, updates and deletes take the document's partition field
+value (or its index):
+    Event.get('1', partition='2013-05-01T10:00:00')
+    Event.update('1', { 'name': 'relaunch' }, partition='2013-05-01T10:00:00')
+    Event.delete('event', '1', partition=datetime.date(2013, 5, 1))
+Without one, gets search every partition for the ids, which unlike the get
+API only sees documents once they are refreshed.
+"""
+import calendar
+import datetime
+import re
+
+import const
+import exception
+from codec import parse_date, strftime_formats
+from cost import find_mapping
+from field import (FILTER_TERM, FILTER_TERMS, FILTER_RANGE, FILTER_GT,
+        FILTER_GTE, FILTER_LT, FILTER_LTE, FILTER_FROM, FILTER_TO)
+from model import SearchModel
+from template import Param
+
+HOUR = 'hour'
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+YEAR = 'year'
+INTERVALS = (HOUR, DAY, WEEK, MONTH, YEAR)
+
+LOWER_BOUNDS = (FILTER_GT, FILTER_GTE, FILTER_FROM)
+UPPER_BOUNDS = (FILTER_LT, FILTER_LTE, FILTER_TO)
+
+# ES dates have millisecond resolution: "lt x" matches up to x - 1ms.
+MILLISECOND = datetime.timedelta(milliseconds=1)
+
+DATE_MATH_RE = re.compile(r'([+-])(\d+)([yMwdhHms])|/([yMwdhHms])')
+DATE_MATH_INTERVALS = { 'y': YEAR, 'M': MONTH, 'w': WEEK, 'd': DAY,
+        'h': HOUR, 'H': HOUR }
+DATE_MATH_DELTAS = { 'w': 'weeks', 'd': 'days', 'h': 'hours', 'H': 'hours',
+        'm': 'minutes', 's': 'seconds' }
+
+
+def floor_date(value, interval):
+    """
+    Return the start of the interval containing a datetime.
+    """
+    if interval == HOUR:
+        return value.replace(minute=0, second=0, microsecond=0)
+    value = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == WEEK:
+        return value - datetime.timedelta(days=value.weekday())
+    if interval == MONTH:
+        return value.replace(day=1)
+    if interval == YEAR:
+        return value.replace(month=1, day=1)
+    return value
+
+
+def next_date(value, interval):
+    """
+    Return the start of the interval following the one starting at value.
+    """
+    if interval == HOUR:
+        return value + datetime.timedelta(hours=1)
+    if interval == WEEK:
+        return value + datetime.timedelta(days=7)
+    if interval == MONTH:
+        if value.month == 12:
+            return value.replace(year=value.year + 1, month=1)
+        return value.replace(month=value.month + 1)
+    if interval == YEAR:
+        return value.replace(year=value.year + 1)
+    return value + datetime.timedelta(days=1)
+
+
+def shift_date(value, amount, unit):
+    """
+    Add amount date math units (y, M, w, d, h, H, m, s) to a datetime.
+    Like ES, adding months keeps the day within the month.
+    """
+    if unit in ('y', 'M'):
+        months = value.month - 1 + amount * (12 if unit == 'y' else 1)
+        year = value.year + months // 12
+        month = months % 12 + 1
+        return value.replace(year=year, month=month,
+                day=min(value.day, calendar.monthrange(year, month)[1]))
+    return value + datetime.timedelta(**{ DATE_MATH_DELTAS[unit]: amount })
+
+
+def round_date(value, unit, round_up=False):
+    """
+    Round a datetime down to the start of its date math unit, or with
+    round_up to the last millisecond of the unit.
+    """
+    if unit == 'm':
+        start = value.replace(second=0, microsecond=0)
+    elif unit == 's':
+        start = value.replace(microsecond=0)
+    else:
+        start = floor_date(value, DATE_MATH_INTERVALS[unit])
+    if not round_up:
+        return start
+    return shift_date(start, 1, unit) - MILLISECOND
+
+
+def resolve_date_math(value, mapping, round_up=False, now=None):
+    """
+    Resolve an ES date math string ("now-1d/d", "2013-05-01||+1M") to a
+    datetime, or None if it isn't valid date math. "now" is the current UTC
+    time. Rounding goes down, or up as ES does for gt and lte bounds.
+    """
+    if value.startswith('now'):
+        date = now or datetime.datetime.utcnow()
+        expression = value[len('now'):]
+    elif '||' in value:
+        anchor, expression = value.split('||', 1)
+        date = to_datetime(anchor, mapping)
+    else:
+        return None
+    position = 0
+    while date is not None and position < len(expression):
+        match = DATE_MATH_RE.match(expression, position)
+        if match is None:
+            return None
+        sign, amount, unit, rounding = match.groups()
+        if rounding:
+            date = round_date(date, rounding, round_up)
+        else:
+            date = shift_date(date, int(amount) if sign == '+'
+                    else -int(amount), unit)
+        position = match.end()
+    return date
+
+
+def to_datetime(value, mapping):
+    """
+    Convert a partition field value (datetime, date, epoch milliseconds or
+    a string in the mapping's format) to a datetime, or None.
+    """
+    if isinstance(value, datetime.datetime):
+        return value
+    if isinstance(value, datetime.date):
+        return datetime.datetime.combine(value, datetime.time())
+    if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        return datetime.datetime.utcfromtimestamp(value / 1000.0)
+    if isinstance(value, basestring):
+        parsed = parse_date(value, strftime_formats(mapping or {}))
+        if isinstance(parsed, datetime.datetime):
+            return parsed
+    return None
+
+
+def range_bound(key, value, clause, mapping, now=None):
+    """
+    Return the inclusive datetime bound of one range filter bound, or None
+    if it can't be resolved on the client: params, and strings interpreted
+    in a time_zone.
+    """
+    if isinstance(value, Param):
+        return None
+    if isinstance(value, basestring) and clause.get('time_zone'):
+        return None
+    exclusive = key in (FILTER_GT, FILTER_LT) or (key == FILTER_FROM
+            and not clause.get('include_lower', True)) or (key == FILTER_TO
+            and not clause.get('include_upper', True))
+    lower = key in LOWER_BOUNDS
+    if isinstance(value, basestring) and (value.startswith('now')
+            or '||' in value):
+        # ES rounds gt and lte bounds up, gte and lt bounds down.
+        date = resolve_date_math(value, mapping, lower == exclusive, now)
+    else:
+        date = to_datetime(value, mapping)
+    if date is None or not exclusive:
+        return date
+    return date + MILLISECOND if lower else date - MILLISECOND
+
+
+def filter_window(filters, path, mapping, now=None):
+    """
+    Return the (low, high) datetimes, both inclusive, that documents
+    matching all of the given filters fall within, from range / term /
+    terms filters on path. Either bound is None if unknown.
+    """
+    lows = []
+    highs = []
+    for expression in filters:
+        if not isinstance(expression, dict) or len(expression) != 1:
+            continue
+        name, body = expression.items()[0]
+        if not isinstance(body, dict) or path not in body:
+            continue
+        clause = body[path]
+        if name == FILTER_RANGE and isinstance(clause, dict):
+            for key, value in clause.iteritems():
+                if key not in LOWER_BOUNDS and key not in UPPER_BOUNDS:
+                    continue
+                date = range_bound(key, value, clause, mapping, now)
+                if date is None:
+                    continue
+                if key in LOWER_BOUNDS:
+                    lows.append(date)
+                elif key in UPPER_BOUNDS:
+                    highs.append(date)
+        elif name in (FILTER_TERM, FILTER_TERMS):
+            values = clause if isinstance(clause, list) else [ clause ]
+            dates = [ None if isinstance(value, Param)
+                else to_datetime(value, mapping) for value in values ]
+            if dates and None not in dates:
+                lows.append(min(dates))
+                highs.append(max(dates))
+    return (max(lows) if lows else None, min(highs) if highs else None)
+
+
+class PartitionedSearchModel(SearchModel):
+    """
+    A SearchModel whose documents are partitioned by a date field into one
+    index per interval.
+
+    Class attributes:
+        index_pattern: strftime pattern of partition index names.
+        partition_field: dotted path of the date field partitioning data.
+        partition_interval: one of "hour", "day", "week", "month", "year".
+        max_partitions: queries overlapping more partitions than this search
+            index_name instead of listing partitions.
+    """
+
+    abstract = True
+
+    index_pattern = None
+    partition_field = None
+    partition_interval = DAY
+    max_partitions = 100
+
+    @classmethod
+    def partition_mapping(cls):
+        return find_mapping(cls, cls.partition_field)
+
+    @classmethod
+    def partition_index(cls, value):
+        """
+        Return the name of the partition index for a partition field value.
+        """
+        date = to_datetime(value, cls.partition_mapping())
+        if date is None:
+            raise exception.InvalidDocument, "Cannot partition by %s value \
+%r" % (cls.partition_field, value)
+        return floor_date(date, cls.partition_interval).strftime(
+                cls.index_pattern)
+
+    @classmethod
+    def partition_indices(cls, low, high):
+        """
+        Return the partition index names overlapping [low, high], or None if
+        the window is open or spans more than max_partitions.
+        """
+        if low is None or high is None:
+            return None
+        names = []
+        current = floor_date(low, cls.partition_interval)
+        while current <= high:
+            name = current.strftime(cls.index_pattern)
+            if not names or names[-1] != name:
+                names.append(name)
+            if len(names) > cls.max_partitions:
+                return None
+            current = next_date(current, cls.partition_interval)
+        return names or [ floor_date(low, cls.partition_interval).strftime(
+            cls.index_pattern) ]
+
+    @classmethod
+    def write_index(cls, doc):
+        value = doc
+        for name in cls.partition_field.split('.'):
+            value = value.get(name) if isinstance(value, dict) else None
+        if value is None:
+            raise exception.InvalidDocument, "Document has no %s value: %r" % (
+                    cls.partition_field, doc)
+        return cls.partition_index(value)
+
+    @classmethod
+    def document_index(cls, index=None, partition=None):
+        """
+        Return the partition index of an existing document, for gets,
+        updates and deletes: the given index, or the partition of a
+        partition field value.
+        """
+        if index is not None:
+            return index
+        if partition is None:
+            raise ValueError, "Requests for a partitioned document need its \
+partition field value (partition=) or index (index=)"
+        return cls.partition_index(partition)
+
+    @classmethod
+    def query_indices(cls, query):
+        """
+        Return the partitions overlapping the query's filters on the
+        partition field, or index_name if they can't be narrowed down.
+        """
+        if query.or_filters:
+            return cls.index_name
+        low, high = filter_window(query.and_filters,
+                cls.partition_field, cls.partition_mapping())
+        return cls.partition_indices(low, high) or cls.index_name
+
+    @classmethod
+    def get(cls, doc_id, doc_type=None, return_raw=False, decode=None,
+            routing=None, parent=None, index=None, partition=None,
+            **request_params):
+        """
+        Get one document by id (see SearchModel.get) from the partition of
+        its partition field value given as partition=, or the given index=.
+        Without either, search every partition for it.
+        """
+        if index is not None or partition is not None:
+            return super(PartitionedSearchModel, cls).get(doc_id, doc_type,
+                    return_raw, decode, routing, parent,
+                    cls.document_index(index, partition), **request_params)
+        results = cls.multi_get([ doc_id ], doc_type, return_raw, decode,
+                routing)
+        if return_raw:
+            hits = results[const.HITS][const.HITS]
+            if not hits:
+                return None
+            source = hits[0][const.SOURCE]
+            source[const.ID] = hits[0][const.ID]
+            source[const.TYPE] = hits[0][const.TYPE]
+            return source
+        return results.documents[0] if results.documents else None
+
+    @classmethod
+    def multi_get(cls, doc_ids, doc_type=None, return_raw=False, decode=None,
+            routing=None, parent=None, index=None, partition=None,
+            **request_params):
+        """
+        Get documents by their ids (see SearchModel.multi_get) from the
+        partitions of their partition field values given as partition=, or
+        the given indices (index=): one value for all documents, a list
+        matching doc_ids or a { doc id: value } dict. Without either, search
+        every partition for them, as the multi get API needs each
+        document's index.
+        """
+        if index is not None or partition is not None:
+            doc_ids = list(doc_ids)
+            indices = cls._document_values(doc_ids, index, 'indices')
+            partitions = cls._document_values(doc_ids, partition,
+                    'partition values')
+            return super(PartitionedSearchModel, cls).multi_get(doc_ids,
+                    doc_type, return_raw, decode, routing, parent,
+                    [ cls.document_index(doc_index, doc_partition)
+                        for doc_index, doc_partition
+                        in zip(indices, partitions) ], **request_params)
+        if doc_type is None:
+            if cls.doc_type:
+                doc_type = cls.doc_type
+            else:
+                raise ValueError, "No document type specified"
+        if isinstance(routing, dict):
+            routing = routing.values()
+        query = { const.QUERY: { 'ids': { 'type': doc_type,
+            'values': list(doc_ids) } }, const.SIZE: len(doc_ids) }
+        results = cls.search(query, return_raw, decode, routing=routing)
+        if not return_raw:
+            order = dict((doc_id, position)
+                for position, doc_id in enumerate(doc_ids))
+            results.documents.sort(key=lambda doc: order.get(doc._id))
+        return results
+
+    @classmethod
+    def update(cls, doc_id, *args, **kwargs):
+        """
+        Update one document in place (see SearchModel.update), in the
+        partition of its partition field value given as partition=, or in
+        the given index=.
+        """
+        kwargs['index'] = cls.document_index(kwargs.pop('index', None),
+                kwargs.pop('partition', None))
+        return super(PartitionedSearchModel, cls).update(doc_id, *args,
+                **kwargs)
+
+    @classmethod
+    def bulk_update(cls, updates, *args, **kwargs):
+        """
+        Apply updates in bulk (see SearchModel.bulk_update); each update has
+        a "partition" field value or an "index".
+        """
+        def located():
+            for update in updates:
+                update = dict(update)
+                update['index'] = cls.document_index(update.pop('index', None),
+                        update.pop('partition', None))
+                yield update
+        return super(PartitionedSearchModel, cls).bulk_update(located(),
+                *args, **kwargs)
+
+    @classmethod
+    def delete(cls, doc_type, doc_id, routing=None, index=None,
+            partition=None, **request_params):
+        """
+        Delete one document, from the partition of its partition field value
+        or the given index.
+        """
+        return super(PartitionedSearchModel, cls).delete(doc_type, doc_id,
+                routing, cls.document_index(index, partition),
+                **request_params)
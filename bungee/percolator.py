@@ -0,0 +1,434 @@
+"""
+This module contains a client-side percolator: SearchQuery objects are
+registered once, compiled into Python predicates, and matched against single
+documents without a request to ElasticSearch:
+    Book.register_query('short', Book.query().filter(Book.pages < 100))
+    Book.percolate({ 'title': 'Heart of Darkness', 'pages': 72 })
+    # ['short']
+
+Documents are analyzed with the model's mappings, as the memory backend
+does. A term pre-index maps (field, term) pairs to the queries requiring
+them, so only candidate queries are evaluated for each document; queries
+without a required term (e.g. a lone range filter) are always evaluated.
+"""
+import fnmatch
+import re
+
+import const
+import exception
+from memory import (ALL_FIELD, META_FIELDS, STRING_MAPPING, analyze,
+        document_terms, leaf_mappings, to_term)
+
+
+def always(doc_terms):
+    return True
+
+
+def all_of(compiled):
+    """
+    Combine (predicate, required terms) pairs with AND. The required terms
+    are the smallest required set of any clause.
+    """
+    predicates = [ predicate for predicate, _ in compiled ]
+    required = [ terms for _, terms in compiled if terms is not None ]
+    def predicate(doc_terms):
+        for clause in predicates:
+            if not clause(doc_terms):
+                return False
+        return True
+    return predicate, min(required, key=len) if required else None
+
+
+def any_of(compiled):
+    """
+    Combine (predicate, required terms) pairs with OR. Terms are only
+    required if every clause requires some.
+    """
+    predicates = [ predicate for predicate, _ in compiled ]
+    required = set()
+    for _, terms in compiled:
+        if terms is None:
+            required = None
+            break
+        required |= terms
+    def predicate(doc_terms):
+        for clause in predicates:
+            if clause(doc_terms):
+                return True
+        return False
+    return predicate, required
+
+
+def none_of(compiled):
+    predicates = [ predicate for predicate, _ in compiled ]
+    def predicate(doc_terms):
+        for clause in predicates:
+            if clause(doc_terms):
+                return False
+        return True
+    return predicate, None
+
+
+class QueryCompiler(object):
+    """
+    Compiles query and filter DSL into (predicate, required terms) pairs.
+    Predicates take a document's {indexed path: set of terms}; required
+    terms is a set of (path, term) of which a matching document has at least
+    one, or None.
+    :param mappings: dictionary of indexed field path -> leaf mapping.
+    """
+
+    def __init__(self, mappings):
+        self.mappings = mappings
+
+    def term(self, path, value):
+        mapping = STRING_MAPPING if path in META_FIELDS else \
+                self.mappings.get(path, {})
+        try:
+            return to_term(mapping, value)
+        except (TypeError, ValueError), e:
+            raise exception.InvalidQueryExpression, "Cannot percolate \
+value %r of field %s: %s" % (value, path, e)
+
+    def compile(self, body, is_query=False):
+        if not isinstance(body, dict) or len(body) != 1:
+            raise exception.InvalidQueryExpression, "Cannot percolate %r" % (
+                    body,)
+        name, clause = body.items()[0]
+        if name == const.BOOL:
+            name = 'bool_query' if is_query else 'bool_filter'
+        method = getattr(self, 'compile_' + name, None)
+        if method is None:
+            raise exception.InvalidQueryExpression, "Cannot percolate \
+%s clauses" % name
+        return method(clause)
+
+    def compile_all(self, clauses, is_query=False):
+        if isinstance(clauses, dict):
+            clauses = [ clauses ]
+        return [ self.compile(clause, is_query) for clause in clauses or () ]
+
+    @staticmethod
+    def field_clause(clause):
+        """
+        Return (path, value) from a single-field clause, ignoring options
+        such as "_cache".
+        """
+        fields = [ (key, value) for key, value in clause.iteritems()
+            if not key.startswith('_') or key in META_FIELDS ]
+        if len(fields) != 1:
+            raise exception.InvalidQueryExpression, "Expected one field in \
+%r" % (clause,)
+        return fields[0]
+
+    """Filters"""
+    def compile_match_all(self, clause):
+        return always, None
+
+    def compile_term(self, clause):
+        path, value = self.field_clause(clause)
+        if isinstance(value, dict):
+            value = value.get(const.TERM, value.get('value'))
+        term = self.term(path, value)
+        return (lambda doc_terms: term in doc_terms.get(path, ()),
+                set([ (path, term) ]))
+
+    def compile_terms(self, clause):
+        clause = dict((key, value) for key, value in clause.iteritems()
+                if key not in ('execution', 'minimum_match',
+                    'minimum_should_match'))
+        path, values = self.field_clause(clause)
+        terms = frozenset(self.term(path, value) for value in values)
+        return (lambda doc_terms: not terms.isdisjoint(
+            doc_terms.get(path, ())), set((path, term) for term in terms))
+
+    def compile_range(self, clause):
+        path, bounds = self.field_clause(clause)
+        checks = []
+        for key, value in bounds.iteritems():
+            if value is None or key in ('include_lower', 'include_upper',
+                    'boost', 'time_zone'):
+                continue
+            bound = self.term(path, value)
+            if key == 'gt' or (key == 'from'
+                    and not bounds.get('include_lower', True)):
+                checks.append(lambda term, bound=bound: term > bound)
+            elif key in ('gte', 'from'):
+                checks.append(lambda term, bound=bound: term >= bound)
+            elif key == 'lt' or (key == 'to'
+                    and not bounds.get('include_upper', True)):
+                checks.append(lambda term, bound=bound: term < bound)
+            elif key in ('lte', 'to'):
+                checks.append(lambda term, bound=bound: term <= bound)
+            else:
+                raise exception.InvalidQueryExpression, "Cannot percolate \
+range bound %s" % key
+        def predicate(doc_terms):
+            for term in doc_terms.get(path, ()):
+                if all(check(term) for check in checks):
+                    return True
+            return False
+        return predicate, None
+
+    def compile_exists(self, clause):
+        path = clause[const.FIELD]
+        return lambda doc_terms: bool(doc_terms.get(path)), None
+
+    def compile_missing(self, clause):
+        path = clause[const.FIELD]
+        return lambda doc_terms: not doc_terms.get(path), None
+
+    def compile_not(self, clause):
+        if const.FILTER in clause and len(clause) <= 2:
+            clause = clause[const.FILTER]
+        return none_of([ self.compile(clause) ])
+
+    def compile_and(self, clause):
+        if isinstance(clause, dict):
+            clause = clause[const.FILTERS]
+        return all_of(self.compile_all(clause))
+
+    def compile_or(self, clause):
+        if isinstance(clause, dict):
+            clause = clause[const.FILTERS]
+        return any_of(self.compile_all(clause))
+
+    def compile_bool_filter(self, clause):
+        compiled = self.compile_all(clause.get(const.MUST))
+        should = self.compile_all(clause.get(const.SHOULD))
+        if should:
+            compiled.append(any_of(should))
+        must_not = self.compile_all(clause.get(const.MUST_NOT))
+        if must_not:
+            compiled.append(none_of(must_not))
+        return all_of(compiled)
+
+    def compile_query(self, clause):
+        return self.compile(clause, is_query=True)
+
+    def compile_ids(self, clause):
+        ids = [ unicode(doc_id) for doc_id in clause.get('values', ()) ]
+        return self.compile_terms({ const.ID: ids })
+
+    def compile_type(self, clause):
+        return self.compile_term({ const.TYPE: clause['value'] })
+
+    """Queries"""
+    def compile_bool_query(self, clause):
+        compiled = self.compile_all(clause.get(const.MUST), True)
+        should = self.compile_all(clause.get(const.SHOULD), True)
+        if should and not compiled:
+            compiled.append(any_of(should))
+        must_not = self.compile_all(clause.get(const.MUST_NOT), True)
+        if must_not:
+            compiled.append(none_of(must_not))
+        return all_of(compiled)
+
+    def compile_filtered(self, clause):
+        compiled = []
+        if const.QUERY in clause:
+            compiled.append(self.compile(clause[const.QUERY], True))
+        if const.FILTER in clause:
+            compiled.append(self.compile(clause[const.FILTER]))
+        return all_of(compiled)
+
+    def compile_constant_score(self, clause):
+        if const.FILTER in clause:
+            return self.compile(clause[const.FILTER])
+        return self.compile(clause[const.QUERY], True)
+
+    def compile_query_string(self, clause):
+        """
+        Whitespace separated words, with optional "field:" prefixes and
+        wildcards, combined with default_operator (as the memory backend
+        evaluates them).
+        """
+        paths = [ field.split('^')[0] for field in clause.get(const.FIELDS)
+                or [ clause.get('default_field', ALL_FIELD) ] ]
+        wildcards = clause.get('analyze_wildcard', False)
+        words = []
+        for word in clause[const.QUERY].split():
+            if word.upper() in ('AND', 'OR'):
+                continue
+            word_paths = paths
+            if ':' in word:
+                path, _, word = word.partition(':')
+                word_paths = [ path ]
+            if wildcards and ('*' in word or '?' in word):
+                words.append(self.pattern(word_paths,
+                    fnmatch.translate(word.lower())))
+            else:
+                terms = set((path, token) for path in word_paths
+                        for token in analyze(word))
+                words.append(self.any_term(terms))
+        if clause.get('default_operator', 'OR').upper() == 'AND':
+            return all_of(words)
+        return any_of(words)
+
+    @staticmethod
+    def any_term(terms):
+        def predicate(doc_terms):
+            for path, term in terms:
+                if term in doc_terms.get(path, ()):
+                    return True
+            return False
+        return predicate, terms
+
+    @staticmethod
+    def pattern(paths, regex):
+        regex = re.compile(regex + r'\Z')
+        def predicate(doc_terms):
+            for path in paths:
+                for term in doc_terms.get(path, ()):
+                    if isinstance(term, basestring) and regex.match(term):
+                        return True
+            return False
+        return predicate, None
+
+    def pattern_clause(self, clause, translate):
+        path, value = self.field_clause(clause)
+        if isinstance(value, dict):
+            value = value.get('value', value.get(const.TERM))
+        return self.pattern([ path ], translate(value))
+
+    def compile_wildcard(self, clause):
+        return self.pattern_clause(clause, fnmatch.translate)
+
+    def compile_regexp(self, clause):
+        return self.pattern_clause(clause, lambda pattern: pattern)
+
+
+class Percolator(object):
+    """
+    Registered queries of one SearchModel class. Queries are compiled on
+    first use after a registration or a change of the model's mappings.
+    """
+
+    def __init__(self, search_model_class):
+        self.search_model_class = search_model_class
+        self.queries = {}
+        self.order = []
+        self.listeners = []
+        self._compiled = None
+        self._leaves = {}
+
+    def register(self, query_id, query):
+        """
+        Register a SearchQuery (or raw query body) under query_id, replacing
+        any query with the same id. Pagination, sorting and facets are
+        ignored.
+        """
+        if hasattr(query, '_generate_es_query'):
+            query = query._generate_es_query(count_query=True)
+        if query_id not in self.queries:
+            self.order.append(query_id)
+        self.queries[query_id] = query
+        self._compiled = None
+
+    def unregister(self, query_id):
+        if query_id in self.queries:
+            del self.queries[query_id]
+            self.order.remove(query_id)
+            self._compiled = None
+
+    def add_listener(self, listener):
+        """
+        Call listener(doc_id, doc, query_ids) for each document indexed
+        through the model that matches registered queries.
+        """
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self.listeners.remove(listener)
+
+    def invalidate(self):
+        """
+        Forget compiled queries and mappings, e.g. after a mapping change.
+        """
+        self._compiled = None
+        self._leaves = {}
+
+    def leaves(self, doc_type=None):
+        """
+        Return leaf_mappings for a document type (all types if None).
+        """
+        if doc_type not in self._leaves:
+            self._leaves[doc_type] = self._build_leaves(doc_type)
+        return self._leaves[doc_type]
+
+    def _build_leaves(self, doc_type):
+        mappings = self.search_model_class.generate_field_mappings()
+        if doc_type is not None:
+            doc_types = [ doc_type ] if doc_type in mappings else []
+        else:
+            doc_types = mappings.keys()
+        leaves = {}
+        for name in doc_types:
+            properties = dict((field._mapping_name, field._mapping)
+                for field in mappings[name].values())
+            for path, pairs in leaf_mappings(properties).iteritems():
+                leaves.setdefault(path, pairs)
+        return leaves
+
+    def compile(self):
+        """
+        Compile the registered queries. Returns (predicates by query id,
+        pre-index of (path, term) -> query ids, ids of unindexed queries).
+        """
+        if self._compiled is None:
+            mappings = dict((indexed_path, mapping)
+                for pairs in self.leaves().itervalues()
+                for indexed_path, mapping in pairs)
+            compiler = QueryCompiler(mappings)
+            predicates = {}
+            term_index = {}
+            unindexed = set()
+            for query_id in self.order:
+                predicate, required = compiler.compile(self.queries[query_id],
+                        is_query=True)
+                predicates[query_id] = predicate
+                if required is None:
+                    unindexed.add(query_id)
+                    continue
+                for path_term in required:
+                    term_index.setdefault(path_term, set()).add(query_id)
+            self._compiled = (predicates, term_index, unindexed)
+        return self._compiled
+
+    def percolate(self, doc, doc_type=None):
+        """
+        Return the ids of the registered queries matching a document, in
+        registration order.
+        """
+        predicates, term_index, unindexed = self.compile()
+        if not predicates:
+            return []
+        if doc_type is None and isinstance(
+                self.search_model_class.doc_type, basestring):
+            doc_type = self.search_model_class.doc_type
+        doc_id = doc.get(const.ID)
+        terms, _ = document_terms(self.leaves(doc_type), doc, doc_type,
+                unicode(doc_id) if doc_id is not None else None)
+        doc_terms = dict((path, set(path_terms))
+            for path, path_terms in terms.iteritems())
+
+        candidates = set(unindexed)
+        for path, path_terms in doc_terms.iteritems():
+            for term in path_terms:
+                query_ids = term_index.get((path, term))
+                if query_ids:
+                    candidates |= query_ids
+        return [ query_id for query_id in self.order if query_id in candidates
+            and predicates[query_id](doc_terms) ]
+
+    def notify(self, docs, doc_type=None):
+        """
+        Percolate (doc_id, doc) pairs and pass matches to the listeners.
+        """
+        if not self.listeners or not self.queries:
+            return
+        for doc_id, doc in docs:
+            query_ids = self.percolate(doc, doc_type)
+            if query_ids:
+                for listener in self.listeners:
+                    listener(doc_id, doc, query_ids)
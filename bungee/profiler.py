@@ -0,0 +1,339 @@
+"""
+This module contains profile and explain, which show where a SearchQuery
+spends its time on the cluster and why a document matches it, clause by
+clause:
+    q = Book.query().filter(Book.pages > 100).match(Book.title.like('heart'))
+    print q.profile()
+    print q.explain('A', doc_type='book')
+
+profile runs the query once with "profile": true (ES 2.2 or later) and
+keeps the per-shard breakdown of the response; each clause of the query
+(each must / should / must_not query and and / or filter) gets the time of
+the profile nodes that come from it alone. Profile nodes and explanation
+details are mapped back to the clause whose fields they mention; those
+mentioning several clauses (e.g. the BooleanQuery of the whole query) list
+them all, without a single clause.
+
+On clusters without the profile API, profile(native=False, isolate=True)
+runs every clause on its own as a size 0 search instead, timed by the
+fastest ES "took" time of repeat runs, with its hit count showing its
+selectivity. That costs (clauses + 1) * repeat searches, and a clause run
+alone is planned and cached differently than within the whole query, so
+its time is only a rough guide.
+"""
+import re
+
+import bulk
+import const
+import geo
+import instrument
+
+PROFILE = 'profile'
+SHARDS = 'shards'
+SEARCHES = 'searches'
+EXPLAIN = '_explain'
+EXPLANATION = 'explanation'
+MATCHED = 'matched'
+DETAILS = 'details'
+DESCRIPTION = 'description'
+VALUE = 'value'
+BREAKDOWN = 'breakdown'
+CHILDREN = 'children'
+TIME_IN_NANOS = 'time_in_nanos'
+# ES 2.x names of the profile node type and description
+QUERY_TYPE = 'query_type'
+LUCENE = 'lucene'
+
+# (location label, SearchQuery chain attribute) of each clause list
+CLAUSE_LISTS = (
+    (const.MUST, 'must_queries'),
+    (const.SHOULD, 'should_queries'),
+    (const.MUST_NOT, 'must_not_queries'),
+    (const.AND, 'and_filters'),
+    (const.OR, 'or_filters'),
+)
+# Clauses whose body is keyed by field path
+FIELD_CLAUSES = set((const.TERM, const.TERMS, 'range', 'regexp', 'wildcard',
+    'prefix', 'match', geo.GEO_DISTANCE, geo.GEO_BOUNDING_BOX,
+    geo.GEO_POLYGON))
+FIELD_OPTIONS = geo.OPTIONS | set(('execution', 'boost', 'minimum_match',
+    'minimum_should_match'))
+DURATION_RE = re.compile(r'^([\d.]+)(nanos|micros|ms|s)$')
+DURATION_MILLIS = { 'nanos': 1e-6, 'micros': 1e-3, 'ms': 1.0, 's': 1000.0 }
+
+
+def expression_fields(expression, fields=None):
+    """
+    Return the sorted field paths a query or filter expression refers to.
+    """
+    if fields is None:
+        fields = set()
+    if isinstance(expression, dict):
+        for key, body in expression.iteritems():
+            if key in FIELD_CLAUSES and isinstance(body, dict):
+                fields.update(name for name in body
+                    if name not in FIELD_OPTIONS and not name.startswith('_'))
+            elif key == const.FIELD and isinstance(body, basestring):
+                fields.add(body)
+            elif key == const.FIELDS and isinstance(body, list):
+                fields.update(name.split('^')[0] for name in body
+                    if isinstance(name, basestring))
+            else:
+                expression_fields(body, fields)
+    elif isinstance(expression, list):
+        for item in expression:
+            expression_fields(item, fields)
+    return sorted(fields)
+
+
+class Clause(object):
+    """
+    One query or filter expression of a SearchQuery, at a location such as
+    "and[1]", with its time in the profile of the query, or the time and hit
+    count of running it on its own.
+    """
+
+    def __init__(self, location, attribute, expression):
+        self.location = location
+        self.attribute = attribute
+        self.expression = expression
+        self.fields = expression_fields(expression)
+        self.took = None
+        self.hits = None
+
+    def mentioned_in(self, description):
+        """
+        Return True if a Lucene description mentions one of the fields,
+        e.g. "+author.last:heller".
+        """
+        return any(re.search(r'(^|[^\w.])%s:' % re.escape(field),
+            description) for field in self.fields)
+
+    def __repr__(self):
+        return 'Clause[%s %s: %sms, %s hits]' % (self.location,
+                ','.join(self.fields), self.took, self.hits)
+
+
+def query_clauses(query):
+    """
+    Return the Clauses of a SearchQuery.
+    """
+    return [ Clause('%s[%d]' % (label, position), attribute, expression)
+        for label, attribute in CLAUSE_LISTS
+        for position, expression in enumerate(getattr(query, attribute)) ]
+
+
+def mentioned_clauses(description, clauses, parent_clauses=()):
+    """
+    Return the Clauses a profile node or explanation description comes
+    from: those it mentions, or those of its parent if it mentions none.
+    """
+    mentioned = [ clause for clause in clauses
+        if clause.mentioned_in(description) ]
+    return mentioned or list(parent_clauses)
+
+
+def single_clause(clauses):
+    """
+    Return the only Clause of a list, or None if there are several or none.
+    """
+    return clauses[0] if len(clauses) == 1 else None
+
+
+def locations(clauses):
+    return ','.join(clause.location for clause in clauses) or '-'
+
+
+def millis(node):
+    """
+    Return the time of a native profile node in milliseconds.
+    """
+    if TIME_IN_NANOS in node:
+        return node[TIME_IN_NANOS] / 1e6
+    match = DURATION_RE.match(unicode(node.get('time', '')))
+    if match is None:
+        return None
+    return float(match.group(1)) * DURATION_MILLIS[match.group(2)]
+
+
+class ProfileNode(object):
+    """
+    One Lucene query of a native shard profile, and the Clauses it comes
+    from; clause is set when that is exactly one Clause.
+    """
+
+    def __init__(self, node, clauses, parent_clauses=()):
+        self.query_type = node.get('type', node.get(QUERY_TYPE))
+        self.description = node.get(DESCRIPTION, node.get(LUCENE, ''))
+        self.took = millis(node)
+        self.breakdown = node.get(BREAKDOWN, {})
+        self.clauses = mentioned_clauses(self.description, clauses,
+                parent_clauses)
+        self.clause = single_clause(self.clauses)
+        self.children = [ ProfileNode(child, clauses, self.clauses)
+            for child in node.get(CHILDREN, ()) ]
+
+    def clause_nodes(self):
+        """
+        Yield the outermost nodes (this one or descendants) that come from a
+        single Clause.
+        """
+        if self.clause is not None:
+            yield self
+            return
+        for child in self.children:
+            for node in child.clause_nodes():
+                yield node
+
+    def __repr__(self):
+        return 'ProfileNode[%s %s: %sms]' % (self.query_type,
+                locations(self.clauses), self.took)
+
+
+class QueryProfile(object):
+    """
+    The profile of a SearchQuery: the time of the whole query, its clauses
+    (slowest first), and the per-shard ProfileNodes of a native profile as
+    {shard id: [ProfileNode]}, or None.
+    """
+
+    def __init__(self, took, hits, clauses, shards=None):
+        self.took = took
+        self.hits = hits
+        self.clauses = sorted(clauses, key=lambda clause: -(clause.took or 0))
+        self.shards = shards
+
+    def __repr__(self):
+        lines = [ 'QueryProfile(%sms, %s hits):' % (self.took, self.hits) ]
+        lines.extend('  %r' % clause for clause in self.clauses)
+        return '\n'.join(lines)
+
+
+def timed_search(query, es_query, repeat):
+    """
+    Run a size 0 search repeat times; return (fastest took, total hits,
+    last response).
+    """
+    model = query.search_model_class
+    es_query[const.SIZE] = 0
+    took = None
+    response = None
+    for _ in xrange(repeat):
+        response = model.search(es_query, return_raw=True,
+                index=model.query_indices(query),
+                routing=query._search_routing())
+        took = response['took'] if took is None else min(took,
+                response['took'])
+    return took, response[const.HITS][const.TOTAL], response
+
+
+def profile_shards(response, clauses):
+    """
+    Return the ProfileNodes of a profiled search response as {shard id:
+    [ProfileNode]}, adding the time of the nodes that come from a single
+    Clause to that Clause.
+    """
+    shards = {}
+    for shard in response[PROFILE].get(SHARDS, ()):
+        shards[shard.get('id')] = nodes = [ ProfileNode(node, clauses)
+            for search in shard.get(SEARCHES, ())
+            for node in search.get(const.QUERY, ()) ]
+        for node in nodes:
+            for clause_node in node.clause_nodes():
+                if clause_node.took is not None:
+                    clause = clause_node.clause
+                    clause.took = (clause.took or 0) + clause_node.took
+    return shards
+
+
+def profile(query, repeat=1, native=True, isolate=False):
+    """
+    Return a QueryProfile of a SearchQuery.
+    :param repeat: runs of each search; the fastest is kept.
+    :param native: if True, run the query with the ES profile API (ES 2.2 or
+        later) and keep its per-shard breakdown.
+    :param isolate: if True, also time each clause on its own and count its
+        hits: (clauses + 1) * repeat searches in all (see above).
+    """
+    clauses = query_clauses(query)
+    es_query = { const.QUERY: query._generate_es_query(count_query=True) }
+    if native:
+        es_query[PROFILE] = True
+    took, hits, response = timed_search(query, es_query, repeat)
+    shards = None
+    if PROFILE in response:
+        shards = profile_shards(response, clauses)
+    if isolate and len(clauses) > 1:
+        for clause in clauses:
+            isolated = type(query)(query.search_model_class,
+                    **{ clause.attribute: [ clause.expression ] })
+            clause.took, clause.hits, _ = timed_search(query, { const.QUERY:
+                isolated._generate_es_query(count_query=True) }, repeat)
+    elif isolate and clauses:
+        # The only clause is the whole query
+        clauses[0].took, clauses[0].hits = took, hits
+    return QueryProfile(took, hits, clauses, shards)
+
+
+class Explanation(object):
+    """
+    One node of an ES score explanation, and the Clauses it comes from;
+    clause is set when that is exactly one Clause. matched is set on the
+    root node only.
+    """
+
+    def __init__(self, node, clauses, parent_clauses=(), matched=None):
+        self.value = node.get(VALUE)
+        self.description = node.get(DESCRIPTION, '')
+        self.matched = matched
+        self.clauses = mentioned_clauses(self.description, clauses,
+                parent_clauses)
+        self.clause = single_clause(self.clauses)
+        self.details = [ Explanation(detail, clauses, self.clauses)
+            for detail in node.get(DETAILS, ()) ]
+
+    def lines(self, depth=0):
+        clause = ' [%s]' % locations(self.clauses) if self.clauses else ''
+        yield '%s%s = %s%s' % ('  ' * depth, self.description, self.value,
+                clause)
+        for detail in self.details:
+            for line in detail.lines(depth + 1):
+                yield line
+
+    def __repr__(self):
+        return '\n'.join(self.lines())
+
+
+def explain(query, doc_id, doc_type=None, routing=None, parent=None,
+        **request_params):
+    """
+    Return the Explanation of how a document matches (or doesn't match) a
+    SearchQuery.
+    :param doc_type: the document's type; defaults to the model's.
+    :param routing: routing value the document was indexed with; defaults to
+        the query's routing when that is a single value.
+    :param parent: parent id of a child document.
+    :param request_params: query parameters of the explain request.
+    """
+    model = query.search_model_class
+    doc_type = doc_type or model.doc_type
+    if not isinstance(doc_type, basestring):
+        raise ValueError, "No document type specified"
+    index = model.query_indices(query)
+    if not isinstance(index, basestring):
+        index = model.index_name
+    body = { const.QUERY: query._generate_es_query(count_query=True) }
+    if routing is None:
+        routing = query._search_routing()
+        if isinstance(routing, (list, tuple, set)) and len(routing) != 1:
+            # The document is on one of several shards
+            routing = None
+    request_params.update(bulk.query_params(model._document_routing(routing,
+        {}, parent)))
+    connection = model.connection
+    with instrument.request('explain', model, index, body) as event:
+        response = event.send(connection.send_request, 'GET',
+                [ index, doc_type, doc_id, EXPLAIN ], body,
+                query_params=request_params)
+    return Explanation(response.get(EXPLANATION, {}), query_clauses(query),
+            matched=response.get(MATCHED))
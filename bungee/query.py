@@ -1,6 +1,22 @@
+import copy
+
+import aggregation
 import const
-from json_document import ResultSet
-from util import prettify
+import cost
+import deletion
+import exception
+import geo
+import profiler
+from json_document import JsonDocument, ResultSet
+from optimizer import optimize_filters, CACHE
+from template import Param, QueryTemplate
+from util import prettify, to_chain
+
+HAS_CHILD = 'has_child'
+HAS_PARENT = 'has_parent'
+PARENT_TYPE = 'parent_type'
+SCORE_TYPE = 'score_type'
+CONSTANT_SCORE = 'constant_score'
 
 
 class SearchQuery(object):
@@ -21,51 +37,74 @@ class SearchQuery(object):
         query = Model.query.filter( field1 == value1)
         query_foo = query.match(field2=="foo") #filter field1, match field2
         query_bar = query.match(field3.like("bar")) #filter field1, match field3
+
+    Query expressions are stored in persistent Chains, so each chained call
+    is O(1) and shares all earlier expressions with its parent query. The
+    compiled ES query is memoized per instance.
     """
 
     def __init__(self, search_model_class, must_queries=None,
             must_not_queries=None, should_queries=None, and_filters=None,
             or_filters=None, facet_queries=None, limit=None, offset=0,
-            page_size=None, sort=None):
+            page_size=None, sort=None, aggregation_queries=None):
 
         self.search_model_class = search_model_class
-        self.must_queries = must_queries or []
-        self.must_not_queries = must_not_queries or []
-        self.should_queries = should_queries or []
-        self.and_filters = and_filters or []
-        self.or_filters = or_filters or []
-        self.facet_queries = facet_queries or []
+        self.must_queries = to_chain(must_queries)
+        self.must_not_queries = to_chain(must_not_queries)
+        self.should_queries = to_chain(should_queries)
+        self.and_filters = to_chain(and_filters)
+        self.or_filters = to_chain(or_filters)
+        self.facet_queries = to_chain(facet_queries)
+        self.aggregation_queries = to_chain(aggregation_queries)
         self._offset = offset
         self._limit = limit
         self._page_size = page_size
-        self.sort = sort or []
+        self.sort = to_chain(sort)
+        self._optimize = False
+        self._filter_cache = None
+        self._strict = getattr(search_model_class, 'strict_cost', None)
+        self._routing = None
+        self._total = None
+        self._compiled = None
+
+    def _copy(self):
+        """
+        Return a shallow copy of this query, without its compiled ES query
+        or known total.
+        """
+        subquery = copy.copy(self)
+        subquery._compiled = None
+        subquery._total = None
+        return subquery
 
     def _generate_subquery(self, must_queries=None, must_not_queries=None,
             should_queries=None, and_filters=None, or_filters=None,
             facet_queries=None, limit=None, offset=None, page_size=None,
-            sort=None):
+            sort=None, aggregation_queries=None):
         """
         Creates a new query object based on this one, with extra arguments
         appended (or overriden, in the case of limit, offset, page_size, sort).
         """
+        subquery = self._copy()
 
-        # Additive fields
-        must_queries = self.must_queries + (must_queries or [])
-        must_not_queries = self.must_not_queries + (must_not_queries or [])
-        should_queries = self.should_queries + (should_queries or [])
-        and_filters = self.and_filters + (and_filters or [])
-        or_filters = self.or_filters + (or_filters or [])
-        facet_queries = self.facet_queries + (facet_queries or [])
-        sort = self.sort + (sort or [])
+        # Additive fields; the new chains share this query's nodes
+        subquery.must_queries = self.must_queries.extend(must_queries)
+        subquery.must_not_queries = self.must_not_queries.extend(
+                must_not_queries)
+        subquery.should_queries = self.should_queries.extend(should_queries)
+        subquery.and_filters = self.and_filters.extend(and_filters)
+        subquery.or_filters = self.or_filters.extend(or_filters)
+        subquery.facet_queries = self.facet_queries.extend(facet_queries)
+        subquery.aggregation_queries = self.aggregation_queries.extend(
+                aggregation_queries)
+        subquery.sort = self.sort.extend(sort)
 
         # Last added takes precedence
-        limit = limit if limit else self._limit
-        offset = offset if offset else self._offset
-        page_size = page_size if page_size else self._page_size
+        subquery._limit = limit if limit else self._limit
+        subquery._offset = offset if offset else self._offset
+        subquery._page_size = page_size if page_size else self._page_size
 
-        return self.__class__(self.search_model_class, must_queries,
-                must_not_queries, should_queries, and_filters, or_filters,
-                facet_queries, limit, offset, page_size, sort)
+        return subquery
 
     def _generate_es_query(self, count_query=False):
         """
@@ -75,27 +114,58 @@ class SearchQuery(object):
         Note that this dictionary will NOT include limit, offset or any other
         "search api" related settings.
 
+        The full body is compiled once and memoized; the count body is its
+        "query" value. A new top-level dict is returned on each call, but
+        nested values are shared and must not be modified.
+
         :param count_query: if True, do not include facet/sort parameters.
         """
+        if self._compiled is None:
+            self._compiled = self._compile_es_query()
+        if count_query:
+            return dict(self._compiled[const.QUERY])
+        return dict(self._compiled)
+
+    def _compile_es_query(self):
+        """
+        Build the ES search body for _generate_es_query.
+        """
+        must_queries = self.must_queries.to_list()
+        should_queries = self.should_queries.to_list()
+        must_not_queries = self.must_not_queries.to_list()
+        and_filters = self.and_filters.to_list()
+        or_filters = self.or_filters.to_list()
+        if self._optimize:
+            decoders = self._field_decoders()
+            and_filters, _ = optimize_filters(and_filters, const.AND,
+                    decoders)
+            or_filters, _ = optimize_filters(or_filters, const.OR, decoders)
+        and_filters = geo.prefilter(and_filters, const.AND)
+        or_filters = geo.prefilter(or_filters, const.OR)
+
         es_dict = {}
         query_arguments = {}
         filter_arguments = {}
 
-        if self.must_queries or self.should_queries or self.must_not_queries:
+        if must_queries or should_queries or must_not_queries:
             match_query = {}
-            if self.must_queries:
-                match_query[const.MUST] = self.must_queries
-            if self.should_queries:
-                match_query[const.SHOULD] = self.should_queries
-            if self.must_not_queries:
-                match_query[const.MUST_NOT] = self.must_not_queries
+            if must_queries:
+                match_query[const.MUST] = must_queries
+            if should_queries:
+                match_query[const.SHOULD] = should_queries
+            if must_not_queries:
+                match_query[const.MUST_NOT] = must_not_queries
             query_arguments[const.BOOL] = match_query
 
-        if self.and_filters or self.or_filters:
-            if len(self.and_filters):
-                filter_arguments = { const.AND: self.and_filters }
-            if len(self.or_filters):
-                filter_arguments = { const.OR: self.or_filters }
+        if and_filters or or_filters:
+            if len(and_filters):
+                filter_arguments = { const.AND: and_filters }
+            if len(or_filters):
+                filter_arguments = { const.OR: or_filters }
+            if self._filter_cache is not None:
+                for conjunction, filters in filter_arguments.items():
+                    filter_arguments[conjunction] = { const.FILTERS: filters,
+                        CACHE: self._filter_cache }
 
         if query_arguments and filter_arguments:
             es_dict[const.FILTERED] = { const.QUERY: query_arguments }
@@ -108,18 +178,18 @@ class SearchQuery(object):
             else:
                 es_dict[const.MATCH_ALL] = {}
 
-        if count_query:
-            return es_dict
-
         es_dict = { const.QUERY: es_dict }
         if self.facet_queries:
             facets = {}
             for field in self.facet_queries:
                 facets.update(field)
             es_dict[const.FACETS] = facets
+        if self.aggregation_queries:
+            es_dict[aggregation.AGGS] = aggregation.to_dicts(
+                    self.aggregation_queries)
 
         if self.sort:
-            sort = self.sort
+            sort = self.sort.to_list()
         else:
             sort = [{const.ID: { const.ORDER: const.ASC }}]
         es_dict[const.SORT] = sort
@@ -155,6 +225,127 @@ class SearchQuery(object):
         """
         return self._generate_subquery(page_size=amount)
 
+    def optimize(self, enabled=True, cache=None):
+        """
+        Run the filter optimizer when compiling this query: duplicate filters
+        are dropped, term filters on one field merged, ranges on one field
+        intersected and cheap filters ordered first.
+        :param enabled: if False, emit filters exactly as written.
+        :param cache: if not None, set the "_cache" hint of the top-level
+            and/or filter to this value.
+        """
+        subquery = self._copy()
+        subquery._optimize = enabled
+        subquery._filter_cache = cache
+        return subquery
+
+    def _field_decoders(self):
+        """
+        Return the decoder trees of the model's document types, which the
+        optimizer uses to compare absolute date bounds.
+        """
+        return getattr(self.search_model_class, '_decoders', {}).values()
+
+    def explain_optimizations(self):
+        """
+        Return a list of strings describing what the filter optimizer changes
+        in this query (whether or not optimization is enabled).
+        """
+        decoders = self._field_decoders()
+        _, and_notes = optimize_filters(self.and_filters.to_list(), const.AND,
+                decoders)
+        _, or_notes = optimize_filters(self.or_filters.to_list(), const.OR,
+                decoders)
+        return ([ 'and: ' + note for note in and_notes ] +
+                [ 'or: ' + note for note in or_notes ])
+
+    def cost_report(self):
+        """
+        Return a CostReport listing expensive patterns in this query (leading
+        wildcards, open regexps, deep offsets, high-cardinality facets).
+        """
+        return cost.analyze_query(self)
+
+    def profile(self, repeat=1, native=True, isolate=False):
+        """
+        Return a QueryProfile of this query on the cluster: its time and the
+        per-shard breakdown of the ES profile API (ES 2.2 or later), with the
+        time of each query / filter clause (see profiler.py).
+        :param repeat: runs of each search; the fastest is kept.
+        :param native: if False, don't use the profile API.
+        :param isolate: if True, also run each clause on its own to time it
+            and count its hits, at the cost of (clauses + 1) * repeat
+            searches.
+        """
+        return profiler.profile(self, repeat, native, isolate)
+
+    def explain(self, doc_id, doc_type=None, **request_params):
+        """
+        Return the Explanation of how a document matches this query, with
+        each explanation detail mapped to the clause it comes from.
+        """
+        return profiler.explain(self, doc_id, doc_type, **request_params)
+
+    def strict(self, severity=cost.ERROR):
+        """
+        Reject this query with ExpensiveQueryError before it is sent, if its
+        cost report has warnings of the given severity or worse.
+        :param severity: "error", "warning", or None to disable.
+        """
+        subquery = self._copy()
+        subquery._strict = severity
+        return subquery
+
+    def routing(self, value):
+        """
+        Search only the shards for the given routing value (or list of
+        values). Without it, the routing is derived from term filters on the
+        model's routing_field.
+        """
+        subquery = self._copy()
+        subquery._routing = value
+        return subquery
+
+    def _search_routing(self):
+        """
+        Return the routing value(s) for this query: the one set with
+        routing(), or the values term / terms filters on the model's
+        routing_field allow. None means all shards.
+        """
+        if self._routing is not None:
+            return self._routing
+        routing_field = getattr(self.search_model_class, 'routing_field', None)
+        if routing_field is None or self.or_filters:
+            return None
+        allowed = None
+        for expression in self.and_filters:
+            if not isinstance(expression, dict) or len(expression) != 1:
+                continue
+            name, body = expression.items()[0]
+            if name not in (const.TERM, const.TERMS) or not isinstance(body,
+                    dict) or routing_field not in body:
+                continue
+            values = body[routing_field]
+            if not isinstance(values, list):
+                values = [ values ]
+            if any(isinstance(value, Param) for value in values):
+                continue
+            values = set(unicode(value) for value in values)
+            allowed = values if allowed is None else allowed & values
+        return sorted(allowed) if allowed else None
+
+    def _check_cost(self):
+        if self._strict:
+            cost.enforce(self, self._strict)
+
+    def _check_body_cost(self, es_query):
+        """
+        Apply this query's strict() check to a compiled body derived from it,
+        e.g. a bound QueryTemplate.
+        """
+        if self._strict:
+            cost.enforce_body(es_query, self._strict)
+
     """
     Filtering: The presence of one of these expressions will generate a
     "filtered" query on execution.
@@ -205,14 +396,62 @@ class SearchQuery(object):
         Add query expression that documents MUST NOT match.
         """
         return self._generate_subquery(must_not_queries=[query_expression])
+
+    """
+    Parent / child joins, evaluated on the cluster in one request: related
+    documents are given as a SearchQuery of their model (or a filter
+    expression and their doc_type).
+    """
+    def _join(self, join_type, type_key, related, doc_type, score_type):
+        if isinstance(related, SearchQuery):
+            doc_type = doc_type or related.search_model_class.doc_type
+            body = { const.QUERY: related._generate_es_query(
+                count_query=True) }
+        elif score_type is not None:
+            body = { const.QUERY: { CONSTANT_SCORE: {
+                const.FILTER: related } } }
+        else:
+            body = { const.FILTER: related }
+        if not isinstance(doc_type, basestring):
+            raise exception.InvalidQueryExpression, "%s needs one document \
+type, got %r" % (join_type, doc_type)
+        body[type_key] = doc_type
+        if score_type is None:
+            return self.filter({ join_type: body })
+        body[SCORE_TYPE] = score_type
+        return self.must_match({ join_type: body })
+
+    def has_child(self, child_query, doc_type=None, score_type=None):
+        """
+        Keep documents with at least one child document matching child_query.
+        :param doc_type: the child document type; defaults to the type of
+            the child query's model.
+        :param score_type: "max", "sum" or "avg" to score documents by their
+            matching children (as a must query); by default, a filter.
+        """
+        return self._join(HAS_CHILD, const.PROPERTY_TYPE, child_query,
+                doc_type, score_type)
+
+    def has_parent(self, parent_query, doc_type=None, score_type=None):
+        """
+        Keep documents whose parent document matches parent_query.
+        :param doc_type: the parent document type; defaults to the type of
+            the parent query's model.
+        :param score_type: "score" to score documents by their parent's score
+            (as a must query); by default, a filter.
+        """
+        return self._join(HAS_PARENT, PARENT_TYPE, parent_query, doc_type,
+                score_type)
  
     def _add_facet(self, facet_type, search_field, facet_name=None,
-            facet_filters=None):
+            facet_filters=None, facet_size=None):
         if not facet_name:
             facet_name = search_field.hierarchy
         q = { facet_name: { 
             facet_type: { const.FIELD: search_field.hierarchy }
         }}
+        if facet_size is not None:
+            q[facet_name][facet_type][const.SIZE] = facet_size
 
         if facet_filters:
             facet_filter_dict = {}
@@ -230,28 +469,151 @@ class SearchQuery(object):
         :param facet_name: string, optional name for the facet result
             (will default to the full name of the search field)
         :param facet_filters: list of QueryExpressions to filter facet results
+        :param facet_size: number of terms to return (ES default: 10)
         """
         q = self._add_facet(const.TERMS, search_field,
-            facet_name=facet_name, facet_filters=facet_filters)
+            facet_name=facet_name, facet_filters=facet_filters,
+            facet_size=facet_size)
         return self._generate_subquery(facet_queries=[q])
 
+    """Aggregations."""
+    def aggregate(self, *aggregations):
+        """
+        Add aggregations (see aggregation.py), returned with the results of
+        all() or by aggregations().
+        """
+        return self._generate_subquery(aggregation_queries=aggregations)
+
+    def aggregations(self, **request_params):
+        """
+        Run one search returning no hits and return the aggregation results
+        as a JsonDocument keyed by aggregation name.
+        """
+        self._check_cost()
+        es_query = self._generate_es_query()
+        es_query.pop(const.FACETS, None)
+        es_query.pop(const.SORT, None)
+        es_query[const.SIZE] = 0
+        results = self.search_model_class.search(es_query, return_raw=True,
+                index=self.search_model_class.query_indices(self),
+                routing=self._search_routing(), **request_params)
+        return JsonDocument(results.get(aggregation.AGGREGATIONS, {}))
+
+    def composite_buckets(self, sources, aggregations=(),
+            size=aggregation.DEFAULT_COMPOSITE_SIZE,
+            name=aggregation.COMPOSITE):
+        """
+        Yield every bucket of a composite aggregation, as JsonDocuments with
+        a "key" dict, a "doc_count" and sub-aggregation results, paging with
+        one request per size buckets. Needs ES 6.1 or later, so the query is
+        sent in its ES 5 form (see aggregation.bool_query).
+        :param sources: terms / histogram / date_histogram Aggregations whose
+            value combinations are the buckets.
+        :param aggregations: sub-aggregations computed per bucket.
+        """
+        self._check_cost()
+        es_query = { const.QUERY: aggregation.bool_query(
+            self._generate_es_query(count_query=True)), const.SIZE: 0 }
+        index = self.search_model_class.query_indices(self)
+        routing = self._search_routing()
+        after = None
+        page = 0
+        while True:
+            composite = aggregation.composite(sources, name, size, after)
+            es_query[aggregation.AGGS] = aggregation.to_dicts([
+                composite.aggregate(*aggregations) ])
+            results = self.search_model_class.search(es_query,
+                    return_raw=True, index=index, routing=routing, page=page)
+            response = results[aggregation.AGGREGATIONS][name]
+            buckets = response[aggregation.BUCKETS]
+            for bucket in buckets:
+                yield JsonDocument(bucket)
+            after = response.get(aggregation.AFTER_KEY)
+            if not buckets or after is None:
+                break
+            page += 1
+
     """Query execution."""
-    def count(self, **request_params):
+    def prepare(self, count_query=False):
+        """
+        Compile this query once into a QueryTemplate. Values for param()
+        placeholders are supplied per request with QueryTemplate.bind, e.g.:
+            template = Book.query().filter(Book.pages > param('min')).prepare()
+            results = template.search(min=300)
+
+        :param count_query: if True, prepare a count request body.
+        """
+        return QueryTemplate(self, count_query=count_query)
+
+    def count(self, at_least=None, cached=False, **request_params):
         """
         Fetch the number of matching documents with the ES count API. See ES
         documentation for supported request_params.
-        """
+
+        count() only counts: count() followed by all() or page() runs the
+        query twice. To show documents with their total, fetch them with
+        page() (one search request returning hits and total) and read its
+        total instead.
+
+        :param at_least: count no further than this: shards stop after
+            at_least matches, and at_least is returned if there are at least
+            that many documents (e.g. to show "1,000+").
+        :param cached: if True and this query instance already ran a search
+            (all() or page()), return that search's total without another
+            request. The total is as of that search.
+        """
+        if cached and self._total is not None and not request_params:
+            if at_least is not None:
+                return min(self._total, at_least)
+            return self._total
+        self._check_cost()
         es_query = self._generate_es_query(count_query=True)
-        return self.search_model_class.count(es_query, **request_params)
+        count = self.search_model_class.count(es_query,
+                index=self.search_model_class.query_indices(self),
+                routing=self._search_routing(), terminate_after=at_least,
+                **request_params)
+        if at_least is not None:
+            return min(count, at_least)
+        return count
+
+    def exists(self, **request_params):
+        """
+        Return True if any document matches, stopping at the first match.
+        """
+        return self.count(at_least=1, **request_params) > 0
 
-    def all(self):
+    def page(self, number=0, decode=None):
+        """
+        Fetch one page of page_size documents, with the total number of
+        matching documents, in one search request: the single-request
+        replacement for count() followed by all(). The total is kept for
+        count(cached=True).
+        :param number: page number, from 0.
+        :param decode: if True, convert mapped date and number fields.
+        """
+        self._check_cost()
+        es_query = self._generate_es_query()
+        page_size = self._page_size or const.DEFAULT_PAGE_SIZE
+        es_query[const.SIZE] = page_size
+        es_query[const.FROM] = number * page_size
+        results = self.search_model_class.search(es_query, decode=decode,
+                index=self.search_model_class.query_indices(self),
+                routing=self._search_routing(), page=number)
+        self._total = results.total
+        return results
+
+    def all(self, decode=None):
         """
         Fetch all documents for given query and return a tuple containing
         (total document count, document sources).
 
         Queries will be executed one <page_size> at a time, until there are no
         more documents, or a specific <limit> has been reached.
+
+        :param decode: if True, convert mapped date and number fields to Python
+            objects. Defaults to the model's "decode_results" setting.
         """
+        self._check_cost()
         es_query = self._generate_es_query()
 
         page_size = self._page_size or const.DEFAULT_PAGE_SIZE
@@ -265,16 +627,19 @@ class SearchQuery(object):
         start = 0
         done = False
         unique_ids = set()
+        index = self.search_model_class.query_indices(self)
+        routing = self._search_routing()
 
         result_set = ResultSet()
 
         while True:
             es_query[const.FROM] = start * page_size
-            results = self.search_model_class.search(es_query, return_raw=False)
+            results = self.search_model_class.search(es_query, return_raw=False,
+                    decode=decode, index=index, routing=routing, page=start)
 
             total = results.total
             if result_set.total is None:
-                result_set.total = total
+                result_set.total = self._total = total
 
             for document in results.documents:
                 if document._id not in unique_ids:
@@ -284,8 +649,12 @@ class SearchQuery(object):
                     if len(unique_ids) >= self._limit:
                         done = True
                         break
-            if results.facets and not result_set.facets:
+            if start == 0:
                 result_set.facets = results.facets
+                result_set.aggregations = results.aggregations
+                # Later pages only need hits
+                es_query.pop(const.FACETS, None)
+                es_query.pop(aggregation.AGGS, None)
 
             if done:
                 break
@@ -298,13 +667,36 @@ class SearchQuery(object):
 
         return result_set
 
-    def delete(cls, **request_params):
+    def delete(self, doc_type=None, batch_size=None, max_per_second=None,
+            progress=None, cancel=None, **request_params):
         """
         Delete all documents that match this query.
-        """
-        es_query = self._generate_es_query()
-        return cls.search_model_class.delete_by_query(doc_type, es_query,
-                **request_params)
+
+        By default this is one delete by query request, returning True. With
+        batch_size or max_per_second, matching ids are scrolled and deleted
+        with throttled bulk requests instead, returning a DeleteProgress (see
+        deletion.py).
+
+        :param doc_type: document type(s) to delete; defaults to the model's.
+        :param batch_size: documents per scroll page and bulk delete.
+        :param max_per_second: maximum documents deleted per second.
+        :param progress: function called with the DeleteProgress after each
+            batch.
+        :param cancel: function returning True to stop before the next batch.
+        :param request_params: pyelasticsearch request arguments of the delete
+            by query request.
+        """
+        if doc_type is None:
+            doc_type = self.search_model_class.doc_type
+        if batch_size is not None or max_per_second is not None:
+            return deletion.throttled_delete(self, doc_type,
+                    batch_size or deletion.DEFAULT_BATCH_SIZE, max_per_second,
+                    progress, cancel)
+        self._check_cost()
+        es_query = self._generate_es_query(count_query=True)
+        return self.search_model_class.delete_by_query(doc_type, es_query,
+                index=self.search_model_class.query_indices(self),
+                routing=self._search_routing(), **request_params)
 
     def __repr__(self):
         return "SearchQuery:[\n%s\n]" % self._generate_es_query()
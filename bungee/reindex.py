@@ -0,0 +1,218 @@
+"""
+This module contains reindex, which copies a model's documents into another
+index, e.g. after a mapping change:
+    progress = Book.reindex_to('books_v2', transform=add_slug,
+        progress=lambda progress: log.info('%r', progress))
+
+The source is read with a scrolled search sorted by _uid. Documents are
+transformed and written by a pool of workers sending chunked bulk requests,
+with refresh disabled on the target until one final refresh. Chunks complete
+in scroll order, so progress.checkpoint is the _uid of the last document
+written; an interrupted reindex resumes from it:
+    Book.reindex_to('books_v2', checkpoint=progress.checkpoint)
+"""
+import collections
+import time
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+from pyelasticsearch.exceptions import (IndexAlreadyExistsError,
+        ElasticHttpNotFoundError)
+
+import bulk
+import const
+import exception
+import instrument
+from field import FILTER_RANGE, FILTER_GT
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_WORKERS = 4
+DEFAULT_SCROLL = '5m'
+SCROLL_ID = '_scroll_id'
+REFRESH_INTERVAL = 'index.refresh_interval'
+DEFAULT_REFRESH_INTERVAL = '1s'
+REFRESH_DISABLED = '-1'
+
+
+class Progress(object):
+    """
+    Progress of a reindex: documents written and skipped out of total, the
+    checkpoint to resume from, and throughput.
+    """
+
+    def __init__(self, total, checkpoint=None):
+        self.total = total
+        self.written = 0
+        self.skipped = 0
+        self.checkpoint = checkpoint
+        self.start = time.time()
+
+    @property
+    def done(self):
+        return self.written + self.skipped
+
+    @property
+    def elapsed(self):
+        return time.time() - self.start
+
+    @property
+    def rate(self):
+        """
+        Documents processed per second.
+        """
+        elapsed = self.elapsed
+        return self.done / elapsed if elapsed else 0.0
+
+    def __repr__(self):
+        return 'Progress(%d/%d documents, %d skipped, %.0f/s, \
+checkpoint=%r)' % (self.done, self.total, self.skipped, self.rate,
+                self.checkpoint)
+
+
+def uid(hit):
+    return u'%s#%s' % (hit[const.TYPE], hit[const.ID])
+
+
+def scroll(connection, query, index, doc_type=None, scroll=DEFAULT_SCROLL,
+        **request_params):
+    """
+    Yield the search responses of a scrolled search, page by page, until a
+    page has no hits. The scroll is cleared when the generator finishes or
+    is closed; iterate it with contextlib.closing to clear it as soon as a
+    caller stops early or fails.
+    :param request_params: pyelasticsearch arguments of the first request.
+    """
+    response = connection.search(query, index=index, doc_type=doc_type,
+            es_scroll=scroll, **request_params)
+    try:
+        while response[const.HITS][const.HITS]:
+            yield response
+            response = connection.send_request('GET', [ '_search', 'scroll' ],
+                    response[SCROLL_ID], query_params={ 'scroll': scroll },
+                    encode_body=False)
+    finally:
+        clear_scroll(connection, response.get(SCROLL_ID))
+
+
+def clear_scroll(connection, scroll_id):
+    """
+    Free the search contexts of a scroll instead of holding them until the
+    scroll times out. Scrolls that already expired are ignored.
+    """
+    if not scroll_id:
+        return
+    try:
+        connection.send_request('DELETE', [ '_search', 'scroll' ], scroll_id,
+                encode_body=False)
+    except ElasticHttpNotFoundError:
+        pass
+
+
+def source_query(checkpoint, chunk_size):
+    """
+    Return the scroll query reading documents after checkpoint in _uid order.
+    """
+    query = { const.MATCH_ALL: {} }
+    if checkpoint is not None:
+        query = { const.FILTERED: { const.QUERY: query, const.FILTER: {
+            FILTER_RANGE: { const.UID: { FILTER_GT: checkpoint } } } } }
+    return { const.QUERY: query, const.SORT: [ { const.UID: const.ASC } ],
+        const.SIZE: chunk_size }
+
+
+def create_target(connection, source_index, target_index):
+    """
+    Create the target index with the source mappings, unless it exists.
+    """
+    mappings = {}
+    source_mappings = connection.get_mapping(source_index)
+    for index_name in sorted(source_mappings):
+        for doc_type, mapping in source_mappings[index_name].iteritems():
+            mappings.setdefault(doc_type, mapping)
+    try:
+        connection.create_index(target_index, { 'mappings': mappings })
+    except IndexAlreadyExistsError:
+        pass
+
+
+def write_chunk(model, target_index, hits, transform):
+    """
+    Transform and bulk index one chunk of hits; return (written, skipped).
+    """
+    actions = []
+    for hit in hits:
+        doc = hit[const.SOURCE]
+        if transform is not None:
+            doc = transform(doc)
+            if doc is None:
+                continue
+        actions.append((bulk.action(const.INDEX, target_index, hit[const.TYPE],
+            hit[const.ID], routing=model.routing_for(doc),
+            parent=model.parent_for(doc)), doc))
+    if actions:
+        with instrument.request('reindex', model, target_index) as event:
+            event.hits = len(actions)
+            response = event.send(bulk.send, model.connection, actions)
+        failed = [ item for item in response[const.ITEMS]
+            if not bulk.succeeded(item) ]
+        if failed:
+            raise exception.IndexDocumentError("Failed to reindex %d docs. \
+First failure: %s" % (len(failed), failed[0]))
+    return len(actions), len(hits) - len(actions)
+
+
+def reindex(model, target_index, transform=None, doc_type=None,
+        chunk_size=DEFAULT_CHUNK_SIZE, workers=DEFAULT_WORKERS,
+        checkpoint=None, progress=None, scroll_timeout=DEFAULT_SCROLL):
+    """
+    Copy a model's documents into target_index and return the final Progress.
+    :param transform: function of a document source returning the document
+        to write, or None to skip it.
+    :param doc_type: document type(s) to copy; defaults to all.
+    :param chunk_size: documents per scroll page and bulk request.
+    :param workers: number of threads transforming and writing chunks.
+    :param checkpoint: _uid to resume after, from Progress.checkpoint.
+    :param progress: function called with the Progress after each chunk.
+    :param scroll_timeout: how long ES keeps the scroll context between pages.
+    """
+    connection = model.connection
+    create_target(connection, model.index_name, target_index)
+    settings = connection.get_settings(target_index).get(target_index, {})
+    refresh_interval = settings.get('settings', {}).get(REFRESH_INTERVAL,
+            DEFAULT_REFRESH_INTERVAL)
+    connection.update_settings(target_index,
+            { REFRESH_INTERVAL: REFRESH_DISABLED })
+
+    status = None
+    pool = ThreadPool(workers)
+    pending = collections.deque()
+    try:
+        def finish(last_uid, result):
+            written, skipped = result.get()
+            status.written += written
+            status.skipped += skipped
+            status.checkpoint = last_uid
+            if progress is not None:
+                progress(status)
+
+        with closing(scroll(connection, source_query(checkpoint, chunk_size),
+                model.index_name, doc_type, scroll_timeout)) as responses:
+            for response in responses:
+                hits = response[const.HITS][const.HITS]
+                if status is None:
+                    status = Progress(response[const.HITS][const.TOTAL],
+                            checkpoint)
+                pending.append((uid(hits[-1]), pool.apply_async(write_chunk,
+                    (model, target_index, hits, transform))))
+                # Bound the chunks held in memory
+                while len(pending) > workers:
+                    finish(*pending.popleft())
+        while pending:
+            finish(*pending.popleft())
+    finally:
+        pool.close()
+        pool.join()
+        connection.update_settings(target_index,
+                { REFRESH_INTERVAL: refresh_interval })
+        connection.refresh(target_index)
+    return status or Progress(0, checkpoint)
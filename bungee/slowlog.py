@@ -0,0 +1,152 @@
+"""
+This module contains a slow-query log, built on the instrumentation hooks.
+
+Searches, counts and deletes by query slower than a threshold are logged
+with their compiled JSON body, model, index, page (for SearchQuery.all),
+timings and the Python call site that issued them:
+    from bungee import slowlog
+    slowlog.configure(threshold=0.5, sample_rate=0.1, max_per_second=1)
+
+Slow requests are sampled and rate limited, so the log is safe to leave on
+in production.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+
+import instrument
+
+QUERY_OPERATIONS = ('search', 'search_template', 'count', 'delete_by_query')
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+TESTS_DIR = os.path.join(PACKAGE_DIR, 'tests')
+
+
+def call_site():
+    """
+    Return "file:line in function" for the innermost stack frame outside of
+    bungee (tests excepted), or None.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        if (not filename.startswith(PACKAGE_DIR)
+                or filename.startswith(TESTS_DIR)):
+            return '%s:%d in %s' % (filename, frame.f_lineno,
+                    frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+class RateLimiter(object):
+    """
+    Token bucket allowing rate events per second, with bursts of up to burst.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                    self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class SlowQueryLog(instrument.Sink):
+    """
+    Instrumentation sink recording requests slower than threshold.
+    :param threshold: wall time in seconds above which a request is slow.
+    :param sample_rate: fraction of slow requests recorded (0 - 1).
+    :param max_per_second: maximum number of records per second; None for
+        no limit.
+    :param logger: logging.Logger to write records to.
+    :param level: logging level for records.
+    :param keep: number of most recent records kept in self.records.
+    :param operations: instrumented operations to watch.
+    """
+
+    def __init__(self, threshold=1.0, sample_rate=1.0, max_per_second=1,
+            logger=None, level=logging.WARNING, keep=100,
+            operations=QUERY_OPERATIONS):
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.limiter = RateLimiter(max_per_second) if max_per_second else None
+        self.logger = logger or logging.getLogger('bungee.slowlog')
+        self.level = level
+        self.records = deque(maxlen=keep)
+        self.operations = set(operations)
+        self.dropped = 0
+
+    def handle(self, event):
+        if event.operation not in self.operations:
+            return
+        if event.wall_time < self.threshold:
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if self.limiter is not None and not self.limiter.allow():
+            self.dropped += 1
+            return
+        record = self.make_record(event)
+        self.records.append(record)
+        self.logger.log(self.level, 'Slow %(operation)s on %(model)s \
+[%(index)s] page=%(page)s: wall=%(wall_ms).1fms took=%(took)sms from \
+%(call_site)s\n%(body)s', record)
+
+    def make_record(self, event):
+        """
+        Return a dictionary describing a slow request.
+        """
+        return {
+            'operation': event.operation,
+            'model': event.model.__name__,
+            'index': event.index,
+            'page': event.extra.get('page'),
+            'wall_ms': event.wall_time * 1000,
+            'request_ms': (event.request_time or 0) * 1000,
+            'wrap_ms': event.wrap_time * 1000,
+            'took': event.took,
+            'total': event.total,
+            'body': json.dumps(event.body, default=repr, sort_keys=True),
+            'call_site': call_site(),
+            'time': time.time(),
+        }
+
+
+SLOW_LOG = None
+
+
+def configure(threshold=1.0, **options):
+    """
+    Enable the slow-query log, replacing any previous configuration. See
+    SlowQueryLog for options. Returns the SlowQueryLog.
+    """
+    global SLOW_LOG
+    disable()
+    SLOW_LOG = instrument.add_sink(SlowQueryLog(threshold, **options))
+    return SLOW_LOG
+
+
+def disable():
+    """
+    Disable the slow-query log.
+    """
+    global SLOW_LOG
+    if SLOW_LOG is not None:
+        instrument.remove_sink(SLOW_LOG)
+        SLOW_LOG = None
@@ -0,0 +1,131 @@
+"""
+This module contains dump and load, which snapshot a model's documents to a
+newline-delimited JSON file and load them back:
+    Book.dump('books.ndjson.gz')
+    Book.load('books.ndjson.gz', index='books_staging')
+
+Files hold bulk API lines: an index action (type, id and routing, but no
+index) followed by the document source. Loading sends raw chunks of the file
+to the bulk API without decoding documents. Uncompressed files are memory
+mapped; files ending in ".gz" are gzip compressed and streamed.
+"""
+import gzip
+import mmap
+from contextlib import closing
+
+import bulk
+import const
+import exception
+import instrument
+import reindex
+
+GZIP_SUFFIX = '.gz'
+COMPRESS_LEVEL = 6
+DEFAULT_CHUNK_BYTES = 5 * 1024 * 1024
+
+
+def is_compressed(path):
+    return path.endswith(GZIP_SUFFIX)
+
+
+def dump(model, path, doc_type=None, chunk_size=reindex.DEFAULT_CHUNK_SIZE,
+        scroll_timeout=reindex.DEFAULT_SCROLL):
+    """
+    Write all documents of a model to path; return the number written.
+    :param doc_type: document type(s) to dump; defaults to all.
+    :param chunk_size: documents per scroll page.
+    """
+    connection = model.connection
+    query = { const.QUERY: { const.MATCH_ALL: {} }, const.SIZE: chunk_size }
+    if is_compressed(path):
+        output = gzip.open(path, 'wb', COMPRESS_LEVEL)
+    else:
+        output = open(path, 'wb')
+    count = 0
+    try:
+        with closing(reindex.scroll(connection, query, model.index_name,
+                doc_type, scroll_timeout)) as responses:
+            for response in responses:
+                hits = response[const.HITS][const.HITS]
+                output.write(bulk.body(connection, [ (bulk.action(
+                    const.INDEX, None, hit[const.TYPE], hit[const.ID],
+                    routing=model.routing_for(hit[const.SOURCE]),
+                    parent=model.parent_for(hit[const.SOURCE])),
+                    hit[const.SOURCE]) for hit in hits ]))
+                count += len(hits)
+    finally:
+        output.close()
+    return count
+
+
+def mapped_chunks(path, chunk_bytes):
+    """
+    Yield chunks of an uncompressed dump of about chunk_bytes, each ending
+    after a document source line.
+    """
+    with open(path, 'rb') as input_file:
+        if not input_file.read(1):
+            return
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            start = 0
+            size = mapped.size()
+            while start < size:
+                end = mapped.find('\n', min(start + chunk_bytes, size - 1))
+                end = size if end == -1 else end + 1
+                chunk = mapped[start:end]
+                # Actions and sources alternate: end on an even line count
+                if chunk.count('\n') % 2:
+                    next_end = mapped.find('\n', end)
+                    end = size if next_end == -1 else next_end + 1
+                    chunk = mapped[start:end]
+                yield chunk
+                start = end
+        finally:
+            mapped.close()
+
+
+def compressed_chunks(path, chunk_bytes):
+    """
+    Yield chunks of a gzip compressed dump of about chunk_bytes, each ending
+    after a document source line.
+    """
+    input_file = gzip.open(path, 'rb')
+    try:
+        lines = []
+        length = 0
+        for line in input_file:
+            lines.append(line)
+            length += len(line)
+            if length >= chunk_bytes and not len(lines) % 2:
+                yield ''.join(lines)
+                lines = []
+                length = 0
+        if lines:
+            yield ''.join(lines)
+    finally:
+        input_file.close()
+
+
+def load(model, path, index=None, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """
+    Bulk index a dump into index (by default the model's index); return the
+    number of documents loaded.
+    :param chunk_bytes: approximate size of each bulk request.
+    """
+    index = index or model.index_name
+    chunks = compressed_chunks if is_compressed(path) else mapped_chunks
+    count = 0
+    for chunk in chunks(path, chunk_bytes):
+        with instrument.request('load', model, index) as event:
+            response = event.send(model.connection.send_request, 'POST',
+                    [ index, bulk.BULK ], chunk, encode_body=False)
+            event.hits = len(response[const.ITEMS])
+        failed = [ item for item in response[const.ITEMS]
+            if not bulk.succeeded(item) ]
+        if failed:
+            raise exception.IndexDocumentError("Failed to load %d docs after \
+%d. First failure: %s" % (len(failed), count, failed[0]))
+        count += len(response[const.ITEMS])
+    model.connection.refresh(index)
+    return count
@@ -0,0 +1,176 @@
+"""
+This module contains warmup, which prepares every SearchModel of a process
+before it serves requests, e.g. in a worker's post-fork hook:
+    Book.add_warmup_query(Book.query().order_by(Book.published.desc()))
+    report = bungee.warmup()
+
+Independent steps run concurrently on a thread pool:
+- mappings not loaded yet (or all, with reload_mappings) are fetched with one
+  get_mapping per connection for the indices of all its models;
+- every configured URL is requested once per pooled connection, so requests
+  reuse open keep-alive connections;
+- the models' registered warm-up queries are then run, loading field data
+  and caches on the ES side.
+Failures don't stop other steps: they are warned about and listed in the
+returned WarmupReport.
+"""
+import fnmatch
+import time
+import warnings
+from multiprocessing.pool import ThreadPool
+
+from pyelasticsearch.exceptions import ElasticHttpNotFoundError
+
+import instrument
+import model as model_module
+
+DEFAULT_WORKERS = 8
+
+
+class WarmupReport(object):
+    """
+    What a warmup did: indices whose mappings were fetched, URLs opened,
+    queries run, and (step description, exception) errors.
+    """
+
+    def __init__(self, models):
+        self.models = models
+        self.indices = []
+        self.urls = []
+        self.queries = 0
+        self.errors = []
+        self.start = time.time()
+        self.elapsed = None
+
+    def __repr__(self):
+        return 'WarmupReport(%d models, %d indices, %d urls, %d queries, \
+%d errors, %.3fs)' % (len(self.models), len(self.indices), len(self.urls),
+                self.queries, len(self.errors), self.elapsed or 0.0)
+
+
+def model_urls(model):
+    urls = model._urls
+    if isinstance(urls, basestring):
+        urls = [ urls ]
+    return [ url.rstrip('/') for url in urls ]
+
+
+def matching_mappings(model, mappings):
+    """
+    Return the part of a get_mapping response belonging to a model's index
+    name, which may be a wildcard; None if nothing matches (e.g. an alias).
+    """
+    matching = dict((index_name, mapping)
+        for index_name, mapping in mappings.iteritems()
+        if index_name == model.index_name
+        or fnmatch.fnmatchcase(index_name, model.index_name))
+    return matching or None
+
+
+def load_mappings(connection, models, reload_mappings):
+    """
+    Fetch the mappings of models sharing a connection with one request and
+    bind their fields; return the index names fetched. Models whose index
+    isn't in the response fall back to their own get_mapping.
+    """
+    if not reload_mappings:
+        models = [ model for model in models
+            if model.index_name not in model_module.INDEX_MAPPINGS ]
+    index_names = sorted(set(model.index_name for model in models))
+    if not index_names:
+        return []
+    try:
+        with instrument.request('get_mapping', models[0],
+                ','.join(index_names)) as event:
+            mappings = event.send(connection.get_mapping, index=index_names)
+    except ElasticHttpNotFoundError:
+        # One missing index fails the whole request
+        mappings = {}
+    for model in models:
+        matching = matching_mappings(model, mappings)
+        if matching is not None:
+            model.bind_field_mappings(matching)
+        else:
+            model.initialize_search_fields(force_reload=True)
+    return index_names
+
+
+def open_connection(connection, url):
+    """
+    Send one keep-alive request to url through the connection's HTTP session.
+    """
+    response = connection.session.get(url + '/', timeout=connection.timeout)
+    response.raise_for_status()
+    return url
+
+
+def run_query(query):
+    query.page(0)
+    return 1
+
+
+def run_all(pool, steps, report):
+    """
+    Run (description, function, args) steps on the pool; return the results
+    of those that succeeded and record the errors of the others.
+    """
+    pending = [ (description, pool.apply_async(function, args))
+        for description, function, args in steps ]
+    results = []
+    for description, result in pending:
+        try:
+            results.append(result.get())
+        except Exception, e:
+            warnings.warn('Warmup failed to %s: %s' % (description, e))
+            report.errors.append((description, e))
+    return results
+
+
+def warmup(models=None, reload_mappings=False, connections=1, queries=True,
+        workers=DEFAULT_WORKERS):
+    """
+    Warm up SearchModel classes and return a WarmupReport.
+    :param models: classes to warm up; defaults to all registered models.
+    :param reload_mappings: if True, fetch mappings even if already loaded.
+    :param connections: keep-alive connections to open per URL.
+    :param queries: if True, run the models' warm-up queries.
+    :param workers: number of threads running steps concurrently.
+    """
+    if models is None:
+        models = model_module.registered_models()
+    models = list(models)
+    report = WarmupReport(models)
+    by_connection = {}
+    for model in models:
+        by_connection.setdefault(id(model.connection),
+                (model.connection, []))[1].append(model)
+
+    steps = []
+    for connection, connection_models in by_connection.values():
+        steps.append(('load mappings of %s' % ', '.join(model.__name__
+            for model in connection_models), load_mappings,
+            (connection, connection_models, reload_mappings)))
+        if not hasattr(connection, 'session'):
+            continue
+        urls = sorted(set(url for model in connection_models
+            for url in model_urls(model)))
+        for url in urls:
+            steps.extend(('open %s' % url, open_connection, (connection, url))
+                for _ in xrange(connections))
+
+    pool = ThreadPool(workers)
+    try:
+        for result in run_all(pool, steps, report):
+            if isinstance(result, list):
+                report.indices.extend(result)
+            elif result not in report.urls:
+                report.urls.append(result)
+        if queries:
+            report.queries = sum(run_all(pool, [ ('run warm-up query %r'
+                % query, run_query, (query,)) for model in models
+                for query in model._warmup_queries ], report))
+    finally:
+        pool.close()
+        pool.join()
+    report.elapsed = time.time() - report.start
+    return report
@@ -0,0 +1,201 @@
+"""
+This module contains classes for prepared (parameterized) queries.
+
+A query built with param() placeholders, e.g.:
+    query = Book.query().filter(Book.pages > param('min_pages'))
+    template = query.prepare()
+
+is compiled once; template.bind(min_pages=300) then produces the request
+body by filling in only the placeholder slots, copying just the containers
+on the path to each slot and sharing everything else. Templates search the
+indices and routing of the query they were prepared from, and apply its
+strict() cost check when prepared and to every bound body. Indices are
+resolved per request, so partitions pruned by "now" date math move with the
+clock.
+"""
+import json
+
+import const
+
+PARAM_MARKER = '__bungee_param_%d__'
+
+
+class Param(object):
+    """
+    A named placeholder for a query operand. Params used in SearchField
+    expressions remember the field's encoder, so bound values are converted
+    the same way literal operands would be.
+    """
+
+    __slots__ = ('name', 'encode')
+
+    def __init__(self, name, encode=None):
+        self.name = name
+        self.encode = encode
+
+    def encoded_by(self, encode):
+        """
+        Return a copy of this Param that converts bound values with encode.
+        """
+        return self.__class__(self.name, encode)
+
+    def __call__(self, value):
+        if self.encode is None:
+            return value
+        return self.encode(value)
+
+    def __repr__(self):
+        return 'param(%r)' % self.name
+
+
+def param(name):
+    """
+    Return a placeholder for a value supplied when a prepared query is bound.
+    """
+    return Param(name)
+
+
+def find_params(value):
+    """
+    Return a trie of the Params in a compiled query: nested dicts keyed by the
+    dict keys / list indexes leading to each Param.
+    """
+    if isinstance(value, Param):
+        return value
+    if isinstance(value, dict):
+        items = value.iteritems()
+    elif isinstance(value, list):
+        items = enumerate(value)
+    else:
+        return None
+    slots = {}
+    for key, item in items:
+        found = find_params(item)
+        if found is not None:
+            slots[key] = found
+    return slots or None
+
+
+def fill_params(value, slots, values):
+    """
+    Return a copy of value with the Params in slots replaced by values.
+    Only containers on the path to a Param are copied.
+    """
+    value = dict(value) if isinstance(value, dict) else list(value)
+    for key, slot in slots.iteritems():
+        if isinstance(slot, Param):
+            value[key] = slot(values[slot.name])
+        else:
+            value[key] = fill_params(value[key], slot, values)
+    return value
+
+
+def param_names(slots, names=None):
+    """
+    Return the set of Param names in a slot trie.
+    """
+    if names is None:
+        names = set()
+    if isinstance(slots, Param):
+        names.add(slots.name)
+    elif slots:
+        for slot in slots.itervalues():
+            param_names(slot, names)
+    return names
+
+
+class QueryTemplate(object):
+    """
+    A SearchQuery compiled once, with named placeholders to be bound per
+    request. Created by SearchQuery.prepare().
+    """
+
+    def __init__(self, query, count_query=False):
+        query._check_cost()
+        self.search_model_class = query.search_model_class
+        self.count_query = count_query
+        self.query = query
+        self.routing = query._search_routing()
+        self.check_body_cost = query._check_body_cost
+        body = query._generate_es_query(count_query=count_query)
+        if not count_query:
+            page_size = query._page_size or const.DEFAULT_PAGE_SIZE
+            body[const.SIZE] = page_size
+            body[const.FROM] = (query._offset or 0) * page_size
+        self.body = body
+        self.slots = find_params(body)
+        self.params = param_names(self.slots)
+
+    @property
+    def index(self):
+        """
+        The index name(s) the prepared query searches.
+        """
+        return self.search_model_class.query_indices(self.query)
+
+    def _check_values(self, values):
+        missing = self.params.difference(values)
+        if missing:
+            raise ValueError, "Missing template parameters: %s" % (
+                    ', '.join(sorted(missing)))
+
+    def bind(self, **values):
+        """
+        Return the request body with every placeholder filled in.
+        """
+        self._check_values(values)
+        if not self.slots:
+            return dict(self.body)
+        body = fill_params(self.body, self.slots, values)
+        self.check_body_cost(body)
+        return body
+
+    def server_body(self, **values):
+        """
+        Return a request body for the ES search template API. The compiled
+        query is sent as a mustache template, with each bound value passed as
+        JSON text in "params".
+        """
+        self.bind(**values)
+        placeholders = []
+        def encode_param(value):
+            if not isinstance(value, Param):
+                raise TypeError, repr(value) + " is not JSON serializable"
+            placeholders.append(value)
+            return PARAM_MARKER % (len(placeholders) - 1)
+        template = json.dumps(self.body, default=encode_param)
+        params = {}
+        for index, placeholder in enumerate(placeholders):
+            key = '%s_%d' % (placeholder.name, index)
+            template = template.replace('"%s"' % (PARAM_MARKER % index),
+                    '{{{%s}}}' % key)
+            params[key] = json.dumps(placeholder(values[placeholder.name]))
+        return { const.TEMPLATE: template, const.PARAMS: params }
+
+    def search(self, server=False, return_raw=False, decode=None, **values):
+        """
+        Bind values and run the search.
+        :param server: if True, use the ES search template API.
+        :param return_raw: if True, return pyelasticsearch response.
+        :param decode: if True, convert mapped date and number fields.
+        """
+        if server:
+            return self.search_model_class.search_template(
+                    self.server_body(**values), return_raw=return_raw,
+                    decode=decode, index=self.index, routing=self.routing)
+        return self.search_model_class.search(self.bind(**values),
+                return_raw=return_raw, decode=decode, index=self.index,
+                routing=self.routing)
+
+    def count(self, **values):
+        """
+        Bind values and run a count request. The template must have been
+        prepared with count_query=True.
+        """
+        if not self.count_query:
+            raise ValueError, "Template was not prepared as a count query"
+        return self.search_model_class.count(self.bind(**values),
+                index=self.index, routing=self.routing)
+
+    def __repr__(self):
+        return "QueryTemplate:[\n%s\n]" % self.body
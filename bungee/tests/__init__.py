@@ -1,17 +1,21 @@
 """
 bungee tests
 
-These require an ElasticSearch server running on localhost:9200.
+These require an ElasticSearch server running on localhost:9200, except
+memory_tests, which run the same tests against the in-memory backend,
+profiler_tests, which replay ES responses from fixtures/,
+and codec_tests and compression_tests.
 """
 import unittest
 
 from bungee import SearchModel
-
-from pyelasticsearch import ElasticSearch
+from bungee.model import get_connection
 
 
 class BungeeTestCase(unittest.TestCase):
 
+    url = 'http://localhost:9200'
+
     books = [
         {   '_id': 'A',
             'title': 'Heart of Darkness',
@@ -72,20 +76,25 @@ class BungeeTestCase(unittest.TestCase):
         }
     }
 
-#    Figure out if / how to support this
-#    nested_mapping = {
-#        'book': {
-#            'properties': {
-#                'title': { 'type': 'string' },
-#                'author': { 'type': 'nested' },
-#                'year': { 'type': 'date', 'format': 'YYYY-MM-dd' },
-#                'pages': { 'type': 'integer' }
-#            }
-#        }
-#    }
+    nested_mapping = {
+        'anthology': {
+            'properties': {
+                'title': { 'type': 'string' },
+                'authors': {
+                    'type': 'nested',
+                    'properties': {
+                        'first': { 'type': 'string' },
+                        'last': { 'type': 'string' },
+                        'born': { 'type': 'date', 'format': 'YYYY-MM-dd' }
+                    }
+                }
+            }
+        }
+    }
 
     def setUp(self):
-        es_connection = ElasticSearch('http://localhost:9200')
+        es_url = self.url
+        es_connection = get_connection([ es_url ])
         try:
             es_connection.delete_index('unit_tests')
         except:
@@ -94,6 +103,7 @@ class BungeeTestCase(unittest.TestCase):
 
         class TestModel(SearchModel):
             index_name = 'unit_tests'
+            url = es_url
 
         self.model = TestModel
 
@@ -0,0 +1,56 @@
+import datetime
+import unittest
+
+from bungee import codec
+
+
+class CodecTestCase(unittest.TestCase):
+    when = datetime.datetime(2020, 1, 2, 3, 4, 5, 678000)
+
+    def codec(self, date_format):
+        mapping = { 'type': 'date', 'format': date_format }
+        return codec.value_encoder(mapping), codec.decoder_for(mapping)
+
+    def test_quoted_literals(self):
+        encode, decode = self.codec("yyyy-MM-dd'T'HH:mm:ss")
+        self.assertEqual(encode(self.when), '2020-01-02T03:04:05')
+        self.assertEqual(decode('2020-01-02T03:04:05'),
+            datetime.datetime(2020, 1, 2, 3, 4, 5))
+        encode, decode = self.codec("yyyy '100%' ''HH''")
+        self.assertEqual(encode(self.when), "2020 100% '03'")
+        self.assertEqual(decode("2020 100% '03'"),
+            datetime.datetime(2020, 1, 1, 3))
+
+    def test_epoch_formats(self):
+        encode, decode = self.codec('epoch_millis||yyyy-MM-dd')
+        self.assertEqual(encode(self.when), 1577934245678)
+        self.assertEqual(decode(1577934245678), self.when)
+        self.assertEqual(decode('1577934245678'), self.when)
+        self.assertEqual(decode('2020-01-02'), datetime.datetime(2020, 1, 2))
+        encode, decode = self.codec('yyyy-MM-dd||epoch_second')
+        self.assertEqual(encode(self.when), '2020-01-02')
+        self.assertEqual(decode(1577934245),
+            datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(codec.strftime_formats({ 'format':
+            'yyyy||epoch_second' }), [ '%Y', codec.EPOCH_SECOND ])
+
+    def test_zones(self):
+        encode, decode = self.codec("yyyy-MM-dd'T'HH:mm:ssZ")
+        self.assertEqual(encode(self.when), '2020-01-02T03:04:05+0000')
+        self.assertEqual(decode('2020-01-02T03:04:05+0130'),
+            datetime.datetime(2020, 1, 2, 1, 34, 5))
+        encode, decode = self.codec("yyyy-MM-dd'T'HH:mm:ss.SSSZZ")
+        self.assertEqual(encode(self.when), '2020-01-02T03:04:05.678+00:00')
+        self.assertEqual(decode('2020-01-02T03:04:05.678-02:00'),
+            datetime.datetime(2020, 1, 2, 5, 4, 5, 678000))
+
+    def test_optional_time_zones(self):
+        decode = codec.decoder_for({ 'type': 'date' })
+        self.assertEqual(decode('2020-01-02T03:04:05Z'),
+            datetime.datetime(2020, 1, 2, 3, 4, 5))
+        self.assertEqual(decode('2020-01-02T03:04:05.123+01:00'),
+            datetime.datetime(2020, 1, 2, 2, 4, 5, 123000))
+        self.assertEqual(decode('2020-01-02T03:04-0130'),
+            datetime.datetime(2020, 1, 2, 4, 34))
+        self.assertEqual(decode('2020-01-02'), datetime.datetime(2020, 1, 2))
+        self.assertEqual(decode('01/02/2020'), '01/02/2020')
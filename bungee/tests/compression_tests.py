@@ -0,0 +1,103 @@
+import httplib
+import json
+import unittest
+import zlib
+from StringIO import StringIO
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+from bungee import SearchModel, compression, instrument
+from bungee.model import get_connection
+
+
+class OriginalResponse(object):
+    msg = httplib.HTTPMessage(StringIO(''))
+
+
+class RawResponse(object):
+    """
+    The urllib3 response requests reads cookies from.
+    """
+    _original_response = OriginalResponse()
+
+
+class CapturingAdapter(BaseAdapter):
+    """
+    Transport adapter recording requests and answering {"ok": true}.
+    """
+
+    def __init__(self):
+        super(CapturingAdapter, self).__init__()
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        response = Response()
+        response.status_code = 200
+        response._content = json.dumps({ 'ok': True })
+        response.raw = RawResponse()
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def connection(self, encoding):
+        connection = get_connection([ 'http://compression.test:9200' ],
+                encoding)
+        adapter = CapturingAdapter()
+        connection.session.mount('http://', adapter)
+        return connection, adapter
+
+    def test_compressed_requests(self):
+        body = '{"index": {}}\n{"title": "Heart of Darkness"}\n' * 100
+        for encoding, wbits in (('gzip', 16 + zlib.MAX_WBITS),
+                ('deflate', zlib.MAX_WBITS)):
+            connection, adapter = self.connection(encoding)
+            connection.send_request('POST', [ '_bulk' ], body,
+                    encode_body=False)
+            connection.send_request('GET', [ '_search' ], { 'size': 1 })
+            large, small = adapter.requests
+            self.assertEqual(large.headers['Content-Encoding'], encoding)
+            self.assertEqual(zlib.decompress(large.body, wbits), body)
+            self.assertNotIn('Content-Encoding', small.headers)
+            self.assertEqual(json.loads(small.body), { 'size': 1 })
+            self.assertEqual(small.headers['Accept-Encoding'], 'gzip, deflate')
+
+    def test_measured_bytes(self):
+        body = '{"index": {}}\n{"title": "Heart of Darkness"}\n' * 100
+        connection, adapter = self.connection('gzip')
+        event = instrument.RequestEvent('bulk_index', SearchModel, 'books')
+        event.send(connection.send_request, 'POST', [ '_bulk' ], body,
+                encode_body=False)
+        connection.send_request('GET', [ '_search' ], { 'size': 1 })
+        self.assertEqual(event.request_bytes, len(adapter.requests[0].body))
+        self.assertLess(event.request_bytes, len(body))
+        self.assertEqual(event.response_bytes, len('{"ok": true}'))
+        memory = instrument.RequestEvent('refresh', SearchModel, 'books')
+        memory.send(get_connection([ 'memory://' ]).refresh)
+        self.assertIsNone(memory.request_bytes)
+
+    def test_configuration(self):
+        self.assertIsNot(get_connection([ 'http://compression.test:9200' ]),
+                get_connection([ 'http://compression.test:9200' ], 'gzip'))
+        self.assertRaises(ValueError, compression.CompressingSession, 'br')
+        session = compression.CompressingSession(compress_responses=False)
+        self.assertEqual(session.headers['Accept-Encoding'], 'identity')
+
+        memory = get_connection([ 'memory://' ])
+        memory.create_index('unit_tests_compression')
+        try:
+            class Book(SearchModel):
+                index_name = 'unit_tests_compression'
+                url = 'memory://'
+                compression = 'gzip'
+
+            self.assertIs(Book.connection, memory)
+        finally:
+            memory.delete_index('unit_tests_compression')
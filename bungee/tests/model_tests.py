@@ -1,5 +1,15 @@
+import os
+import shutil
+import tempfile
+
+from bungee import bulk, instrument, warmup
+from bungee.bulk import send
+from bungee.exception import IndexDocumentError, UpdateIndexError
 from bungee.tests import BungeeTestCase
 from bungee.field import SearchField
+from bungee.model import registered_models
+
+from pyelasticsearch import ElasticHttpError
 
 
 class ModelTestCase(BungeeTestCase):
@@ -47,6 +57,8 @@ class ModelTestCase(BungeeTestCase):
         self.model.bulk_index(self.books, doc_type='book')
         self.assertIsInstance(self.model.title.untouched, SearchField)
         self.assertIsInstance(self.model.title, SearchField)
+        self.assertIs(self.model.title.untouched, self.model.title.untouched)
+        self.assertEqual(self.model.author.born.hierarchy, 'author.born')
 
     def test_delete(self):
         self.model.bulk_index(self.books, doc_type='book')
@@ -57,3 +69,139 @@ class ModelTestCase(BungeeTestCase):
         self.assertIsNone(self.model.get('B', doc_type='book'))
         self.assertIsNone(self.model.get('C', doc_type='book'))
 
+
+    def test_instrumentation(self):
+        sink = instrument.add_sink(instrument.HistogramSink())
+        try:
+            self.model.bulk_index(self.books, doc_type='book')
+            self.model.query().all()
+            self.model.get('A', doc_type='book')
+        finally:
+            instrument.remove_sink(sink)
+        summary = sink.summary()
+        for operation in ('bulk_index', 'refresh', 'search', 'get'):
+            self.assertEqual(summary[operation]['wall_time']['count'], 1)
+        self.assertIn('took', summary['search'])
+
+    def test_reindex_to(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        connection = self.model.connection
+        def transform(doc):
+            if doc['_id'] == 'B':
+                return None
+            doc['pages'] = doc['pages'] * 2
+            return doc
+        reports = []
+        try:
+            progress = self.model.reindex_to('unit_tests_copy', transform,
+                    chunk_size=1, workers=2, progress=lambda progress:
+                    reports.append((progress.done, progress.checkpoint)))
+            self.assertEqual((progress.total, progress.written,
+                progress.skipped), (3, 2, 1))
+            self.assertEqual(reports, [ (1, 'book#A'), (2, 'book#B'),
+                (3, 'book#C') ])
+            hits = connection.search({ 'sort': [ '_id' ] },
+                    index='unit_tests_copy')['hits']['hits']
+            self.assertEqual([ (hit['_id'], hit['_source']['pages'])
+                for hit in hits ], [ ('A', 144), ('C', 1030) ])
+            self.assertEqual(connection.get_settings('unit_tests_copy')[
+                'unit_tests_copy']['settings']['index.refresh_interval'], '1s')
+
+            progress = self.model.reindex_to('unit_tests_resumed',
+                    checkpoint='book#A')
+            self.assertEqual((progress.written, progress.checkpoint),
+                    (2, 'book#C'))
+            self.assertEqual(connection.count({ 'match_all': {} },
+                index='unit_tests_resumed')['count'], 2)
+        finally:
+            for index in ('unit_tests_copy', 'unit_tests_resumed'):
+                try:
+                    connection.delete_index(index)
+                except:
+                    pass
+
+    def test_dump_load(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('books.ndjson', 'books.ndjson.gz'):
+                path = os.path.join(directory, name)
+                self.assertEqual(self.model.dump(path, chunk_size=2), 3)
+                self.model.delete_all('book')
+                self.assertEqual(self.model.load(path, chunk_bytes=10), 3)
+                books = self.model.multi_get([ 'A', 'B', 'C' ], 'book')
+                self.assertEqual([ book.title for book in books.documents ],
+                    [ 'Heart of Darkness', 'Catch-22', 'Infinite Jest' ])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_update(self):
+        model = self.model
+        model.bulk_index(self.books, doc_type='book')
+        version = model.update('A', { 'pages': 80,
+            'author': { 'first': 'J.' } }, doc_type='book')
+        book = model.get('A', doc_type='book')
+        self.assertEqual((book.pages, book.author.first, book.author.last),
+                (80, 'J.', 'Conrad'))
+        self.assertRaises(ElasticHttpError, model.update, 'A',
+                { 'pages': 81 }, doc_type='book', version=version - 1)
+        self.assertEqual(model.update('D', { 'title': 'Ulysses' },
+            doc_type='book', upsert=True), 1)
+        self.assertEqual(model.get('D', doc_type='book').title, 'Ulysses')
+        self.assertRaises(ValueError, model.update, 'A', doc_type='book')
+
+        ids = model.bulk_update(({ '_id': book_id, 'partial': { 'read': True } }
+            for book_id in 'ABC'), doc_type='book', chunk_size=2)
+        self.assertEqual(ids, [ 'A', 'B', 'C' ])
+        self.assertEqual(model.query().filter(model.read == True).count(), 3)
+        self.assertRaises(UpdateIndexError, model.bulk_update,
+                [ { '_id': 'E', 'partial': { 'read': True } } ], doc_type='book')
+
+    def test_bulk_ingest(self):
+        attempts = {}
+        def rejecting_send(connection, actions, **request_params):
+            # B is rejected once, C always fails
+            response = send(connection, actions, **request_params)
+            for item in response['items']:
+                result = item['index']
+                attempts[result['_id']] = attempts.get(result['_id'], 0) + 1
+                if result['_id'] == 'B' and attempts['B'] == 1:
+                    item['index'] = { '_id': 'B', 'status': 429,
+                        'error': 'EsRejectedExecutionException[rejected]' }
+                elif result['_id'] == 'C':
+                    item['index'] = { '_id': 'C', 'status': 400,
+                        'error': 'MapperParsingException[failed to parse]' }
+            return response
+        dead = []
+        bulk.send = rejecting_send
+        try:
+            ids = self.model.bulk_ingest(iter(self.books), doc_type='book',
+                    chunk_size=2, backoff=0, dead_letter=lambda action, doc,
+                    item: dead.append((doc['_id'], item['index']['status'])))
+            self.assertEqual(list(ids), [ 'A', 'B' ])
+            self.assertEqual(attempts, { 'A': 1, 'B': 2, 'C': 1 })
+            self.assertEqual(dead, [ ('C', 400) ])
+            self.assertRaises(IndexDocumentError, list,
+                    self.model.bulk_ingest(self.books[2:], doc_type='book'))
+        finally:
+            bulk.send = send
+
+    def test_warmup(self):
+        self.assertIn(self.model, registered_models())
+        self.model.bulk_index(self.books, doc_type='book')
+        self.model.connection.put_mapping(self.model.index_name, 'book',
+                { 'book': { 'properties': { 'read': { 'type': 'boolean' } } } })
+        self.assertFalse(hasattr(self.model, 'read'))
+        query = self.model.query().filter(self.model.pages > 0)
+        self.model.add_warmup_query(query)
+        sink = instrument.add_sink(instrument.HistogramSink())
+        try:
+            report = warmup([ self.model ], reload_mappings=True)
+        finally:
+            instrument.remove_sink(sink)
+        self.assertEqual(report.indices, [ self.model.index_name ])
+        self.assertEqual(report.queries, 1)
+        self.assertEqual(report.errors, [])
+        self.assertIsInstance(self.model.read, SearchField)
+        self.assertEqual(sink.summary()['get_mapping']['wall_time']['count'], 1)
+        self.assertEqual(warmup([ self.model ], queries=False).indices, [])
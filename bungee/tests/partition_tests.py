@@ -0,0 +1,160 @@
+import datetime
+
+from bungee import PartitionedSearchModel, instrument, param
+from bungee.model import get_connection
+from bungee.partition import filter_window
+from bungee.tests import BungeeTestCase
+
+
+class PartitionTestCase(BungeeTestCase):
+
+    events = [
+        { '_id': '1', 'name': 'launch', 'timestamp': '2013-05-01T10:00:00' },
+        { '_id': '2', 'name': 'review', 'timestamp': '2013-05-02T09:30:00' },
+        { '_id': '3', 'name': 'retro', 'timestamp': '2013-05-02T17:00:00' },
+        { '_id': '4', 'name': 'launch', 'timestamp': '2013-05-04T08:00:00' },
+    ]
+
+    def setUp(self):
+        super(PartitionTestCase, self).setUp()
+        es_url = self.url
+        self.connection = get_connection([ es_url ])
+        try:
+            self.connection.delete_index('unit_tests_events-*')
+        except:
+            pass
+        # An older partition providing the mapping
+        self.connection.create_index('unit_tests_events-2013.01.01', {
+            'mappings': { 'event': { 'properties': {
+                'name': { 'type': 'string', 'index': 'not_analyzed' },
+                'timestamp': { 'type': 'date' } } } } })
+
+        class Event(PartitionedSearchModel):
+            index_name = 'unit_tests_events-*'
+            index_pattern = 'unit_tests_events-%Y.%m.%d'
+            partition_field = 'timestamp'
+            doc_type = 'event'
+            url = es_url
+
+        self.event_model = Event
+        self.event_model.bulk_index(self.events)
+        self.event_model.initialize_search_fields(force_reload=True)
+
+    def tearDown(self):
+        super(PartitionTestCase, self).tearDown()
+        try:
+            self.connection.delete_index('unit_tests_events-*')
+            self.event_model.delete_field_mappings()
+        except:
+            pass
+
+    def test_partitioned_writes(self):
+        model = self.event_model
+        mappings = self.connection.get_mapping('unit_tests_events-*')
+        self.assertTrue(set([ 'unit_tests_events-2013.05.01',
+            'unit_tests_events-2013.05.02', 'unit_tests_events-2013.05.04' ])
+            <= set(mappings))
+        self.assertEqual(model.get('3').name, 'retro')
+        self.assertEqual([ doc._id for doc in model.multi_get(
+            [ '4', '1' ]).documents ], [ '4', '1' ])
+        raw = model.get('3', return_raw=True)
+        self.assertEqual((raw['_id'], raw['_type'], raw['name']),
+                ('3', 'event', 'retro'))
+
+        sink = instrument.add_sink(instrument.HistogramSink())
+        events = []
+        sink.handle = lambda event: events.append(event)
+        try:
+            self.assertEqual(model.get('3',
+                partition='2013-05-02T17:00:00').name, 'retro')
+            self.assertIsNone(model.get('3', partition=datetime.date(2013, 5,
+                1)))
+            self.assertEqual([ doc._id for doc in model.multi_get([ '4', '1' ],
+                partition={ '1': '2013-05-01T10:00:00',
+                    '4': datetime.date(2013, 5, 4) }).documents ], [ '4', '1' ])
+            self.assertEqual(model.get('1',
+                index='unit_tests_events-2013.05.01', return_raw=True)['name'],
+                'launch')
+        finally:
+            instrument.remove_sink(sink)
+        self.assertEqual([ (event.operation, event.index) for event in events ],
+            [ ('get', 'unit_tests_events-2013.05.02'),
+              ('get', 'unit_tests_events-2013.05.01'),
+              ('multi_get', 'unit_tests_events-*'),
+              ('get', 'unit_tests_events-2013.05.01') ])
+        self.assertRaises(ValueError, model.multi_get, [ '4', '1' ],
+                partition={ '1': '2013-05-01T10:00:00' })
+
+    def test_partitioned_updates(self):
+        model = self.event_model
+        self.assertRaises(ValueError, model.update, '2', { 'name': 'demo' })
+        model.update('2', { 'name': 'demo' }, partition='2013-05-02T09:30:00')
+        model.bulk_update([ { '_id': '1', 'partial': { 'name': 'liftoff' },
+            'partition': datetime.date(2013, 5, 1) } ])
+        self.assertEqual((model.get('2').name, model.get('1').name),
+                ('demo', 'liftoff'))
+        model.delete('event', '4', index='unit_tests_events-2013.05.04')
+        self.assertIsNone(model.get('4'))
+        self.assertEqual(model.query().count(), 3)
+        sink = instrument.add_sink(instrument.HistogramSink())
+        events = []
+        sink.handle = lambda event: events.append(event)
+        try:
+            self.assertTrue(model.query().filter(
+                model.timestamp >= '2013-05-01').filter(
+                model.timestamp < '2013-05-02').delete('event'))
+        finally:
+            instrument.remove_sink(sink)
+        self.assertEqual([ (event.operation, event.index) for event in events ],
+                [ ('delete_by_query', [ 'unit_tests_events-2013.05.01' ]) ])
+        self.assertEqual(model.query().count(), 2)
+
+    def test_index_pruning(self):
+        model = self.event_model
+        sink = instrument.add_sink(instrument.HistogramSink())
+        events = []
+        sink.handle = lambda event: events.append(event)
+        try:
+            q = model.query().filter(model.timestamp >= '2013-05-02T00:00:00')
+            q = q.filter(model.timestamp < datetime.date(2013, 5, 3))
+            results = q.order_by(model._id.asc()).all()
+            self.assertEqual(q.count(), 2)
+            template = q.filter(model.name == param('name')).prepare()
+            self.assertEqual(template.search(name='retro').total, 1)
+            self.assertEqual(template.search(server=True, name='retro').total,
+                    1)
+            everything = model.query().count()
+        finally:
+            instrument.remove_sink(sink)
+        self.assertEqual([ doc._id for doc in results.documents ], [ '2', '3' ])
+        self.assertEqual(everything, 4)
+        self.assertEqual([ event.index for event in events ],
+                [ [ 'unit_tests_events-2013.05.02' ] ] * 4
+                + [ 'unit_tests_events-*' ])
+
+    def test_pruning_bounds(self):
+        model = self.event_model
+        mapping = model.partition_mapping()
+        now = datetime.datetime(2013, 5, 2, 10, 30)
+        def indices(*filters):
+            query = model.query()
+            for expression in filters:
+                query = query.filter(expression)
+            return model.partition_indices(*filter_window(query.and_filters,
+                'timestamp', mapping, now))
+        self.assertEqual(indices(model.timestamp > '2013-05-01T23:59:59.999',
+            model.timestamp <= '2013-05-03T00:00:00'),
+            [ 'unit_tests_events-2013.05.02', 'unit_tests_events-2013.05.03' ])
+        self.assertEqual(indices(model.timestamp.range(
+            '2013-05-01T00:00:00', '2013-05-02T00:00:00')),
+            [ 'unit_tests_events-2013.05.01', 'unit_tests_events-2013.05.02' ])
+        self.assertEqual(indices(model.timestamp >= 'now-1d/d',
+            model.timestamp < 'now/d'), [ 'unit_tests_events-2013.05.01' ])
+        self.assertEqual(indices(model.timestamp > 'now-1d/d',
+            model.timestamp <= 'now'), [ 'unit_tests_events-2013.05.02' ])
+        self.assertEqual(indices(model.timestamp >= '2013-04-30||+1d',
+            model.timestamp < '2013-04-30||+1M/M'),
+            [ 'unit_tests_events-2013.05.01' ])
+        self.assertEqual(indices(model.timestamp >= 'now-1x'), None)
+        self.assertEqual(model.query_indices(model.query().filter(
+            model.timestamp >= 'now/d')), model.index_name)
@@ -0,0 +1,143 @@
+"""
+profile and explain against ES 2.4 responses (in fixtures/, following the
+documented mapping, profile and explain response formats of that release)
+to the query
+    filter(pages > 100).filter(author.last == 'heller').match(title ~ catch)
+on the test books, in a "unit_tests" index of two shards.
+"""
+import json
+import os
+import unittest
+
+from requests.adapters import BaseAdapter
+from requests.models import Response
+
+from bungee import SearchModel, profiler
+from bungee.model import get_connection
+from bungee.tests.compression_tests import RawResponse
+
+URL = 'http://profiler.test:9200'
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name)) as fixture_file:
+        return fixture_file.read()
+
+
+class RecordedAdapter(BaseAdapter):
+    """
+    Transport adapter answering mapping, search and explain requests with
+    the fixture ES responses, and recording the requests.
+    """
+
+    def __init__(self):
+        super(RecordedAdapter, self).__init__()
+        self.requests = []
+
+    def send(self, request, **kwargs):
+        self.requests.append(request)
+        path = request.path_url.split('?')[0].strip('/').split('/')
+        if path[-1] == '_mapping':
+            content = fixture('es2_mapping.json')
+        elif path[-1] == '_search':
+            content = json.loads(fixture('es2_profile.json'))
+            if 'profile' not in json.loads(request.body):
+                del content['profile']
+            content = json.dumps(content)
+        else:
+            content = fixture('es2_explain_%s.json' % path[-2])
+        response = Response()
+        response.status_code = 200
+        response._content = content
+        response.raw = RawResponse()
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class ProfilerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.adapter = RecordedAdapter()
+        get_connection([ URL ]).session.mount('http://', self.adapter)
+
+        class Book(SearchModel):
+            index_name = 'unit_tests'
+            doc_type = 'book'
+            url = URL
+
+        self.model = Book
+        self.query = Book.query().filter(Book.pages > 100).filter(
+            Book.author.last == 'heller').match(Book.title.like('catch'))
+
+    def tearDown(self):
+        self.model.delete_field_mappings()
+
+    def test_profile(self):
+        profile = self.query.profile()
+        search = self.adapter.requests[-1]
+        self.assertTrue(json.loads(search.body)['profile'])
+        self.assertEqual(len([ request for request in self.adapter.requests
+            if '_search' in request.url ]), 1)
+        self.assertEqual((profile.took, profile.hits), (3, 1))
+        self.assertEqual(len(profile.shards), 2)
+        root = profile.shards['[Vb1xQmMbTv2bXIN5YnYXqA][unit_tests][0]'][0]
+        self.assertEqual((root.query_type, root.clause), ('BooleanQuery', None))
+        self.assertEqual([ clause.location for clause in root.clauses ],
+                [ 'must[0]', 'and[0]', 'and[1]' ])
+        self.assertEqual([ (child.description, child.clause and
+            child.clause.location) for child in root.children ], [
+                ('title:catch', 'must[0]'),
+                ('+pages:{100 TO *} +author.last:heller', None) ])
+        self.assertAlmostEqual(root.took, 0.306428)
+        self.assertEqual([ (clause.location, round(clause.took, 6),
+            clause.hits) for clause in profile.clauses ], [
+                ('and[0]', 0.096861, None), ('must[0]', 0.079213, None),
+                ('and[1]', 0.032348, None) ])
+
+    def test_isolated_profile(self):
+        profile = self.query.profile(native=False, isolate=True)
+        searches = [ json.loads(request.body) for request
+            in self.adapter.requests if '_search' in request.url ]
+        self.assertEqual(len(searches), 4)
+        self.assertFalse(any('profile' in search for search in searches))
+        self.assertIsNone(profile.shards)
+        self.assertTrue(all(clause.took == 3 and clause.hits == 1
+            for clause in profile.clauses))
+
+    def test_explain(self):
+        explanation = self.query.explain('B')
+        self.assertTrue(explanation.matched)
+        self.assertAlmostEqual(explanation.value, 0.30685282)
+        weight, filters = explanation.details
+        self.assertEqual(weight.clause.location, 'must[0]')
+        self.assertEqual(weight.details[0].clause.location, 'must[0]')
+        self.assertIsNone(filters.clause)
+        self.assertEqual([ clause.location for clause
+            in filters.details[1].clauses ], [ 'and[0]', 'and[1]' ])
+        self.assertTrue(self.adapter.requests[-1].path_url.startswith(
+            '/unit_tests/book/B/_explain'))
+
+        explanation = self.query.explain('A', routing='Conrad')
+        self.assertFalse(explanation.matched)
+        self.assertIn('routing=Conrad', self.adapter.requests[-1].url)
+        title, filters = explanation.details
+        self.assertEqual((title.clause.location, title.value), ('must[0]', 0))
+        self.assertEqual([ (detail.clause.location, detail.value) for detail
+            in filters.details[0].details ], [ ('and[0]', 0), ('and[1]', 0) ])
+
+    def test_profile_node(self):
+        node = profiler.ProfileNode({ 'type': 'BooleanQuery',
+            'description': '+title:catch #author.last:heller',
+            'time_in_nanos': 2500000, 'children': [ { 'type': 'TermQuery',
+                'description': 'author.last:heller', 'time': '0.5ms' } ] },
+            profiler.query_clauses(self.query))
+        self.assertEqual((node.took, node.clause), (2.5, None))
+        self.assertEqual([ clause.location for clause in node.clauses ],
+                [ 'must[0]', 'and[1]' ])
+        self.assertEqual((node.children[0].took,
+            node.children[0].clause.location), (0.5, 'and[1]'))
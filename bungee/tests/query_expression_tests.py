@@ -1,7 +1,12 @@
+import datetime
 import unittest
 
 from bungee.tests import BungeeTestCase
-from bungee.field import SearchField
+from bungee import SearchModel
+from bungee import aggregation as agg, instrument, param, slowlog
+from bungee.exception import (ExpensiveQueryError, InvalidDocument,
+        InvalidQueryExpression)
+from bungee.field import SearchField, not_
 
 
 class QueryExpressionTestCase(BungeeTestCase):
@@ -100,3 +105,420 @@ class QueryExpressionTestCase(BungeeTestCase):
         count = q.count()
         self.assertEqual(count, 3)
 
+
+    def test_typed_operands(self):
+        self.model.put_mapping('book', self.multi_field_mapping,
+                ignore_conflicts=True)
+        self.assertEqual(self.model.pages > '300',
+                { 'range': { 'pages': { 'gt': 300 } } })
+        self.assertEqual(self.model.author.born >= datetime.date(1923, 5, 1),
+                { 'range': { 'author.born': { 'gte': '1923-05-01' } } })
+        self.assertEqual(self.model.title.untouched == 'Catch-22',
+                { 'term': { 'title.untouched': 'Catch-22' } })
+
+        self.model.bulk_index(self.books, doc_type='book')
+        q = self.model.query().filter(self.model.pages > 400)
+        results = q.all(decode=True)
+        self.assertEqual(results.total, 2)
+        borns = set(doc.author.born for doc in results.documents)
+        self.assertEqual(borns, set([ datetime.datetime(1923, 5, 1),
+            datetime.datetime(1962, 2, 21) ]))
+
+    def test_chaining(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        base = self.model.query().filter(self.model.pages > 100)
+        q = base
+        for first in ('Joseph', 'David'):
+            q = q.filter_or(self.model.author.first == first)
+        self.assertEqual(len(base.and_filters), 1)
+        self.assertEqual(len(q.or_filters), 2)
+        self.assertEqual(base.count(), 2)
+        self.assertIs(base._generate_es_query()[ 'query' ],
+                base._generate_es_query()[ 'query' ])
+        self.assertIs(base._generate_es_query(count_query=True)['filtered'],
+                base._generate_es_query()[ 'query' ]['filtered'])
+
+    def test_prepared_query(self):
+        self.model.put_mapping('book', self.multi_field_mapping,
+                ignore_conflicts=True)
+        self.model.bulk_index(self.books, doc_type='book')
+        q = self.model.query().filter(self.model.pages > param('min_pages'))
+        template = q.prepare()
+        self.assertEqual(template.params, set(['min_pages']))
+        self.assertRaises(ValueError, template.bind)
+
+        body = template.bind(min_pages='400')
+        self.assertEqual(body['query']['filtered']['filter']['and'],
+                [ { 'range': { 'pages': { 'gt': 400 } } } ])
+        self.assertEqual(template.search(min_pages=400).total, 2)
+        self.assertEqual(template.search(min_pages=500).total, 1)
+        for min_pages in (0, 400, 600):
+            self.assertEqual(sorted(doc._id for doc in template.search(
+                server=True, min_pages=min_pages).documents),
+                sorted(doc._id for doc in self.model.search(template.bind(
+                    min_pages=min_pages)).documents))
+        self.assertEqual(q.prepare(count_query=True).count(min_pages=400), 2)
+        self.assertEqual(q.routing(453).prepare().routing, 453)
+
+        strict = self.model.query().match(self.model.title.like(
+            param('title'))).strict().prepare()
+        self.assertEqual(strict.search(title='jest').total, 1)
+        self.assertRaises(ExpensiveQueryError, strict.search, title='*jest')
+        self.assertRaises(ExpensiveQueryError, strict.search, server=True,
+                title='*jest')
+        self.assertRaises(ExpensiveQueryError, self.model.query().match(
+            self.model.title.like('*jest')).strict().prepare)
+
+    def test_optimize(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        q = self.model.query()
+        q = q.filter(self.model.pages > 50).filter(self.model.pages >= 100)
+        q = q.filter(self.model._id.in_(['A', 'B', 'C']))
+        q = q.filter(self.model._id.in_(['B', 'C']))
+        self.assertEqual(len(q.explain_optimizations()), 2)
+
+        optimized = q.optimize()
+        filters = optimized._generate_es_query()['query']['filtered']
+        self.assertEqual(filters['filter']['and'], [
+            { 'terms': { '_id': ['A', 'B', 'C'] } },
+            { 'terms': { '_id': ['B', 'C'] } },
+            { 'range': { 'pages': { 'gte': 100 } } } ])
+        self.assertEqual(optimized.count(), q.count())
+
+        q = self.model.query().filter_or(self.model._id == 'A')
+        q = q.filter_or(self.model._id.in_(['B', 'C']))
+        filters = q.optimize()._generate_es_query()['query']['filtered']
+        self.assertEqual(filters['filter']['or'],
+                [ { 'terms': { '_id': ['A', 'B', 'C'] } } ])
+
+    def test_optimize_date_ranges(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        born = self.model.author.born
+        q = self.model.query().filter(born >= 'now-7d')
+        q = q.filter(born >= 'now-1d').optimize()
+        ranges = [ expression['range']['author.born'] for expression in
+            q._generate_es_query()['query']['filtered']['filter']['and'] ]
+        self.assertEqual(ranges, [ { 'gte': 'now-7d' }, { 'gte': 'now-1d' } ])
+
+        q = self.model.query().filter(born >= '1923-05-01||+1M')
+        q = q.filter(born >= '1923-05-01').optimize()
+        self.assertEqual(len(q._generate_es_query()['query']['filtered'][
+            'filter']['and']), 2)
+
+        q = self.model.query().filter(born >= datetime.date(1923, 5, 1))
+        q = q.filter(born >= '1899-12-31').filter(born < '1990-01-01')
+        filters = q.optimize()._generate_es_query()['query']['filtered']
+        self.assertEqual(filters['filter']['and'], [ { 'range': {
+            'author.born': { 'gte': '1923-05-01', 'lt': '1990-01-01' } } } ])
+
+    def test_cost_report(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        q = self.model.query().match(self.model.title.like('*ness'))
+        q = q.filter(self.model.title.regexp('.*jest'))
+        report = q.cost_report()
+        self.assertEqual(set(warning.rule for warning in report.errors),
+                set([ 'open_regexp', 'leading_wildcard' ]))
+        self.assertRaises(ExpensiveQueryError, q.strict().all)
+        self.assertEqual(len(self.model.query().cost_report()), 0)
+
+    def test_slow_query_log(self):
+        self.model.bulk_index(self.books, doc_type='book')
+        log = slowlog.configure(threshold=0, max_per_second=None)
+        try:
+            self.model.query().page_size(2).all()
+            self.model.query().count()
+        finally:
+            slowlog.disable()
+        records = list(log.records)
+        self.assertEqual([ record['operation'] for record in records ],
+                [ 'search', 'search', 'count' ])
+        self.assertEqual([ record['page'] for record in records ],
+                [ 0, 1, None ])
+        self.assertIn('query_expression_tests.py', records[0]['call_site'])
+
+    def test_percolate(self):
+        self.model.put_mapping('book', self.multi_field_mapping,
+                ignore_conflicts=True)
+        model = self.model
+        model.register_query('short', model.query().filter(model.pages < 100))
+        model.register_query('josephs', model.query().filter(
+            model.author.first == 'joseph').match(model.title.like('catch')))
+        model.register_query('untouched', model.query().filter(
+            model.title.untouched.in_(['Infinite Jest', 'Catch-22'])))
+        model.register_query('old', model.query().filter(
+            model.author.born < '1900-01-01'))
+        matches = []
+        model.add_percolate_listener(lambda doc_id, doc, query_ids:
+            matches.append((doc_id, query_ids)))
+        model.bulk_index(self.books, doc_type='book')
+        self.assertEqual(matches, [ ('A', [ 'short', 'old' ]),
+            ('B', [ 'josephs', 'untouched' ]), ('C', [ 'untouched' ]) ])
+
+        model.unregister_query('old')
+        self.assertEqual(model.percolate(self.books[0]), [ 'short' ])
+        self.assertEqual(model.percolate({ 'title': 'Catch-22', 'pages': 10 },
+            doc_type='book'), [ 'short', 'untouched' ])
+
+    def test_routing(self):
+        model = self.model
+        model.routing_field = 'pages'
+        model.bulk_index(self.books[:2], doc_type='book')
+        model.index(self.books[2], doc_type='book')
+        self.assertEqual(model.get('A', 'book', routing=72).title,
+                'Heart of Darkness')
+        self.assertIsNone(model.get('A', 'book', routing=453))
+        self.assertRaises(ValueError, model.get, 'A', 'book',
+                routing=[ 72, 453 ])
+        self.assertEqual([ doc._id for doc in model.multi_get([ 'C', 'B' ],
+            'book', routing=[ 515, 453 ]).documents ], [ 'C', 'B' ])
+        self.assertEqual([ doc._id for doc in model.multi_get([ 'C', 'B' ],
+            'book', routing={ 'B': 453, 'C': 515 }).documents ], [ 'C', 'B' ])
+        self.assertRaises(ValueError, model.multi_get, [ 'C', 'B' ], 'book',
+                routing=[ 515 ])
+
+        q = model.query().filter(model.pages.in_([ 453, 515 ]))
+        self.assertEqual(q._search_routing(), [ '453', '515' ])
+        q = q.filter(model.pages == 515)
+        self.assertEqual(q._search_routing(), [ '515' ])
+        self.assertEqual(q.count(), 1)
+        self.assertEqual(q.routing(453)._search_routing(), 453)
+        self.assertEqual(model.query().filter(model.pages == 72).filter_or(
+            model.pages > 100)._search_routing(), None)
+        self.assertRaises(InvalidDocument, model.index, { 'title': 'Anon' },
+                doc_type='book')
+
+    def test_aggregations(self):
+        model = self.model
+        model.bulk_index(self.books, doc_type='book')
+        q = model.query().aggregate(
+            agg.terms(model.author.first).aggregate(agg.stats(model.pages)),
+            agg.range_(model.pages, [ (None, 100), (100, None) ]),
+            agg.date_histogram(model.published, 'year', name='years'),
+            agg.cardinality(model.author.last, name='authors'))
+        results = q.aggregations()
+        by_first = results['author.first'].buckets
+        self.assertEqual([ (bucket.key, bucket.doc_count, bucket.pages.sum)
+            for bucket in by_first ], [ ('joseph', 2, 525), ('david', 1, 515) ])
+        self.assertEqual([ bucket.doc_count
+            for bucket in results.pages.buckets ], [ 1, 2 ])
+        self.assertEqual([ bucket.key_as_string[:4]
+            for bucket in results.years.buckets ], [ '1900', '1961', '1996' ])
+        self.assertEqual(results.authors.value, 3)
+
+        all_results = q.page_size(2).all()
+        self.assertEqual(len(all_results.documents), 3)
+        self.assertEqual(all_results.aggregations.authors.value, 3)
+
+        q = model.query().match(model.title.like('catch')).filter_or(
+            model.pages < 100).filter_or(not_(model.author.last.missing()))
+        self.assertEqual(agg.bool_query(q._generate_es_query(
+            count_query=True)), { 'bool': {
+                'must': q._generate_es_query(count_query=True)['filtered'][
+                    'query'],
+                'filter': { 'bool': { 'should': [
+                    { 'range': { 'pages': { 'lt': 100 } } },
+                    { 'bool': { 'must_not': { 'bool': { 'must_not': {
+                        'exists': { 'field': 'author.last' } } } } } } ],
+                    'minimum_should_match': 1 } } } })
+        self.assertRaises(InvalidQueryExpression, agg.terms, model.author)
+
+    def test_threshold_counts(self):
+        model = self.model
+        model.bulk_index(self.books, doc_type='book')
+        self.assertEqual(model.query().count(at_least=2), 2)
+        self.assertEqual(model.query().count(at_least=5), 3)
+        self.assertTrue(model.query().filter(model.pages > 500).exists())
+        self.assertFalse(model.query().filter(model.pages > 600).exists())
+
+        q = model.query().filter(model.pages > 100).page_size(1)
+        sink = instrument.add_sink(instrument.HistogramSink())
+        try:
+            results = q.page(1)
+            self.assertEqual(q.count(cached=True), 2)
+            self.assertEqual(q.count(at_least=1, cached=True), 1)
+            self.assertEqual(q.filter(model.pages > 500).count(), 1)
+            model.index({ '_id': 'D', 'title': 'Ulysses', 'pages': 730 },
+                    doc_type='book')
+            self.assertEqual(q.count(), 3)
+            self.assertEqual(q.count(cached=True), 2)
+        finally:
+            instrument.remove_sink(sink)
+        self.assertEqual((results.total, [ doc._id for doc in
+            results.documents ]), (2, [ 'C' ]))
+        summary = sink.summary()
+        self.assertEqual(summary['search']['wall_time']['count'], 1)
+        self.assertEqual(summary['count']['wall_time']['count'], 2)
+
+    def test_delete(self):
+        model = self.model
+        model.bulk_index(self.books, doc_type='book')
+        self.assertTrue(model.query().filter(model.pages < 100).delete('book'))
+        self.assertEqual(model.query().count(), 2)
+
+        model.bulk_index(self.books, doc_type='book')
+        deleted = []
+        model.add_delete_listener(lambda doc_type, doc_ids:
+            deleted.extend(doc_ids))
+        reports = []
+        progress = model.query().filter(model.pages > 100).delete('book',
+                batch_size=1, max_per_second=1000,
+                progress=lambda progress: reports.append(progress.deleted))
+        self.assertEqual((progress.total, progress.deleted), (2, 2))
+        self.assertEqual(sorted(deleted), [ 'B', 'C' ])
+        self.assertEqual(reports, [ 1, 2 ])
+        self.assertEqual([ doc._id for doc in model.query().all().documents ],
+                [ 'A' ])
+
+        model.bulk_index(self.books, doc_type='book')
+        progress = model.query().delete('book', batch_size=1,
+                cancel=lambda: len(deleted) >= 3)
+        self.assertTrue(progress.cancelled)
+        self.assertEqual(progress.deleted, 1)
+        self.assertEqual(model.query().count(), 2)
+
+    def test_delete_routed(self):
+        model = self.model
+        model.routing_field = 'pages'
+        model.bulk_index(self.books, doc_type='book')
+        progress = model.query().filter(model.pages > 100).delete('book',
+                batch_size=1)
+        self.assertEqual(progress.deleted, 2)
+        self.assertEqual([ doc._id for doc in model.query().all().documents ],
+                [ 'A' ])
+        self.assertIsNone(model.get('B', 'book', routing=453))
+
+        model.bulk_index(self.books, doc_type='book')
+        self.assertTrue(model.query().filter(model.pages > 100).routing(515)
+                .delete('book'))
+        self.assertEqual(sorted(doc._id for doc in
+            model.query().all().documents), [ 'A', 'B' ])
+
+    def test_geo(self):
+        model = self.model
+        model.put_mapping('store', { 'store': { 'properties': {
+            'name': { 'type': 'string', 'index': 'not_analyzed' },
+            'location': { 'type': 'geo_point' } } } })
+        stores = [
+            { '_id': 'soho', 'name': 'soho',
+                'location': { 'lat': 40.7233, 'lon': -74.0030 } },
+            { '_id': 'brooklyn', 'name': 'brooklyn',
+                'location': [ -73.9442, 40.6782 ] },
+            { '_id': 'boston', 'name': 'boston', 'location': '42.3601,-71.0589' },
+        ]
+        model.bulk_index(stores, doc_type='store')
+        center = (40.7128, -74.0060)
+        near = model.location.within_distance(center, 10)
+        self.assertEqual(near, { 'geo_distance': { 'distance': '10km',
+            'location': { 'lat': 40.7128, 'lon': -74.006 } } })
+        q = model.query().filter(near)
+        filters = q._generate_es_query(count_query=True)['filtered']['filter']
+        box, distance = filters['and']
+        self.assertGreater(box['geo_bounding_box']['location']['top_left'][
+            'lat'], 40.7128 + 10 / 111.3)
+        self.assertEqual(distance['geo_distance']['optimize_bbox'], 'none')
+        self.assertEqual(sorted(doc._id for doc in q.all().documents),
+                [ 'brooklyn', 'soho' ])
+        self.assertEqual(model.query().filter(model.location.within_distance(
+            center, 200, 'mi')).count(), 3)
+        self.assertEqual(len(model.query().filter_or(near).filter_or(
+            model.name == 'boston')._generate_es_query(True)['filtered'][
+            'filter']['or'][0]['and']), 2)
+
+        nearest = model.query().filter(model._type == 'store').order_by(
+            model.location.by_distance((42.0, -71.0)))
+        self.assertEqual([ doc._id for doc in nearest.all().documents ],
+                [ 'boston', 'brooklyn', 'soho' ])
+        self.assertEqual([ doc._id for doc in model.query().filter(
+            model.location.within_box((41, -74.01), (40.6, -73.99))
+            ).all().documents ], [ 'soho' ])
+        self.assertEqual([ doc._id for doc in model.query().filter(
+            model.location.within_polygon([ (41, -75), (41, -73.98),
+                (40.5, -73.98) ])).all().documents ], [ 'soho' ])
+        self.assertRaises(InvalidQueryExpression,
+                model.name.within_distance, center, 10)
+        self.assertRaises(InvalidQueryExpression,
+                model.location.within_distance, center, 10, 'furlongs')
+        self.assertRaises(InvalidQueryExpression,
+                model.location.within_distance, (91, 0), 10)
+
+    def test_nested(self):
+        model = self.model
+        model.put_mapping('anthology', self.nested_mapping)
+        model.bulk_index([
+            { '_id': 'X', 'title': 'Modern Classics', 'authors': [
+                { 'first': 'Joseph', 'last': 'Heller', 'born': '1923-05-01' },
+                { 'first': 'David', 'last': 'Wallace',
+                    'born': '1962-02-21' } ] },
+            { '_id': 'Y', 'title': 'Old Classics', 'authors': [
+                { 'first': 'Joseph', 'last': 'Conrad', 'born': '1857-12-03' },
+                { 'first': 'David', 'last': 'Heller',
+                    'born': '1880-01-01' } ] },
+        ], doc_type='anthology')
+        authors = model.authors
+        q = model.query().filter(authors.nested(authors.first == 'joseph',
+            authors.last == 'heller'))
+        self.assertEqual(q._generate_es_query(True)['filtered']['filter'],
+            { 'and': [ { 'nested': { 'path': 'authors', 'filter': { 'and': [
+                { 'term': { 'authors.first': 'joseph' } },
+                { 'term': { 'authors.last': 'heller' } } ] } } } ] })
+        self.assertEqual([ doc._id for doc in q.all().documents ], [ 'X' ])
+        self.assertEqual(model.query().filter(authors.nested(
+            authors.born < '1900-01-01')).count(), 1)
+        q = model.query().match(authors.nested_query(
+            authors.last.like('heller'), score_mode='max'))
+        self.assertEqual(sorted(doc._id for doc in q.all().documents),
+                [ 'X', 'Y' ])
+        self.assertRaises(InvalidQueryExpression, model.title.nested,
+                model.title == 'x')
+        self.assertRaises(InvalidQueryExpression, authors.__eq__, 'x')
+
+    def test_parent_child(self):
+        model = self.model
+        model.bulk_index(self.books, doc_type='book')
+        model.put_mapping('chapter', { 'chapter': {
+            '_parent': { 'type': 'book' },
+            'properties': { 'book': { 'type': 'string',
+                'index': 'not_analyzed' } } } })
+        class Chapter(SearchModel):
+            index_name = model.index_name
+            url = self.url
+            doc_type = 'chapter'
+            parent_field = 'book'
+        Chapter.bulk_index([
+            { '_id': '1', 'book': 'A', 'title': 'The Sepulchral City',
+                'words': 9000 },
+            { '_id': '2', 'book': 'B', 'title': 'The Texan', 'words': 4000 },
+            { '_id': '3', 'book': 'B', 'title': 'Yossarian', 'words': 12000 },
+        ])
+        Chapter.index({ '_id': '4', 'book': 'C', 'title': 'Year of Glad',
+            'words': 800 })
+        self.assertRaises(InvalidDocument, Chapter.index,
+                { 'title': 'Orphan' })
+        self.assertIsNone(Chapter.get('2'))
+        self.assertEqual(Chapter.get('2', parent='B').title, 'The Texan')
+        self.assertEqual([ doc._id for doc in Chapter.multi_get([ '1', '2' ],
+            parent=[ 'A', 'B' ]).documents ], [ '1', '2' ])
+        Chapter.update('2', { 'words': 4500 }, parent='B')
+        self.assertEqual(Chapter.get('2', parent='B').words, 4500)
+
+        long_chapters = Chapter.query().filter(Chapter.words > 5000)
+        q = model.query().has_child(long_chapters)
+        self.assertEqual(q._generate_es_query(True)['filtered']['filter'],
+            { 'and': [ { 'has_child': { 'type': 'chapter', 'query': {
+                'filtered': { 'filter': { 'and': [ { 'range': {
+                    'words': { 'gt': 5000 } } } ] } } } } } ] })
+        self.assertEqual(sorted(doc._id for doc in q.all().documents),
+                [ 'A', 'B' ])
+        self.assertEqual(model.query().has_child(Chapter.words < 1000,
+            'chapter', score_type='max').count(), 1)
+
+        q = Chapter.query().has_parent(model.query().filter(
+            model.author.last == 'heller'), 'book')
+        self.assertEqual(sorted(doc._id for doc in q.all().documents),
+                [ '2', '3' ])
+        self.assertEqual(Chapter.query().has_parent(model.pages < 100,
+            'book').count(), 1)
+        self.assertRaises(InvalidQueryExpression, model.query().has_child,
+                Chapter.words > 0)
+        self.assertTrue(Chapter.delete('chapter', '4', parent='C'))
+        self.assertIsNone(Chapter.get('4', parent='C'))
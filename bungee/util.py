@@ -24,3 +24,61 @@ def make_identifier(text):
         raise ValueError, "Cannot make identifier from '%s'" % text
     return text
 
+
+class Chain(object):
+    """
+    Immutable, singly linked list of items in insertion order.
+
+    Appending returns a new Chain that shares every existing node with its
+    parent, so building up a list one item at a time costs O(1) per step and
+    earlier Chains are never modified.
+    """
+
+    __slots__ = ('_item', '_parent', '_length')
+
+    def __init__(self, item=None, parent=None):
+        self._item = item
+        self._parent = parent
+        self._length = parent._length + 1 if parent is not None else 0
+
+    def append(self, item):
+        return Chain(item, self)
+
+    def extend(self, items):
+        chain = self
+        for item in items or ():
+            chain = Chain(item, chain)
+        return chain
+
+    def to_list(self):
+        """
+        Return the items as a new list, oldest first.
+        """
+        items = []
+        node = self
+        while node._length:
+            items.append(node._item)
+            node = node._parent
+        items.reverse()
+        return items
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        return self._length
+
+    def __repr__(self):
+        return 'Chain(%r)' % self.to_list()
+
+
+EMPTY_CHAIN = Chain()
+
+
+def to_chain(items):
+    """
+    Return items (a Chain, list or None) as a Chain.
+    """
+    if isinstance(items, Chain):
+        return items
+    return EMPTY_CHAIN.extend(items)